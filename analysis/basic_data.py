@@ -2,17 +2,18 @@ from typing import Callable
 
 import numpy as np
 import pandas as pd
-from shapely.geometry import Point
-
-from econtools import load_or_build
-
-from epa_airpoll import (blocks_population, monitors_annual_summary,
-                         load_blocks_shape_info, monitors_data,
-                         load_block_shape)
-from multisatpm import msat_northamer_1year, multisat_conus_year
-
 
+from util.cache import load_or_build
 from util.env import data_path
+from util.prefetch import prefetch_map
+from util.panel import PanelBuilder
+from util.profiling import profiled
+from analysis.sources import (blocks_population, monitors_annual_summary,
+                              load_blocks_shape_info, monitors_data,
+                              msat_northamer_1year, multisat_conus_year,
+                              SATELLITE_YEARS)
+from analysis.geometry_store import read_geometries, bbox_contains
+from analysis.exposure_query import exposure_query
 from analysis.geo_exposure import (multisatpm_exposure_block_conus,
                                    multisatpm_exposure_bg_conus,
                                    _xy_to_int_multisat, _int_to_xy_multisat)
@@ -48,27 +49,26 @@ def block_has_monitor(year: int) -> pd.Series:
 
 @load_or_build(data_path('blocks_multisatpm_withpop_panel.pkl'))
 def blocks_multisatpm_withpop_panel() -> pd.DataFrame:
-    dfs = [blocks_multisatpm_withpop(y) for y in range(2000, 2016 + 1)]
-    df = pd.concat(dfs, axis=1)
-    del dfs
-
-    return df
+    return _stream_panel(blocks_multisatpm_withpop, range(2000, 2016 + 1))
 
 
 @load_or_build(data_path('blocks_multisatpm_withpop_{}.pkl'), path_args=[0])
 def blocks_multisatpm_withpop(year):
-    df = (multisatpm_exposure_block_conus(year)
-          .squeeze()
-          .to_frame(year))
-    df = merge_blocks_pop(df)
-
-    df = df[df['pop'] > 0].copy()
+    # Same as merging all blocks, then `pop > 0`, but only merges those
+    df = (exposure_query('multisatpm', years=[year])
+          .to_blocks()
+          .where(_has_pop, 'pop > 0')
+          .collect())
+    return df
 
-    del df['pop']
 
-    return df
+def _has_pop(block_ids):
+    pop = blocks_population().reindex(block_ids)
+    assert pop.notnull().min()
+    return pop.values > 0
 
 
+@profiled
 def merge_blocks_pop(df):
     """ Join blocks' population to `df` w/ block_id index """
     pop = blocks_population()
@@ -88,11 +88,7 @@ def merge_blocks_xy(df):
 # Block Group Level
 @load_or_build(data_path('bg_multisatpm_withpop_panel.pkl'))
 def bg_multisatpm_withpop_panel():
-    dfs = [bg_multisatpm_withpop(y) for y in range(2000, 2016 + 1)]
-    df = pd.concat(dfs, axis=1)
-    del dfs
-
-    return df
+    return _stream_panel(bg_multisatpm_withpop, range(2000, 2016 + 1))
 
 
 @load_or_build(data_path('bg_multisatpm_withpop_{}.pkl'), path_args=[0])
@@ -119,6 +115,7 @@ def merge_bg_pop(df):
     return new_df
 
 
+@profiled
 def counties_monitor(year):
     mon = monitors_annual_summary(year)
 
@@ -141,6 +138,8 @@ def counties_monitor(year):
 
 @load_or_build(data_path('monitors_block.pkl'))
 def monitors_block():
+    from shapely.geometry import Point
+
     df = monitors_data()
     df = df[df['state_code'] != 'CC']
     df['state_code'] = df['state_code'].astype(int)
@@ -156,26 +155,24 @@ def monitors_block():
     for state_code, state_mon in df.groupby('state_code'):
 
         print(f"Loading shape {state_code}...", end='')
-        state_shape = load_block_shape(str(state_code).zfill(2))
-        state_shape = state_shape.set_index('GEOID10')
-        state_shape.index.name = 'block_id'
+        state_shape = read_geometries('block', str(state_code).zfill(2))
         print("done!")
 
         for county_code, county_mon in state_mon.groupby('county_code'):
             print(f"Finding in county {county_code}")
             county_str = str(county_code).zfill(3)
-            county_shape = state_shape[state_shape['COUNTYFP10'] == county_str]
             for monitor_id, monitor_row in county_mon.iterrows():
-                this_point = Point(monitor_row['longitude'],
-                                   monitor_row['latitude'])
-                winner = county_shape.contains(this_point)
-                count = winner.sum()
-                if count < 1 or winner.empty:
-                    winner = state_shape.contains(this_point)
+                x, y = monitor_row['longitude'], monitor_row['latitude']
+                # Only shapes whose bounding box holds the point can contain it
+                near_shape = state_shape[bbox_contains(state_shape, x, y)]
+                winner = near_shape.contains(Point(x, y))
+                in_county = winner & (near_shape['county'] == county_str)
+                count = in_county.sum()
+                if count < 1:
                     count = winner.sum()
                     assert count == 1
                 elif count == 1:
-                    pass
+                    winner = in_county
                 else:
                     raise AssertionError
 
@@ -187,12 +184,7 @@ def monitors_block():
 # Satellite Data - Block Level
 def multisatpm_years_block(start_year, end_year):       # XXX DEPRECATE
     years = range(start_year, (end_year+1))
-    exp_dfs = [(multisatpm_exposure_block_conus(year).squeeze().to_frame(year))
-               for year in years]
-    df = pd.concat(exp_dfs, axis=1)
-    del exp_dfs
-
-    return df
+    return _stream_panel(multisatpm_exposure_block_conus, years)
 
 
 @load_or_build(data_path('tmp_multisatpm_3year_wlag_block.pkl'))
@@ -214,12 +206,7 @@ def prep_multisatpm_3year_block():
 # Satellite Data - Block Group Level
 def multisatpm_years_bg(start_year, end_year):
     years = range(start_year, (end_year+1))
-    exp_dfs = [(multisatpm_exposure_bg_conus(year).squeeze().to_frame(year))
-               for year in years]
-    df = pd.concat(exp_dfs, axis=1)
-    del exp_dfs
-
-    return df
+    return _stream_panel(multisatpm_exposure_bg_conus, years)
 
 
 @load_or_build(data_path('tmp_multisatpm_3year_wlag_bg.pkl'))
@@ -277,8 +264,16 @@ def msatna_bg_3lag_year(year: int) -> pd.Series:
 
 @load_or_build(data_path('tmp_msatna_blocks_3lag_{}.pkl'), path_args=[0])
 def msatna_blocks_3lag_year(year: int) -> pd.Series:
-    """ Convenience, just for the caching """
-    return msatna_blocks_3lag_panel()[year]
+    """
+    `msatna_blocks_3lag_panel()[year]`, reading only the 3 source years it
+    needs
+    """
+    df = (exposure_query('msatna')
+          .lag3()
+          .years([year])
+          .to_blocks()
+          .collect())
+    return df[year]
 
 
 @load_or_build(data_path('tmp_msatna_blocks_3lag_panel.pkl'))
@@ -297,6 +292,7 @@ def msatna_blocks_panel() -> pd.DataFrame:
     return df
 
 
+@profiled
 def merge_blocks_msatna(exp0: pd.DataFrame) -> pd.DataFrame:
     # blocks
     df = load_blocks_shape_info()
@@ -331,18 +327,19 @@ def msatna_panel() -> pd.DataFrame:
     return _panel_guts(year_func)
 
 
+@profiled
 def _panel_guts(year_func: Callable) -> pd.DataFrame:
-    years = range(2002, 2016 + 1)
-    exp_dfs = [_prep_df_for_merge(year_func(year), year)
-               for year in years]
-    df = pd.concat(exp_dfs, axis=1)
-    del exp_dfs
-
-    df = df.reset_index()
-    df[xy] = _int_to_xy_multisat(df[xy_int])
-    df = (df
-          .set_index(xy)
-          .drop(xy_int, axis=1))
+    years = SATELLITE_YEARS
+    panel = PanelBuilder(years)
+    # Read year y + 1 while year y is prepped
+    for year, year_df in zip(years, prefetch_map(year_func, years)):
+        panel.add(year, _prep_df_for_merge(year_df, year)[year])
+        del year_df
+    df = panel.frame()
+
+    df.index = pd.MultiIndex.from_arrays(
+        [_int_to_xy_multisat(df.index.get_level_values(c)) for c in xy_int],
+        names=xy)
 
     df.columns = df.columns.astype(int)
 
@@ -361,6 +358,16 @@ def _prep_df_for_merge(df0: pd.DataFrame, year: int) -> pd.DataFrame:
 
 
 # Aux functions
+def _stream_panel(year_func: Callable, years) -> pd.DataFrame:
+    """ (rows x years) panel of single-column `year_func(year)` outputs """
+    panel = PanelBuilder(years)
+    for year, year_df in zip(years, prefetch_map(year_func, years)):
+        panel.add(year, year_df.squeeze())
+        del year_df
+    return panel.frame()
+
+
+@profiled
 def panel_to_3lag(df: pd.DataFrame) -> pd.DataFrame:
     N, __ = df.shape
     years = df.columns[3:].values.tolist()
@@ -375,6 +382,7 @@ def panel_to_3lag(df: pd.DataFrame) -> pd.DataFrame:
     return out
 
 
+@profiled
 def panel_to_3nolag(df: pd.DataFrame) -> pd.DataFrame:
     N, __ = df.shape
     years = df.columns[2:].values.tolist()
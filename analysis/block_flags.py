@@ -0,0 +1,180 @@
+"""
+Compact store for per-block boolean flags.
+
+Flags are packed 8 blocks to a byte. Blocks are sorted by block ID, so every
+county (first 5 digits) and state (first 2 digits) is a contiguous run of
+bits, and county/state counts and any()'s are segmented popcounts over the
+packed bytes instead of `groupby('fips')` on bool columns.
+"""
+import copy
+
+import numpy as np
+import pandas as pd
+
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+class BlockFlags(object):
+    """
+    Packed boolean layers over a fixed, sorted set of blocks. Layers are keyed
+    by anything hashable, e.g. `('is_over', 2014, 'pm25_12', 'msatna')`.
+    """
+
+    def __init__(self, block_ids):
+        ids = np.sort(np.asarray(pd.Index(block_ids).unique(), dtype='U15'))
+        self.index = pd.Index(ids.astype(object), name='block_id')
+        self.n = len(ids)
+        self.fips, self.county_starts = _runs(ids.astype('U5'))
+        self.states, self.state_starts = _runs(ids.astype('U2'))
+        self._layers = {}
+        self._last_lookup = (None, None)
+
+    def __len__(self):
+        return len(self._layers)
+
+    def __contains__(self, key):
+        return key in self._layers
+
+    def keys(self):
+        return list(self._layers.keys())
+
+    @property
+    def nbytes(self):
+        return sum(v.nbytes for v in self._layers.values())
+
+    # Packed layers are read-only, so copies can share them
+    def __deepcopy__(self, memo):
+        new = copy.copy(self)
+        new._layers = dict(self._layers)
+        return new
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_last_lookup'] = (None, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        for packed in self._layers.values():
+            packed.flags.writeable = False
+
+    # Setting and getting layers
+    def add(self, key, values, fill=False):
+        """
+        Store bool `values` as layer `key`. `values` is either a Series indexed
+        by block ID (blocks not in it get `fill`) or an array already in
+        `self.index` order.
+        """
+        if isinstance(values, pd.Series):
+            pos = self.positions(values.index)
+            found = pos >= 0
+            raw = values.values[found]
+            arr = np.full(self.n, fill, dtype=bool)
+            arr[pos[found]] = np.where(pd.isnull(raw), fill, raw).astype(bool)
+            values = arr
+        else:
+            values = np.asarray(values, dtype=bool)
+            if len(values) != self.n:
+                raise ValueError(
+                    f"Expected {self.n} values, got {len(values)}")
+        packed = np.packbits(values, bitorder='little')
+        packed.flags.writeable = False
+        self._layers[key] = packed
+
+    def positions(self, index) -> np.ndarray:
+        """
+        Position of each label of `index` in `self.index` (-1 if absent). The
+        last lookup is kept, so adding many layers with the same index only
+        hashes the block IDs once.
+        """
+        last_index, last_pos = self._last_lookup
+        if index is last_index or (last_index is not None and
+                                   index.equals(last_index)):
+            return last_pos
+        pos = self.index.get_indexer(index)
+        self._last_lookup = (index, pos)
+        return pos
+
+    def add_bits(self, key, packed):
+        """ Store an already-packed layer, e.g. from `bits(a) & bits(b)` """
+        if packed.dtype != np.uint8 or len(packed) != (self.n + 7) // 8:
+            raise ValueError("Not a packed layer for these blocks")
+        packed = packed.view()
+        packed.flags.writeable = False
+        self._layers[key] = packed
+
+    def bits(self, key) -> np.ndarray:
+        """ Packed layer; combine layers with &, |, ^ and ~ """
+        return self._layers[key]
+
+    def array(self, key) -> np.ndarray:
+        return np.unpackbits(self._layers[key], count=self.n,
+                             bitorder='little').astype(bool)
+
+    def get(self, key) -> pd.Series:
+        return pd.Series(self.array(key), index=self.index, name=key)
+
+    def update(self, other):
+        """ Copy in all layers of `other`, which must cover the same blocks """
+        if other.n != self.n or not other.index.equals(self.index):
+            raise ValueError("BlockFlags cover different blocks")
+        self._layers.update(other._layers)
+
+    # Reductions
+    def count(self, keys, level='county') -> pd.DataFrame:
+        """ Flagged blocks per county or state, one column per key """
+        keys = _as_key_list(keys)
+        return self.count_bits({key: self._layers[key] for key in keys},
+                               level=level)
+
+    def count_bits(self, columns: dict, level='county') -> pd.DataFrame:
+        """ Like `count` for packed arrays not stored as layers """
+        starts, labels = self._level(level)
+        edges = np.append(starts, self.n)
+        out = {name: np.diff(_prefix_count(packed, edges))
+               for name, packed in columns.items()}
+        return pd.DataFrame(out, index=labels, columns=list(columns))
+
+    def any(self, keys, level='county') -> pd.DataFrame:
+        return self.count(keys, level=level) > 0
+
+    def broadcast(self, values, level='county') -> np.ndarray:
+        """ Repeat one value per county/state out to its blocks """
+        starts, __ = self._level(level)
+        sizes = np.diff(np.append(starts, self.n))
+        return np.repeat(np.asarray(values), sizes)
+
+    def _level(self, level):
+        if level == 'county':
+            return self.county_starts, pd.Index(self.fips, name='fips')
+        elif level == 'state':
+            return self.state_starts, pd.Index(self.states, name='state')
+        else:
+            raise ValueError(f"Invalid level: {level}")
+
+
+def _runs(sorted_labels):
+    """ Distinct labels of a sorted array and where each run starts """
+    if len(sorted_labels) == 0:
+        return sorted_labels.astype(object), np.zeros(0, dtype=np.int64)
+    new = np.empty(len(sorted_labels), dtype=bool)
+    new[0] = True
+    new[1:] = sorted_labels[1:] != sorted_labels[:-1]
+    starts = np.flatnonzero(new)
+    return sorted_labels[starts].astype(object), starts
+
+
+def _prefix_count(packed, positions):
+    """ Number of set bits before each of `positions` (bit offsets) """
+    cum = np.zeros(len(packed) + 1, dtype=np.int64)
+    np.cumsum(_POPCOUNT[packed], out=cum[1:])
+    byte, rem = positions >> 3, (positions & 7).astype(np.uint8)
+    head = packed[np.minimum(byte, len(packed) - 1)] if len(packed) else byte
+    mask = ((np.uint16(1) << rem) - 1).astype(np.uint8)
+    partial = np.where(rem > 0, _POPCOUNT[head & mask], 0)
+    return cum[byte] + partial
+
+
+def _as_key_list(keys):
+    return keys if isinstance(keys, list) else [keys]
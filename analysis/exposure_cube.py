@@ -0,0 +1,321 @@
+"""
+All satellite exposure products on one geo-unit x year x dataset cube.
+
+Each product has its own builder, index and years (`multisatpm`,
+`msatna` and `v04NA01` on blocks, `modis` on block groups, and
+`multisatpm_area` on either), so comparing them
+used to mean loading each full panel and joining. Here they're aligned once
+on a common index (blocks or block groups) and `CUBE_YEARS`, the years any
+of them has:
+
+    cube = exposure_cube('block')
+    cube.correlation()                  # dataset x dataset, by year
+    cube.disagreement(2012, limit=12)   # spread across datasets, by block
+
+On disk each dataset is one `.npy` array, its own years (`CUBE_SOURCES`) x
+units in float32, under `Data/mon-coverage/exposure_cube/<geounit>/`, so a
+dataset-year is one contiguous row and the cube is read through memory maps:
+a check across products reads just the rows it uses. A year a dataset doesn't
+have reads as NaN without being stored. A
+dataset's array is built the first time it's asked for, reading its years on
+the I/O pool (`util.prefetch`). A hash of the index it was built on is kept
+next to it (`<dataset>.npy.index`) and the array is rebuilt if the index
+changes; delete the file to rebuild it otherwise.
+
+`v04NA01` is a 3-year mean (`msat_northamer_conus_3year`), not an annual
+value like the other products, so in `correlation` and `disagreement` it's
+smoother than they are and lags real changes. Leave it out (`datasets=`) to
+compare annual products only.
+
+On the block cube, `modis` blocks get their block group's value. On the block
+group cube, block products are population-weighted means over the blocks
+with data. `multisatpm_area` is multisatpm averaged over each polygon by
+area (`geo_exposure.multisatpm_exposure_area_conus`), built on the cube's own
+unit; against `multisatpm` it shows what the centroid merge misses. It's the
+slowest dataset to build the first time, since it intersects every polygon
+with the grid.
+"""
+import hashlib
+import os
+import threading
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from util.cache import load_or_build, build_lock
+from util.env import data_path
+from util.prefetch import prefetch_map, IO_WORKERS
+from util.profiling import profiled
+from util.subset import namespaced
+from analysis.sources import (load_blocks_shape_info, blocks_population,
+                              SATELLITE_YEARS)
+from analysis.geo_exposure import (multisatpm_exposure_block_conus,
+                                   multisatpm_exposure_area_conus,
+                                   modis_exposure_bg_conus_year,
+                                   msatna_v04NA01_exposure_block_conus)
+from analysis.exposure_query import exposure_query
+
+
+CUBE_SOURCES = {
+    'multisatpm': SATELLITE_YEARS,
+    'msatna': SATELLITE_YEARS,
+    'modis': range(2001, 2016),         # As in `modis_exposure_bg_conus`
+    'v04NA01': SATELLITE_YEARS,         # 3-year means, see docstring
+    'multisatpm_area': SATELLITE_YEARS,
+}
+CUBE_YEARS = sorted(set().union(*CUBE_SOURCES.values()))
+CUBE_GEOUNITS = ('block', 'bg')
+# Native unit of each source; None for built on the cube's unit
+SOURCE_GEOUNIT = {'multisatpm': 'block', 'msatna': 'block', 'modis': 'bg',
+                  'v04NA01': 'block', 'multisatpm_area': None}
+
+
+def exposure_cube(geounit: str='block', datasets=None) -> 'ExposureCube':
+    """ The cube for `datasets` (default all), building what's missing """
+    if geounit not in CUBE_GEOUNITS:
+        raise ValueError(f"Invalid geounit: {geounit}")
+    datasets = list(CUBE_SOURCES) if datasets is None else list(datasets)
+    for dataset in datasets:
+        if dataset not in CUBE_SOURCES:
+            raise ValueError(f"Invalid dataset: {dataset}")
+
+    index = cube_index(geounit)
+    arrays = {dataset: cube_array(dataset, geounit, index)
+              for dataset in datasets}
+    return ExposureCube(index, arrays)
+
+
+@load_or_build(data_path('exposure_cube_index_{geounit}.pkl'))
+def cube_index(geounit: str) -> pd.Index:
+    blocks = load_blocks_shape_info().index
+    if geounit == 'block':
+        return pd.Index(blocks.values, name='block_id')
+    elif geounit == 'bg':
+        return pd.Index(np.unique(blocks.astype(str).str[:12]), name='bg_id')
+    else:
+        raise ValueError(f"Invalid geounit: {geounit}")
+
+
+def cube_path(dataset: str, geounit: str) -> str:
+    folder = os.path.dirname(
+        namespaced(data_path('exposure_cube', geounit, f'{dataset}.npy')))
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, f'{dataset}.npy')
+
+
+def cube_array(dataset: str, geounit: str, index: pd.Index) -> np.ndarray:
+    """ Read-only memory map of `dataset`, its years x units """
+    filepath = cube_path(dataset, geounit)
+    key = index_hash(index)
+    if not _is_built(filepath, dataset, index, key):
+        with build_lock(filepath):
+            if not _is_built(filepath, dataset, index, key):
+                build_cube_array(dataset, geounit, index)
+    return np.load(filepath, mmap_mode='r')
+
+
+def index_hash(index: pd.Index) -> str:
+    """ Hash of the unit IDs in `index`, in order """
+    values = pd.util.hash_pandas_object(index, index=False).values
+    h = hashlib.blake2b(digest_size=16)
+    h.update(np.ascontiguousarray(values).tobytes())
+    return h.hexdigest()
+
+
+@profiled
+def build_cube_array(dataset: str, geounit: str, index: pd.Index) -> None:
+    filepath = cube_path(dataset, geounit)
+    print(f"****** Building *******\n\tfile: {filepath}\n"
+          f"\tfunc: build_cube_array\n*************")
+
+    source_unit = SOURCE_GEOUNIT[dataset] or geounit
+    to_index = _aligner(source_unit, geounit, index)
+    years = list(CUBE_SOURCES[dataset])
+
+    tmp_path = f'{filepath}.{os.getpid()}.{threading.get_ident()}.tmp'
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                    shape=(len(years), len(index)))
+    # Years are independent; keep the pool's worth of them loading
+    load = partial(_source_year, dataset, geounit=source_unit)
+    for row, s in enumerate(prefetch_map(load, years, ahead=IO_WORKERS)):
+        out[row] = to_index(s)
+        del s
+    out.flush()
+    del out
+    # Hash last: an array whose hash never got written is rebuilt
+    os.replace(tmp_path, filepath)
+    with open(tmp_path, 'w') as f:
+        f.write(index_hash(index))
+    os.replace(tmp_path, filepath + '.index')
+
+
+def _is_built(filepath, dataset, index, key):
+    if not (os.path.isfile(filepath) and os.path.isfile(filepath + '.index')):
+        return False
+    shape = np.load(filepath, mmap_mode='r').shape
+    if shape != (len(CUBE_SOURCES[dataset]), len(index)):
+        return False
+    with open(filepath + '.index') as f:
+        return f.read() == key
+
+
+def _source_year(dataset: str, year: int, geounit: str=None) -> pd.Series:
+    """
+    `dataset` in `year` on its native unit, see `SOURCE_GEOUNIT`, or on
+    `geounit` for datasets built on any
+    """
+    if dataset == 'multisatpm':
+        return multisatpm_exposure_block_conus(year)['exposure']
+    elif dataset == 'msatna':
+        q = exposure_query('msatna', years=[year]).to_blocks()
+        return q.collect()[year]
+    elif dataset == 'modis':
+        return modis_exposure_bg_conus_year(year).squeeze()
+    elif dataset == 'v04NA01':
+        s = msatna_v04NA01_exposure_block_conus(year)['exposure']
+        # Its rounded merge can match a block to two cells; keep the first
+        return s[~s.index.duplicated()]
+    elif dataset == 'multisatpm_area':
+        return multisatpm_exposure_area_conus(geounit, year)['exposure']
+    else:
+        raise ValueError(f"Invalid dataset: {dataset}")
+
+
+def _aligner(source_unit: str, geounit: str, index: pd.Index):
+    """ Function taking a `source_unit` Series to values on `index` """
+    if source_unit == geounit:
+        return lambda s: s.reindex(index).values
+
+    if (source_unit, geounit) == ('bg', 'block'):
+        bgs = index.astype(str).str[:12]
+        return lambda s: s.reindex(bgs).values
+
+    # Blocks to block groups, population-weighted over blocks with data
+    blocks = load_blocks_shape_info().index
+    pop = blocks_population().reindex(blocks).fillna(0).values
+    codes = index.get_indexer(blocks.astype(str).str[:12])
+
+    def to_bgs(s):
+        exp = s.reindex(blocks).values.astype(float)
+        w = np.where(np.isfinite(exp) & (codes >= 0), pop, 0)
+        keep = w > 0
+        total = np.bincount(codes[keep], weights=(w * exp)[keep],
+                            minlength=len(index))
+        weight = np.bincount(codes[keep], weights=w[keep],
+                             minlength=len(index))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(weight > 0, total / weight, np.nan)
+
+    return to_bgs
+
+
+class ExposureCube(object):
+    """ Aligned datasets; see module docstring """
+
+    def __init__(self, index: pd.Index, arrays: dict):
+        self.index = index
+        self.years = list(CUBE_YEARS)
+        self.datasets = list(arrays)
+        self._arrays = arrays
+
+    def values(self, dataset: str, year: int) -> np.ndarray:
+        """
+        `dataset` in `year` on `index`, a view on the memory map (all NaN if
+        `dataset` doesn't have `year`)
+        """
+        if year not in self.years:
+            raise KeyError(year)
+        years = CUBE_SOURCES[dataset]
+        if year not in years:
+            return np.full(len(self.index), np.nan, dtype=np.float32)
+        return self._arrays[dataset][years.index(year)]
+
+    def get(self, dataset: str, year: int) -> pd.Series:
+        return pd.Series(self.values(dataset, year), index=self.index,
+                         name=year)
+
+    def panel(self, dataset: str) -> pd.DataFrame:
+        """ Units x years, like the per-dataset panels """
+        return pd.DataFrame(self._arrays[dataset].T, index=self.index,
+                            columns=list(CUBE_SOURCES[dataset]))
+
+    def year_frame(self, year: int) -> pd.DataFrame:
+        """ Units x datasets in `year` """
+        return pd.DataFrame({d: self.values(d, year) for d in self.datasets},
+                            index=self.index)
+
+    @profiled
+    def difference(self, a: str, b: str) -> pd.DataFrame:
+        """ `a` minus `b`, units x years they share """
+        years = [y for y in self.years
+                 if y in CUBE_SOURCES[a] and y in CUBE_SOURCES[b]]
+        diff = (self._arrays[a][[CUBE_SOURCES[a].index(y) for y in years]] -
+                self._arrays[b][[CUBE_SOURCES[b].index(y) for y in years]])
+        return pd.DataFrame(diff.T, index=self.index, columns=years)
+
+    @profiled
+    def correlation(self, years=None) -> pd.DataFrame:
+        """
+        Pearson correlation of each pair of datasets across units, over the
+        units both have, by year. Index (year, dataset), columns dataset.
+        """
+        years = self.years if years is None else list(years)
+        out = []
+        for year in years:
+            stack = self._stack(year)
+            corr = np.full((len(self.datasets),) * 2, np.nan)
+            for i in range(len(self.datasets)):
+                for j in range(i, len(self.datasets)):
+                    corr[i, j] = corr[j, i] = _corr(stack[i], stack[j])
+            out.append(pd.DataFrame(corr, index=self.datasets,
+                                    columns=self.datasets))
+        return pd.concat(out, keys=years, names=['year', 'dataset'])
+
+    @profiled
+    def disagreement(self, year: int, limit: float=None) -> pd.DataFrame:
+        """
+        Per unit in `year`: how many datasets have a value (`n`), their
+        `mean`, `range` (max - min) and coefficient of variation (`cv`). With
+        a NAAQS `limit`, `split` is True where some datasets are at or over
+        it and some are under.
+        """
+        stack = self._stack(year)
+        have = np.isfinite(stack)
+        n = have.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(have, stack, 0).sum(axis=0) / n
+            sq = np.where(have, (stack - mean) ** 2, 0).sum(axis=0)
+            cv = np.sqrt(sq / n) / mean
+        df = pd.DataFrame({
+            'n': n,
+            'mean': mean,
+            'range': np.fmax.reduce(stack, axis=0) -
+                     np.fmin.reduce(stack, axis=0),
+            'cv': cv,
+        }, index=self.index)
+        if limit is not None:
+            over = (have & (stack >= limit)).any(axis=0)
+            under = (have & (stack < limit)).any(axis=0)
+            df['split'] = over & under
+        return df
+
+    def _stack(self, year):
+        """ Datasets x units in `year`, float64 """
+        return np.vstack([self.values(d, year) for d in self.datasets]
+                         ).astype(float)
+
+
+def _corr(x, y):
+    keep = np.isfinite(x) & np.isfinite(y)
+    if keep.sum() < 2:
+        return np.nan
+    x = x[keep] - x[keep].mean()
+    y = y[keep] - y[keep].mean()
+    denom = np.sqrt((x * x).sum() * (y * y).sum())
+    return (x * y).sum() / denom if denom > 0 else np.nan
+
+
+if __name__ == '__main__':
+    cube = exposure_cube('block')
+    print(cube.correlation())
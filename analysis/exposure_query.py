@@ -0,0 +1,201 @@
+"""
+Lazy satellite exposure queries.
+
+Builders like `msatna_blocks_3lag_year` used to build the whole grid panel,
+lag every year, merge every block and only then pick one year. A query
+records those steps instead,
+
+    q = exposure_query('msatna').lag3().years([2014]).to_blocks()
+    df = q.collect()
+
+and `collect` plans backwards from the end: it reads only the source years
+the selected (lagged) years need, applies block filters (`where`) to the
+block table before the merge, and drops every grid cell that no kept block
+falls in as soon as each year is read. `q.explain()` shows the plan.
+Add `fill_gaps()` to read gap-filled surfaces instead (`analysis.gap_fill`).
+
+The result is the same as doing each step on the full data.
+"""
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from util.prefetch import prefetch_map
+from util.profiling import profiled
+from analysis.sources import (load_blocks_shape_info, SATELLITE_SURFACES,
+                              SATELLITE_YEARS)
+from analysis.geo_exposure import _xy_to_int_multisat, _int_to_xy_multisat
+
+
+def exposure_query(data: str, years=SATELLITE_YEARS) -> 'ExposureQuery':
+    """ Query on the yearly grid surfaces of `data` for source `years` """
+    if data not in SATELLITE_SURFACES:
+        raise ValueError(f"{data} no good")
+    return ExposureQuery(data, tuple(years))
+
+
+class ExposureQuery(object):
+    """
+    A chain of steps on a (grid cell x year) satellite panel. Each method
+    returns a new query; nothing is read until `collect`.
+    """
+
+    def __init__(self, data, source_years, steps=()):
+        self.data = data
+        self.source_years = source_years
+        self.steps = steps
+
+    def _then(self, *step):
+        return ExposureQuery(self.data, self.source_years,
+                             self.steps + (step,))
+
+    def fill_gaps(self, radius: int=None, method: str='mean'):
+        """ Read gap-filled surfaces (`analysis.gap_fill`), CONUS only """
+        from analysis.gap_fill import GAP_FILL_RADIUS
+        radius = GAP_FILL_RADIUS if radius is None else radius
+        return self._then('fill_gaps', radius, method)
+
+    def lag3(self):
+        """ Mean of the 3 prior years, as in `basic_data.panel_to_3lag` """
+        return self._then('lag3')
+
+    def years(self, years):
+        return self._then('years', tuple(years))
+
+    def to_blocks(self):
+        """ Each block's grid cell value, as in `merge_blocks_msatna` """
+        return self._then('to_blocks')
+
+    def where(self, mask_func, label: str=''):
+        """
+        Keep blocks where `mask_func(block_ids)` is True. Must follow
+        `to_blocks`; it is applied before the merge.
+        """
+        if 'to_blocks' not in [s[0] for s in self.steps]:
+            raise ValueError("`where` filters blocks; call `to_blocks` first")
+        return self._then('where', mask_func, label or mask_func.__name__)
+
+    def explain(self) -> str:
+        plan = self._plan()
+        lines = [f"read {self.data} years {list(plan['read_years'])}"]
+        if plan['fill_gaps'] is not None:
+            lines.append("  gap-filled, radius {} ({})".format(
+                *plan['fill_gaps']))
+        if plan['to_blocks']:
+            filters = ', '.join(plan['filters']) or 'none'
+            lines.append(f"  keep cells of blocks passing: {filters}")
+        lines += [f"  {name} -> years {list(years)}"
+                  for name, years in plan['column_steps']]
+        if plan['to_blocks']:
+            lines.append("  merge onto blocks")
+        return '\n'.join(lines)
+
+    @profiled
+    def collect(self) -> pd.DataFrame:
+        plan = self._plan()
+
+        blocks = None
+        cells = None
+        if plan['to_blocks']:
+            blocks = load_blocks_shape_info()
+            for mask_func in plan['masks']:
+                blocks = blocks[np.asarray(mask_func(blocks.index))]
+            blocks = pd.DataFrame(
+                {'x_int': _xy_to_int_multisat(blocks['x']).values,
+                 'y_int': _xy_to_int_multisat(blocks['y']).values},
+                index=blocks.index)
+            cells = np.unique(_cell_key(blocks['x_int'].values,
+                                        blocks['y_int'].values))
+
+        read_years = plan['read_years']
+        if plan['fill_gaps'] is None:
+            year_func = SATELLITE_SURFACES[self.data]
+        else:
+            from analysis.gap_fill import filled_surface
+            radius, method = plan['fill_gaps']
+            year_func = partial(filled_surface, self.data, radius=radius,
+                                method=method)
+        columns = [_read_cells(year_df, cells) for year_df in
+                   prefetch_map(year_func, read_years)]
+        df = pd.concat(columns, axis=1, keys=read_years)
+        del columns
+
+        for step in plan['column_steps']:
+            if step[0] == 'lag3':
+                df = pd.DataFrame({y: df.loc[:, y - 3:y - 1].mean(axis=1)
+                                   for y in step[1]}, index=df.index)
+            elif step[0] == 'years':
+                df = df[list(step[1])]
+
+        if plan['to_blocks']:
+            df = blocks.join(df, on=['x_int', 'y_int'])
+            df = df.drop(['x_int', 'y_int'], axis=1)
+        else:
+            df.index = pd.MultiIndex.from_arrays(
+                [_int_to_xy_multisat(df.index.get_level_values(c))
+                 for c in ('x_int', 'y_int')], names=['x', 'y'])
+
+        df.columns = df.columns.astype(int)
+
+        return df
+
+    def _plan(self) -> dict:
+        """ Walk the steps backwards to find the source years needed """
+        # Years each step would produce, front to back
+        out_years = [tuple(self.source_years)]
+        for step in self.steps:
+            have = out_years[-1]
+            if step[0] == 'lag3':
+                out_years.append(have[3:] + (max(have) + 1,))
+            elif step[0] == 'years':
+                missing = set(step[1]) - set(have)
+                if missing:
+                    raise KeyError(f"Years not in query: {sorted(missing)}")
+                out_years.append(step[1])
+            else:
+                out_years.append(have)
+
+        # Years each step needs from the one before, back to front
+        need = out_years[-1]
+        column_steps = []
+        for i in range(len(self.steps) - 1, -1, -1):
+            step = self.steps[i]
+            if step[0] == 'lag3':
+                column_steps.append(('lag3', need))
+                have = set(out_years[i])
+                need = tuple(sorted({y - k for y in need for k in (1, 2, 3)
+                                     if y - k in have}))
+            elif step[0] == 'years':
+                column_steps.append(('years', need))
+        column_steps.reverse()
+
+        where = [s for s in self.steps if s[0] == 'where']
+        fills = [s[1:] for s in self.steps if s[0] == 'fill_gaps']
+        return {
+            'fill_gaps': fills[-1] if fills else None,
+            'read_years': need,
+            'column_steps': column_steps,
+            'to_blocks': any(s[0] == 'to_blocks' for s in self.steps),
+            'masks': [s[1] for s in where],
+            'filters': [s[2] for s in where],
+        }
+
+
+def _read_cells(year_df, cells=None) -> pd.Series:
+    """ One year of a surface keyed by integer cell, only `cells` if given """
+    exp = year_df.squeeze()
+    x_int = _xy_to_int_multisat(exp.index.get_level_values('x').values)
+    y_int = _xy_to_int_multisat(exp.index.get_level_values('y').values)
+    values = exp.values
+    if cells is not None:
+        keep = np.isin(_cell_key(x_int, y_int), cells)
+        x_int, y_int, values = x_int[keep], y_int[keep], values[keep]
+    index = pd.MultiIndex.from_arrays([x_int, y_int],
+                                      names=['x_int', 'y_int'])
+    return pd.Series(values, index=index)
+
+
+def _cell_key(x_int, y_int):
+    # y_int is positive and under 10^5 in CONUS
+    return x_int.astype(np.int64) * 100_000 + y_int
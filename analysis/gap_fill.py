@@ -0,0 +1,108 @@
+"""
+Fill missing cells of satellite surfaces from nearby cells.
+
+A block whose 0.01 degree cell has no satellite value (water, borders,
+missing retrievals) gets no exposure from the cell merges. Here each year's
+surface is filled on its dense raster (`analysis.satellite_grid`): a missing
+cell takes the mean of the valid cells within `radius` cells of it (`mean`, a
+masked box filter) or the value of the closest valid cell no more than
+`radius` cells away (`nearest`). Either is one pass over the raster. Cells
+with nothing in range stay missing.
+
+Filled surfaces are cached per year and plug into the block merges through
+`ExposureQuery.fill_gaps`; `blocks_gap_filled` records which blocks got their
+value from a fill.
+"""
+import numpy as np
+import pandas as pd
+
+from util.cache import load_or_build
+from util.env import data_path
+from util.profiling import profiled
+from analysis.sources import load_blocks_shape_info
+from analysis.satellite_grid import satellite_raster
+from analysis.geo_exposure import _xy_to_cell_multisat
+from analysis.zonal import GRID_STEP, GRID_IX0, GRID_IY0, grid_cells
+
+
+GAP_FILL_RADIUS = 3     # cells
+
+
+@load_or_build(data_path(
+    'tmp_satellite_raster_filled_{data}_{year}_{method}{radius}.pkl'))
+def filled_raster(data: str, year: int, radius: int=GAP_FILL_RADIUS,
+                  method: str='mean') -> np.ndarray:
+    """ `satellite_raster(data, year)` with gaps filled (float32) """
+    raster = satellite_raster(data, year)
+    return fill_gaps(raster, radius=radius, method=method)
+
+
+@profiled
+def fill_gaps(raster: np.ndarray, radius: int=GAP_FILL_RADIUS,
+              method: str='mean') -> np.ndarray:
+    """ Copy of 2-D `raster` with NaN cells filled from valid neighbors """
+    from scipy import ndimage
+
+    valid = np.isfinite(raster)
+    out = raster.copy()
+    if valid.all() or not valid.any() or radius < 1:
+        return out
+
+    if method == 'mean':
+        size = 2 * radius + 1
+        # Box means of values and of the mask; their ratio is the mean of
+        # the valid cells in the box
+        total = ndimage.uniform_filter(
+            np.where(valid, raster, 0).astype(np.float64), size=size,
+            mode='constant')
+        share = ndimage.uniform_filter(valid.astype(float), size=size,
+                                       mode='constant')
+        fill = ~valid & (share > .5 / size ** 2)
+        out[fill] = total[fill] / share[fill]
+    elif method == 'nearest':
+        dist, (iy, ix) = ndimage.distance_transform_edt(
+            ~valid, return_indices=True)
+        fill = ~valid & (dist <= radius)
+        out[fill] = raster[iy[fill], ix[fill]]
+    else:
+        raise ValueError(f"Invalid method: {method}")
+
+    return out
+
+
+def filled_surface(data: str, year: int, radius: int=GAP_FILL_RADIUS,
+                   method: str='mean') -> pd.Series:
+    """
+    Filled surface as a Series on cell centers `x`, `y`, like the source
+    loaders (CONUS cells only)
+    """
+    raster = filled_raster(data, year, radius=radius, method=method)
+    iy, ix = np.nonzero(np.isfinite(raster))
+    index = pd.MultiIndex.from_arrays(
+        [(ix + GRID_IX0 + .5) * GRID_STEP, (iy + GRID_IY0 + .5) * GRID_STEP],
+        names=['x', 'y'])
+    return pd.Series(raster[iy, ix].astype(float), index=index, name=year)
+
+
+@load_or_build(data_path(
+    'blocks_gap_filled_{data}_{year}_{method}{radius}.pkl'))
+def blocks_gap_filled(data: str, year: int, radius: int=GAP_FILL_RADIUS,
+                      method: str='mean') -> pd.DataFrame:
+    """
+    Each block's filled exposure in `year` and whether it came from a fill
+    (`filled`), index `block_id`
+    """
+    blocks = load_blocks_shape_info()
+    cells, inside = grid_cells(_xy_to_cell_multisat(blocks['x'].values),
+                               _xy_to_cell_multisat(blocks['y'].values))
+    cells = np.where(inside, cells, 0)
+
+    raw = satellite_raster(data, year).ravel()[cells]
+    filled = filled_raster(data, year, radius=radius, method=method)
+    filled = filled.ravel()[cells]
+
+    df = pd.DataFrame({'exposure': np.where(inside, filled, np.nan),
+                       'filled': inside & ~np.isfinite(raw) &
+                                 np.isfinite(filled)},
+                      index=blocks.index)
+    return df
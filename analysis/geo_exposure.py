@@ -1,18 +1,14 @@
 import numpy as np
 import pandas as pd
-import numexpr as ne
-
-from econtools import load_or_build
-
-from modis.util import annual_mean
-from modis.clean.raw import load_modis_year
-from multisatpm import multisat_conus_year, msat_northamer_conus_3year
-from epa_airpoll import blocks_population
-from epa_airpoll.util import name_to_fips_xwalk
-from epa_airpoll.clean.census.shapefiles import (load_bg_shape,
-                                                 load_blocks_shape_info)
 
+from util.cache import load_or_build
 from util.env import data_path
+from analysis.sources import (load_modis_year, multisat_conus_year,
+                              msat_northamer_conus_3year, blocks_population,
+                              load_blocks_shape_info,
+                              name_to_fips_xwalk, modis_annual_mean)
+from analysis.geometry_store import read_geometries
+from analysis.zonal import zonal_mean, weighted_mean, grid_cells
 
 
 # modis/bg-level
@@ -32,7 +28,7 @@ def modis_exposure_bg_conus():
 
 @load_or_build(data_path('modis_exposure_bg_conus_{}.pkl'), path_args=[0])
 def modis_exposure_bg_conus_year(year):
-    states = sorted(name_to_fips_xwalk.keys())
+    states = sorted(name_to_fips_xwalk().keys())
     modis_data = load_modis_year(year).reset_index()
     state_dfs = [state_modis_exposure_bg(
                  state, year, modis_data=modis_data) for state in states]
@@ -46,24 +42,22 @@ def modis_exposure_bg_conus_year(year):
 
 @load_or_build(data_path('modis_exposure_bg_{}_{}.pkl'), path_args=[0, 1])
 def state_modis_exposure_bg(state, year, modis_data=None):
+    import numexpr as ne
+
     # modis data
     if modis_data is None:
         modis_data = load_modis_year(year).reset_index()
 
-    # census data
-    df = load_bg_shape(name_to_fips_xwalk[state])
+    # census data, bounding boxes only
+    df = read_geometries('bg', name_to_fips_xwalk()[state], geometry=False)
 
     # bounding box
-    bbox = df.bounds
     bound_columns = ['x0', 'y0', 'x1', 'y1']
-    bbox.columns = bound_columns
     xy0 = ['x0', 'y0']
     xy1 = ['x1', 'y1']
     bbox_buffer = 0.05
-    bbox[xy0] = bbox[xy0] - bbox_buffer
-    bbox[xy1] = bbox[xy1] + bbox_buffer
-
-    df = df.join(bbox, how='left')
+    df[xy0] = df[['xmin', 'ymin']].values - bbox_buffer
+    df[xy1] = df[['xmax', 'ymax']].values + bbox_buffer
 
     # condense modis data by state
     state_x0 = df['x0'].min()
@@ -82,6 +76,7 @@ def state_modis_exposure_bg(state, year, modis_data=None):
     state_modis_y = state_modis['y'].values
 
     # identify all modis points in each block group
+    bg_id = df.index
     df = df.reset_index(drop=True)  # make index 0 to N
     mean_modis = np.zeros(len(df))
     for row in df[bound_columns].itertuples():
@@ -90,12 +85,8 @@ def state_modis_exposure_bg(state, year, modis_data=None):
                        f'(state_modis_y > {y0}) & (state_modis_y < {y1})')
         in_bounds = ne.evaluate(ne_equation)
         this_bg_modis = state_modis[in_bounds]
-        mean_modis[i] = annual_mean(this_bg_modis)
+        mean_modis[i] = modis_annual_mean(this_bg_modis)
 
-    bg_id = (df['STATE'].astype(str).str.zfill(2) +
-             df['COUNTY'].astype(str).str.zfill(3) +
-             df['TRACT'].astype(str).str.zfill(6) +
-             df['BLKGRP'].astype(str).str.zfill(1))
     out_df = pd.Series(mean_modis,
                        index=bg_id.values)
 
@@ -105,14 +96,62 @@ def state_modis_exposure_bg(state, year, modis_data=None):
 # multisatpm/block and block-group level
 @load_or_build(data_path('multisatpm_exposure_bg_conus_{year}.pkl'))
 def multisatpm_exposure_bg_conus(year):
-    return _multisat_exposure_guts(year, geounit='bg')
+    """
+    Population-weighted mean, over each block group's blocks, of the
+    multisatpm cell holding the block's centroid. Blocks in cells with no
+    data count as zero.
+    """
+    df = weighted_mean(multisat_conus_year(year), bg_pop_weights(),
+                       rescale=False)
+    df.index.name = 'bg_id'
+    return df.to_frame('exposure')
+
+
+@load_or_build(data_path('multisatpm_exposure_area_{geounit}_{year}.pkl'))
+def multisatpm_exposure_area_conus(geounit: str, year: int) -> pd.DataFrame:
+    """
+    Area-weighted mean of multisatpm over each block or block group polygon
+    (`geounit` 'block' or 'bg'), from true polygon/cell intersections (see
+    `analysis.zonal`), rather than the one cell holding a centroid
+    """
+    df = zonal_mean(multisat_conus_year(year).squeeze(), geounit)
+    return df.to_frame('exposure')
+
+
+@load_or_build(data_path('bg_pop_weights.pkl'))
+def bg_pop_weights() -> dict:
+    """
+    Each block's share of its block group's population, in the grid cell
+    holding its centroid, as sparse (block groups x cells) weights for
+    `zonal.weighted_mean`
+    """
+    from scipy import sparse
+
+    df = load_blocks_shape_info()
+    pop = blocks_population().reindex(df.index).values.astype(float)
+
+    # block_id 15 digits; bg_id 12 digits
+    ids, rows = np.unique(df.index.astype(str).str[0:12],
+                          return_inverse=True)
+    bg_pop = np.bincount(rows, weights=np.nan_to_num(pop))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        share = pop / bg_pop[rows]
+
+    flat, inside = grid_cells(_xy_to_cell_multisat(df['x'].values),
+                              _xy_to_cell_multisat(df['y'].values))
+    keep = inside & np.isfinite(share) & (share != 0)
+    cells, cols = np.unique(flat[keep], return_inverse=True)
+    weights = sparse.csr_matrix((share[keep], (rows[keep], cols)),
+                                shape=(len(ids), len(cells)))
+
+    return {'weights': weights, 'ids': ids, 'cells': cells}
 
 
 @load_or_build(data_path('multisatpm_exposure_block_conus_{year}.pkl'))
 def multisatpm_exposure_block_conus(year):
-    return _multisat_exposure_guts(year, geounit='block')
+    return _multisat_exposure_guts(year)
 
-def _multisat_exposure_guts(year, geounit='block'):
+def _multisat_exposure_guts(year):
     multisatpm = multisat_conus_year(year).reset_index()
     multisatpm = multisatpm.rename(columns={0: 'exposure'})
 
@@ -124,27 +163,6 @@ def _multisat_exposure_guts(year, geounit='block'):
     df = df[['block_id', 'exposure']]
     df = df.set_index('block_id')
 
-    if geounit == 'bg':
-        # weight exposure by population; converge on bg_id
-        pop = blocks_population()
-        df = df.join(pop, how='left')
-
-        # block_id 15 digits; bg_id 12 digits
-        df['bg_id'] = df.index.astype(str).str[0:12]
-
-        bgs_pop = df.groupby('bg_id')['pop'].sum()
-        df = df.join(bgs_pop.to_frame('bgs_pop'), on='bg_id')
-        df['weight'] = df['pop'] / df['bgs_pop']
-        df['exp_weighted'] = df['exposure'] * df['weight']
-
-        df = df.groupby('bg_id')['exp_weighted'].sum().to_frame('exposure')
-
-    elif geounit == 'block':
-        pass
-
-    else:
-        raise ValueError(f'Invalid geounit: {geounit}')
-
     return df
 
 def _coord_trans_and_merge(block_data, multisat_data):
@@ -159,7 +177,11 @@ def _coord_trans_and_merge(block_data, multisat_data):
     return df
 
 def _xy_to_int_multisat(x):
-    return np.floor(x * 100).astype(int) * 10 + 5
+    return _xy_to_cell_multisat(x) * 10 + 5
+
+def _xy_to_cell_multisat(x):
+    """ Integer 0.01 degree cell (floor) holding `x`, as in the block merges """
+    return np.floor(x * 100).astype(int)
 
 def _int_to_xy_multisat(x):
     return x / 1000
@@ -0,0 +1,235 @@
+"""
+Local store of census block and block group shapes.
+
+Each state's shapefile is converted once to GeoParquet: WKB geometry plus
+precomputed county and bounding box (`xmin`, `ymin`, `xmax`, `ymax`) columns,
+sorted by county with one row group per county. Reads are memory-mapped and
+filtered on row group statistics, so a county or bounding box only reads (and
+decodes) the shapes it needs, and work that needs only bounding boxes decodes
+no geometry at all.
+
+Each state's extent goes in a small index, `extents.json`, so a bounding box
+query without a state only builds the stores of states it touches. A state
+that isn't in the index yet is measured from its block group shapefile.
+Bounding boxes here are (xmin, xmax, ymin, ymax), as in `util.subset` and
+`util.conus_bounds`.
+
+Needs `pyarrow`; `geopandas` only to decode geometries.
+"""
+import json
+import os
+import threading
+
+import pandas as pd
+
+from util.cache import build_lock
+from util.env import data_path
+from util.mirror import local_path
+from util.subset import subset
+from util.profiling import profiled
+from analysis.sources import (load_block_shape, load_bg_shape,
+                              name_to_fips_xwalk)
+
+
+BBOX_COLUMNS = ['xmin', 'ymin', 'xmax', 'ymax']
+ID_COLUMNS = {'block': 'block_id', 'bg': 'bg_id'}
+EXTENT_KEYS = ('xmin', 'xmax', 'ymin', 'ymax')
+
+
+def geometry_store_path(geounit: str, state_fips: str) -> str:
+    return data_path('geometry', f'{geounit}_{state_fips}.parquet')
+
+
+def extents_index_path() -> str:
+    return data_path('geometry', 'extents.json')
+
+
+@profiled
+def read_geometries(geounit: str, state_fips: str=None, county: str=None,
+                    bbox: tuple=None, geometry: bool=True) -> pd.DataFrame:
+    """
+    Shapes of `geounit` ('block' or 'bg') in `state_fips`, optionally only in
+    `county` (3-digit FIPS) and/or with bounding boxes meeting `bbox` (xmin,
+    xmax, ymin, ymax). Without `state_fips`, searches every state (`bbox` required).
+
+    Returns a GeoDataFrame indexed by `block_id`/`bg_id` with `county` and
+    bounding box columns, or with `geometry=False` a DataFrame without shapes.
+    """
+    import pyarrow.parquet as pq
+
+    sub = subset()
+    if bbox is None and sub is not None and sub.bbox is not None:
+        bbox = sub.bbox
+
+    if state_fips is None:
+        if bbox is None:
+            raise ValueError("Need `state_fips` or `bbox`")
+        states = [s for s in sorted(name_to_fips_xwalk().values())
+                  if _overlaps(state_extent(s), bbox)]
+        dfs = [read_geometries(geounit, s, county=county, bbox=bbox,
+                               geometry=geometry) for s in states]
+        return pd.concat(dfs)
+
+    path = geometry_store(geounit, state_fips)
+
+    filters = []
+    if county is not None:
+        filters.append(('county', '==', str(county).zfill(3)))
+    if bbox is not None:
+        xmin, xmax, ymin, ymax = bbox
+        filters += [('xmax', '>=', xmin), ('xmin', '<=', xmax),
+                    ('ymax', '>=', ymin), ('ymin', '<=', ymax)]
+    columns = [ID_COLUMNS[geounit], 'county'] + BBOX_COLUMNS
+    if geometry:
+        columns.append('geometry')
+
+    table = pq.read_table(local_path(path), columns=columns,
+                          filters=filters or None, memory_map=True)
+    df = table.to_pandas().set_index(ID_COLUMNS[geounit])
+
+    if geometry:
+        import geopandas as gpd
+        geo = json.loads(table.schema.metadata[b'geo'])
+        geoms = gpd.GeoSeries.from_wkb(df.pop('geometry').values,
+                                       index=df.index,
+                                       crs=geo['columns']['geometry']['crs'])
+        df = gpd.GeoDataFrame(df, geometry=geoms)
+
+    return df
+
+
+def state_extent(state_fips: str) -> tuple:
+    """
+    Bounding box (xmin, xmax, ymin, ymax) of a state's shapes, from the
+    extents index. Blocks nest in block groups, so it's the same for both.
+    """
+    extent = _read_extents().get(state_fips)
+    if extent is None:
+        x0, y0, x1, y1 = load_bg_shape(state_fips).total_bounds
+        extent = _record_extent(state_fips, (x0, x1, y0, y1))
+    return extent
+
+
+def bbox_contains(df: pd.DataFrame, x: float, y: float) -> pd.Series:
+    """ Bool, the bounding box of each row of `df` holds point (x, y) """
+    return ((df['xmin'] <= x) & (df['xmax'] >= x) &
+            (df['ymin'] <= y) & (df['ymax'] >= y))
+
+
+def geometry_store(geounit: str, state_fips: str) -> str:
+    """ Path to a state's store, converting the shapefile if needed """
+    path = geometry_store_path(geounit, state_fips)
+    if not os.path.isfile(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with build_lock(path):
+            # Another thread or process may have built it while we waited
+            if not os.path.isfile(path):
+                build_geometry_store(geounit, state_fips)
+    return path
+
+
+@profiled
+def build_geometry_store(geounit: str, state_fips: str) -> None:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    path = geometry_store_path(geounit, state_fips)
+    print(f"****** Building *******\n\tfile: {path}\n"
+          f"\tfunc: build_geometry_store\n*************")
+
+    shape = _load_shape(geounit, state_fips)
+    df = pd.DataFrame({ID_COLUMNS[geounit]: shape['id'].values,
+                       'county': shape['county'].values})
+    bounds = shape.bounds.values
+    for i, col in enumerate(BBOX_COLUMNS):
+        df[col] = bounds[:, i]
+    df['geometry'] = shape.geometry.to_wkb().values
+    df = df.sort_values('county', kind='stable').reset_index(drop=True)
+
+    crs = shape.crs.to_json_dict() if shape.crs is not None else None
+    extent = (df['xmin'].min(), df['xmax'].max(),
+              df['ymin'].min(), df['ymax'].max())
+    # GeoParquet's bbox is (xmin, ymin, xmax, ymax)
+    geo = {'version': '1.0.0',
+           'primary_column': 'geometry',
+           'columns': {'geometry': {'encoding': 'WKB',
+                                    'geometry_types': [],
+                                    'crs': crs,
+                                    'bbox': [float(extent[i])
+                                             for i in (0, 2, 1, 3)]}}}
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata(
+        dict(table.schema.metadata or {}, geo=json.dumps(geo)))
+
+    # One row group per county, so county and bbox reads skip the rest
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    county_sizes = df.groupby('county', sort=False).size().values
+    with pq.ParquetWriter(tmp_path, table.schema) as writer:
+        start = 0
+        for size in county_sizes:
+            writer.write_table(table.slice(start, size), row_group_size=size)
+            start += size
+    os.replace(tmp_path, path)
+
+    _record_extent(state_fips, extent)
+
+
+def _read_extents() -> dict:
+    """ {state fips: (xmin, xmax, ymin, ymax)} """
+    try:
+        with open(extents_index_path()) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return {}
+    # Entries are named, so the order can't be mixed up; anything else (an
+    # older, unnamed entry) is measured again
+    return {state: tuple(e[k] for k in EXTENT_KEYS)
+            for state, e in index.items() if isinstance(e, dict)}
+
+
+def _record_extent(state_fips, extent) -> tuple:
+    """
+    Add `extent` to the index, merged with what's there, and return the
+    state's extent
+    """
+    path = extents_index_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with build_lock(path):
+        extents = _read_extents()
+        old = extents.get(state_fips, extent)
+        extents[state_fips] = (float(min(old[0], extent[0])),
+                               float(max(old[1], extent[1])),
+                               float(min(old[2], extent[2])),
+                               float(max(old[3], extent[3])))
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({state: dict(zip(EXTENT_KEYS, e))
+                       for state, e in extents.items()},
+                      f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+    return extents[state_fips]
+
+
+def _load_shape(geounit, state_fips):
+    """ Shapefile with `id` and `county` columns in our formats """
+    if geounit == 'block':
+        shape = load_block_shape(state_fips)
+        shape['id'] = shape['GEOID10'].astype(str)
+        shape['county'] = shape['COUNTYFP10'].astype(str).str.zfill(3)
+    elif geounit == 'bg':
+        shape = load_bg_shape(state_fips)
+        shape['id'] = (shape['STATE'].astype(str).str.zfill(2) +
+                       shape['COUNTY'].astype(str).str.zfill(3) +
+                       shape['TRACT'].astype(str).str.zfill(6) +
+                       shape['BLKGRP'].astype(str).str.zfill(1))
+        shape['county'] = shape['COUNTY'].astype(str).str.zfill(3)
+    else:
+        raise ValueError(f"Invalid geounit: {geounit}")
+    return shape
+
+
+def _overlaps(a, b):
+    """ Whether (xmin, xmax, ymin, ymax) boxes `a` and `b` meet """
+    return a[0] <= b[1] and a[1] >= b[0] and a[2] <= b[3] and a[3] >= b[2]
@@ -1,17 +1,38 @@
+import numpy as np
 import pandas as pd
 
-from econtools import load_or_build
-
-from epa_airpoll import nonattainment_block_panel
-
-from util import pmrule_imp_year
+from util import pmrule_imp_year, pm_naaqs_limit
+from util.cache import load_or_build
 from util.env import data_path
+from util.prefetch import gather, prefetch_map
+from util.profiling import profiled
+from analysis.sources import nonattainment_block_panel, blocks_population
+from analysis.block_flags import BlockFlags
 from analysis.basic_data import (prep_multisatpm_3year_wlag_block,
                                  msatna_blocks_3lag_year,
+                                 msatna_blocks_3lag_panel,
                                  block_has_monitor, merge_blocks_pop)
 
 
-def fips_misclass_flag(year: int, rule: str, data: str):
+MISCLASS_YEARS = range(2005, 2017 + 1)
+MISCLASS_RULES = ('pm25_97', 'pm25_06', 'pm25_12')
+MISCLASS_DATA = ('multisatpm', 'msatna')
+
+
+@profiled
+def fips_misclass_flag(year: int, rule: str, data: str,
+                       use_cube: bool=False):
+    """
+    Whether each county outside nonattainment has a block over the NAAQS.
+    From that year's `blocks_misclass_flag`, or with `use_cube` from
+    `misclass_cube` (built first if it isn't cached), which is faster when
+    many years, rules or datasets are queried.
+    """
+    if use_cube:
+        df = misclass_fips_flags(year, rule, data)
+        df = df[df['has_attain']]       # Do NOT want actual non-attains
+        return df[['fips_misclass']]
+
     df = blocks_misclass_flag(year, rule, data)
     df = df[~df['nonattain']]       # Do NOT want actual non-attains
     has_misclass = (df.groupby('fips')['is_over'].max()
@@ -19,20 +40,119 @@ def fips_misclass_flag(year: int, rule: str, data: str):
     return has_misclass
 
 
-@load_or_build(data_path('tmp_blocks_misclass_df_{year}_{rule}_{data}.pkl'))
-def blocks_misclass_flag(year: int, rule: str, data: str) -> pd.DataFrame:
+@profiled
+def misclass_fips_flags(year: int, rule: str, data: str) -> pd.DataFrame:
+    """
+    County flags from `misclass_cube` for counties with blocks in `data`:
+    `has_mon_fips`, `has_nonattain`, `has_over`, `has_attain` (has blocks
+    outside nonattainment) and `fips_misclass` (one of those is over NAAQS).
+    """
+    cube = misclass_cube()
+    key = (year, rule, data)
+    if ('is_over',) + key not in cube:
+        raise KeyError(f"{key} is not in `misclass_cube`")
+
+    sample = cube.bits(('in_sample', data))
+    nonattain = cube.bits(('nonattain', rule)) & sample
+    counts = cube.count_bits({
+        'n_blocks': sample,
+        'has_mon_fips': cube.bits(('has_mon_block', year)) & sample,
+        'has_nonattain': nonattain,
+        'has_over': cube.bits(('is_over',) + key),
+        'has_attain': ~nonattain & sample,
+        'fips_misclass': cube.bits(('misclassed_block',) + key),
+    })
+    counts = counts[counts['n_blocks'] > 0]
+    df = counts.drop('n_blocks', axis=1) > 0
+
+    return df
+
+
+@profiled
+def misclass_fips_cube() -> pd.DataFrame:
+    """ `misclass_fips_flags` for all years, rules and datasets, side by side """
+    cube = {(year, rule, data): misclass_fips_flags(year, rule, data)
+            for year in MISCLASS_YEARS
+            for rule in MISCLASS_RULES
+            for data in MISCLASS_DATA}
+    df = pd.concat(cube, axis=1, names=['year', 'rule', 'data', 'flag'])
+    return df
 
+
+@load_or_build(data_path('tmp_misclass_cube.pkl'))
+def misclass_cube() -> BlockFlags:
+    """
+    Block misclassification flags for every year, rule and dataset, built in
+    one pass that loads each shared input (monitors, nonattainment, exposure
+    panels) once. Same flags as `blocks_misclass_flag`, with layers
+    `('in_sample', data)`, `('has_mon_block', year)`, `('nonattain', rule)`,
+    `('is_over', year, rule, data)` and `('misclassed_block', year, rule,
+    data)`.
+    """
+    cube = BlockFlags(blocks_population().index)
+
+    has_mon = prefetch_map(block_has_monitor, MISCLASS_YEARS)
+    for year, year_has_mon in zip(MISCLASS_YEARS, has_mon):
+        cube.add(('has_mon_block', year), year_has_mon)
+
+    nonattain = {}
+    rule_panels = prefetch_map(nonattainment_block_panel, MISCLASS_RULES)
+    for rule, rule_panel in zip(MISCLASS_RULES, rule_panels):
+        cube.add(('nonattain', rule), rule_panel[pmrule_imp_year[rule]])
+        nonattain[rule] = cube.array(('nonattain', rule))
+
+    exp_panels = prefetch_map(_misclass_exposure_panel, MISCLASS_DATA)
+    for data, exp in zip(MISCLASS_DATA, exp_panels):
+        pos = cube.positions(exp.index)
+        found = pos >= 0
+        cube.add(('in_sample', data), pd.Series(True, index=exp.index))
+        for year in MISCLASS_YEARS:
+            # Missing exposure is never over
+            values = np.full(cube.n, -np.inf)
+            values[pos[found]] = np.nan_to_num(exp[year].values[found],
+                                               nan=-np.inf)
+            for rule in MISCLASS_RULES:
+                is_over = values >= pm_naaqs_limit[rule]
+                cube.add(('is_over', year, rule, data), is_over)
+                cube.add(('misclassed_block', year, rule, data),
+                         is_over & ~nonattain[rule])
+
+    return cube
+
+
+def _misclass_exposure_year(year: int, data: str) -> pd.Series:
+    if data == 'multisatpm':
+        return prep_multisatpm_3year_wlag_block()[year]
+    elif data == 'msatna':
+        return msatna_blocks_3lag_year(year)
+    else:
+        raise ValueError(f"{data} no good")
+
+
+def _misclass_exposure_panel(data: str) -> pd.DataFrame:
     if data == 'multisatpm':
-        df = prep_multisatpm_3year_wlag_block()[year].to_frame('exp')
+        return prep_multisatpm_3year_wlag_block()
     elif data == 'msatna':
-        df = msatna_blocks_3lag_year(year).to_frame('exp')
+        return msatna_blocks_3lag_panel()
     else:
         raise ValueError(f"{data} no good")
 
+
+@load_or_build(data_path('tmp_blocks_misclass_df_{year}_{rule}_{data}.pkl'))
+def blocks_misclass_flag(year: int, rule: str, data: str) -> pd.DataFrame:
+
+    # Independent inputs load concurrently; the merges below then get
+    # population and nonattainment from the memo tier
+    exp, has_mon, __, __ = gather((_misclass_exposure_year, year, data),
+                                  (block_has_monitor, year),
+                                  (blocks_population,),
+                                  (nonattainment_block_panel, rule))
+    df = exp.to_frame('exp')
+
     df['fips'] = df.index.str[:5]
 
     # Merge in has_monitor
-    df = df.join(block_has_monitor(year).to_frame('has_mon_block'))
+    df = df.join(has_mon.to_frame('has_mon_block'))
     df = df.join(
         df.groupby('fips')['has_mon_block'].max() .to_frame('has_mon_fips'),
         on='fips')
@@ -48,8 +168,7 @@ def blocks_misclass_flag(year: int, rule: str, data: str) -> pd.DataFrame:
     df = df.join(fips_nonatt.to_frame('has_nonattain'), on='fips')
 
     # Flag mis-classified
-    naaqs = 12 if rule == 'pm25_12' else 15
-    df['is_over'] = df['exp'] >= naaqs
+    df['is_over'] = df['exp'] >= pm_naaqs_limit[rule]
     has_over = df.groupby('fips')['is_over'].max()
     df = df.join(has_over.to_frame('has_over'), on='fips')
 
@@ -0,0 +1,82 @@
+"""
+Distance from every census block to its nearest active PM2.5 monitor, by year.
+
+Monitor locations go into a KD-tree on the unit sphere (3-D Cartesian
+coordinates), so straight-line nearest neighbors are great-circle nearest
+neighbors and every block is answered in one bulk query per year.
+"""
+import numpy as np
+import pandas as pd
+
+from util.cache import load_or_build
+from util.env import data_path
+from util.profiling import profiled
+from analysis.sources import load_blocks_shape_info, monitors_data
+from analysis.monitor_sample import monitors_summary_panel
+
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+@load_or_build(data_path('tmp_block_nearest_monitor.pkl'))
+def block_nearest_monitor_panel() -> pd.DataFrame:
+    """
+    Blocks by (`km` or `monitor`, year): great-circle distance (float32) to,
+    and ID (categorical) of, the nearest monitor active in `year`.
+    """
+    from scipy.spatial import cKDTree
+
+    blocks = load_blocks_shape_info()
+    block_xyz = _unit_xyz(blocks['x'].values, blocks['y'].values)
+
+    mons = active_monitors()
+    categories = pd.Index(np.sort(mons['monitor_id'].unique()))
+
+    columns = {}
+    for year, year_mons in mons.groupby('year'):
+        tree = cKDTree(_unit_xyz(year_mons['x'].values, year_mons['y'].values))
+        chord, nearest = tree.query(block_xyz, workers=-1)
+        columns[('km', year)] = _chord_to_km(chord).astype(np.float32)
+        codes = categories.get_indexer(year_mons['monitor_id'].values)
+        columns[('monitor', year)] = pd.Categorical.from_codes(
+            codes[nearest], categories=categories)
+
+    df = pd.DataFrame(columns, index=blocks.index)
+    df.columns.names = ['var', 'year']
+
+    return df
+
+
+@profiled
+def active_monitors() -> pd.DataFrame:
+    """ Monitor-years in `monitors_summary_panel` with their coordinates """
+    df = monitors_summary_panel()[['monitor_id', 'year']]
+    coords = (monitors_data()
+              .drop_duplicates('monitor_id')
+              .set_index('monitor_id')[['longitude', 'latitude']]
+              .rename(columns={'longitude': 'x', 'latitude': 'y'}))
+    df = df.join(coords, on='monitor_id')
+    df = df[df['x'].notnull() & df['y'].notnull()]
+
+    return df
+
+
+def block_monitor_distance(year: int) -> pd.Series:
+    """ km from each block to the nearest monitor active in `year` """
+    return block_nearest_monitor_panel()[('km', year)].rename('monitor_km')
+
+
+def blocks_near_monitor(year: int, km: float) -> pd.Series:
+    """ Bool, block is within `km` of a monitor active in `year` """
+    return (block_monitor_distance(year) <= km).rename('near_monitor')
+
+
+def _unit_xyz(lon, lat):
+    lon, lat = np.radians(lon), np.radians(lat)
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon),
+                            np.sin(lat)))
+
+
+def _chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chord / 2, 1))
@@ -1,20 +1,53 @@
+import numpy as np
 import pandas as pd
 
-from econtools import load_or_build
-
-from epa_airpoll import (monitors_annual_summary, monitors_data,
-                         valid_flag_panel, naaqs_assessment_monitors,
-                         nonattainment_block_panel,
-                         )
-
-from util import pmrule_imp_year, MONITOR_MAX_YEAR
+from util import pmrule_imp_year, pm_naaqs_limit, MONITOR_MAX_YEAR
+from util.cache import load_or_build
 from util.env import data_path
+from util.prefetch import gather
+from util.profiling import profiled
+from analysis.sources import (monitors_annual_summary, monitors_data,
+                              valid_flag_panel, naaqs_assessment_monitors,
+                              nonattainment_block_panel,
+                              )
 from analysis.basic_data import monitors_block
+from clean.monitor_daily import monitors_daily_panel
 
 
 CONSTANT_RANGE_DIFF = 2
 
-
+# Annual summary columns we never use
+SUMMARY_DROP_COLUMNS = [
+    'datum', 'parameter_name',
+    'site_number', 'poc', 'units_of_measure',
+    'latitude', 'longitude',
+    'arithmetic_standard_dev',
+    '1st_max_value', '1st_max_datetime',
+    '2nd_max_value', '2nd_max_datetime',
+    '3rd_max_value', '3rd_max_datetime',
+    '4th_max_value', '4th_max_datetime',
+    '1st_max_non_overlapping_value',
+    '1st_no_max_datetime',
+    '2nd_max_non_overlapping_value',
+    '2nd_no_max_datetime',
+    '99th_percentile',
+    '95th_percentile',
+    '90th_percentile',
+    '50th_percentile',
+    '10th_percentile',
+    'local_site_name',
+    'address',
+    'state_name',
+    'county_name',
+    'city_name',
+    'cbsa_name',
+    'date_of_last_change',
+]
+SUMMARY_CATEGORICALS = ['event_type', 'pollutant_standard']
+SUMMARY_CODE_DTYPES = {'state_code': 'int8', 'county_code': 'int16'}
+
+
+@profiled
 def prep_monitor_analysis(df: pd.DataFrame, rule='pm25_12') -> pd.DataFrame:
 
     df = _merge_nonattainment_status(df, rule)
@@ -28,7 +61,7 @@ def prep_monitor_analysis(df: pd.DataFrame, rule='pm25_12') -> pd.DataFrame:
     imp_year = pmrule_imp_year[rule]
     mean_in_year = df.loc[df['year'] == imp_year, 'arithmetic_mean']
     df = df.join(mean_in_year.to_frame('imp_year_mean'))
-    naaqs_limit = _naaqs_limit(rule)
+    naaqs_limit = pm_naaqs_limit[rule]
 
     df['post'] = df['year'] > imp_year
     df['nonattain_post'] = ((df['nonattain']) & (df['post'])).astype(int)
@@ -68,20 +101,15 @@ def _merge_nonattainment_status(df: pd.DataFrame, rule: str) -> pd.DataFrame:
 
 def _merge_regulatory_use_flag(df: pd.DataFrame, rule: str) -> pd.DataFrame:
     test_year = pmrule_imp_year[rule] - 1
-    naaqs = valid_naaqs_monitors(test_year)
     df['used_for_naaqs'] = (df['monitor_id']
-                            .isin(naaqs['monitor_id'].unique()))
-
-    return df
-
-def _naaqs_limit(rule):
-    return 12 if rule == 'pm25_12' else 15
+                            .isin(regulatory_use_monitors(test_year)))
 
     return df
 
-
-def constant_monitor_panel(rule: str='pm25_12') -> pd.DataFrame:
-    df = monitors_summary_panel()
+@profiled
+def constant_monitor_panel(rule: str='pm25_12',
+                           source: str='summary') -> pd.DataFrame:
+    df = monitor_panel(source)
 
     # Define sample period
     imp_year = pmrule_imp_year[rule]
@@ -95,12 +123,14 @@ def constant_monitor_panel(rule: str='pm25_12') -> pd.DataFrame:
 
     return df
 
-def semi_constant_monitor_panel(rule: str='pm25_12') -> pd.DataFrame:
+@profiled
+def semi_constant_monitor_panel(rule: str='pm25_12',
+                                source: str='summary') -> pd.DataFrame:
     """
     Same as `constant_monitor_panel` but includes a few more years before the
     "constant" period where values may be missing.
     """
-    df = monitors_summary_panel()
+    df = monitor_panel(source)
 
     # Define sample period
     imp_year = pmrule_imp_year[rule]
@@ -129,21 +159,36 @@ def _restrict_to_continuous_in_sample(df: pd.DataFrame,
     return df
 
 
+@profiled
 def valid_naaqs_monitors(year: int,
                          lag3: bool=True) -> pd.DataFrame:
+    df = naaqs_candidate_monitors()
+    is_valid = df['monitor_id'].map(_valid_in_year(year, lag3))
+    df = df[is_valid.fillna(False).astype(bool)]
+
+    return df
+
+def regulatory_use_monitors(year: int, lag3: bool=True) -> pd.Index:
+    """ IDs of monitors in `valid_naaqs_monitors(year, lag3)` """
+    ids = naaqs_candidate_monitors()['monitor_id'].unique()
+    valid = _valid_in_year(year, lag3)
+    return valid.index[valid.values].intersection(ids)
+
+def _valid_in_year(year: int, lag3: bool) -> pd.Series:
+    panel = valid_flag_windows(lag3=lag3)
+    if year in panel.columns:
+        return panel[year]
+    return pd.Series(False, index=panel.index)
+
+
+@load_or_build(data_path('tmp_naaqs_candidate_monitors.pkl'))
+def naaqs_candidate_monitors() -> pd.DataFrame:
+    """
+    Primary PM2.5 monitors eligible for NAAQS assessment in any year (before
+    checking validity flags), with site IDs normalized.
+    """
     df = monitors_data()
-    df = df[df['parameter_code'] == 88101]
-    if lag3:
-        valid_in_year = (valid_flag_panel()
-                         .loc[:, year-3:year-1]
-                         .min(axis=1)
-                         .to_frame('is_valid'))
-    else:
-        valid_in_year = (valid_flag_panel()
-                         .loc[:, year]
-                         .to_frame('is_valid'))
-    df = df.join(valid_in_year, on='monitor_id')
-    df = df[df['is_valid'].fillna(False)]
+    df = df[df['parameter_code'] == 88101].copy()
 
     df['fips'] = (df['state_code'].astype(str).str.zfill(2) +
                   df['county_code'].astype(str).str.zfill(3))
@@ -151,7 +196,13 @@ def valid_naaqs_monitors(year: int,
     # Drop monitors as appropriate
     naaqs = naaqs_assessment_monitors()
     naaqs['in_list'] = True
-    df['site_id'] = df['site_id'].apply(_fix_site_id)
+    site = df['site_id'].str.extract(r'^([^_]+)_([^_]+)$')
+    malformed = site[0].isnull()
+    if malformed.any():
+        examples = df.loc[malformed, 'site_id'].head().tolist()
+        raise ValueError(f"{malformed.sum()} site IDs aren't "
+                         f"'<fips>_<site>': {examples}")
+    df['site_id'] = site[0] + site[1].str.zfill(4)
     df = df.join(naaqs.set_index('fips')['in_list'], on='fips')
     wtf = ~((df['in_list']) &
             (~df['site_id'].isin(naaqs['site_id'].tolist())))
@@ -159,62 +210,105 @@ def valid_naaqs_monitors(year: int,
     is_primary = df['naaqs_primary_monitor'] == 'Y'
     df = df[(is_primary) & (wtf)]
 
-    df = df.drop(['in_list', 'is_valid', 'start_date', 'end_date'], axis=1)
+    df = df.drop(['in_list', 'start_date', 'end_date'], axis=1)
 
     return df
 
-def _fix_site_id(x: str) -> str:
-    a, b = x.split('_')
-    return a + b.zfill(4)
 
+@load_or_build(data_path('tmp_valid_flag_windows_{lag3}.pkl'))
+def valid_flag_windows(lag3: bool=True) -> pd.DataFrame:
+    """
+    Bool panel, monitor_id by year. With `lag3`, True if the monitor's
+    validity flags for `year - 3` to `year - 1` are all True (ignoring
+    missing years, but at least one present); otherwise it's the flag for
+    `year` itself. All years come from one pass of cumulative sums.
+    """
+    flags = valid_flag_panel()
+    first, last = min(flags.columns), max(flags.columns)
+    flags = flags.reindex(columns=range(first, last + 1))
+
+    # Running counts of observed and failing flags, by year
+    seen = flags.notnull().values
+    failed = seen & ~flags.fillna(True).astype(bool).values
+    seen_cum = np.zeros((len(flags), seen.shape[1] + 1), dtype=np.int32)
+    failed_cum = np.zeros_like(seen_cum)
+    np.cumsum(seen, axis=1, out=seen_cum[:, 1:])
+    np.cumsum(failed, axis=1, out=failed_cum[:, 1:])
 
-@load_or_build(data_path('tmp_monitor_summ_panel.pkl'))
+    if lag3:
+        years = np.arange(first + 1, last + 4)
+        lo, hi = years - 3, years
+    else:
+        years = np.arange(first, last + 1)
+        lo, hi = years, years + 1
+    # Window edges as positions in the cumulative arrays
+    lo = np.clip(lo - first, 0, seen.shape[1])
+    hi = np.clip(hi - first, 0, seen.shape[1])
+
+    n_seen = seen_cum[:, hi] - seen_cum[:, lo]
+    n_failed = failed_cum[:, hi] - failed_cum[:, lo]
+    out = pd.DataFrame((n_seen > 0) & (n_failed == 0),
+                       index=flags.index, columns=years.tolist())
+
+    return out
+
+
+def monitor_panel(source: str='summary') -> pd.DataFrame:
+    """
+    Monitor-year panel from the EPA annual summaries (`summary`) or built
+    from the daily files (`daily`, see `clean.monitor_daily`)
+    """
+    if source == 'summary':
+        return monitors_summary_panel()
+    elif source == 'daily':
+        return monitors_daily_panel()
+    else:
+        raise ValueError(f"Invalid source: {source}")
+
+
+# Files are named for the trimmed schema (int codes, categoricals) so caches
+# of the old, untrimmed panel aren't picked up
+@load_or_build(data_path('tmp_monitor_summ_trim_panel.pkl'))
 def monitors_summary_panel() -> pd.DataFrame:
-    dfs = [monitors_summary_clean(year)
-           for year in range(2000, MONITOR_MAX_YEAR + 1)]
+    years = range(2000, MONITOR_MAX_YEAR + 1)
+    dfs = gather(*[(monitors_summary_year, year) for year in years])
 
     df = pd.concat(dfs)
     del dfs
 
-    df = df[df['parameter_code'] == 88101]
+    # Per-year categoricals don't share categories, so redo after concat
+    for col in SUMMARY_CATEGORICALS:
+        df[col] = df[col].astype('category')
 
+    assert df.shape == df.drop_duplicates(['year', 'monitor_id']).shape
+
+    return df
+
+
+@load_or_build(data_path('tmp_monitor_summ_trim_{}.pkl'), path_args=[0])
+def monitors_summary_year(year: int) -> pd.DataFrame:
+    """
+    PM2.5 monitors under the 2006 annual standard in `year`, filtered and
+    trimmed as soon as the year is read so only kept rows are held.
+    """
+    df = monitors_summary_clean(year)
+    # Drop what we never use before filtering copies the table. The AQS
+    # columns changed over the years, so not every year has all of them.
+    df = df.drop(SUMMARY_DROP_COLUMNS, axis=1, errors='ignore')
+
+    df = df[(df['parameter_code'] == 88101) &
+            (df['event_type'].isin(('No Events',
+                                    'Concurred Events Excluded'))) &
+            (df['pollutant_standard'] == 'PM25 Annual 2006')]
+    df = df.drop('parameter_code', axis=1)
+
+    for col, dtype in SUMMARY_CODE_DTYPES.items():
+        df[col] = pd.to_numeric(df[col]).astype(dtype)
     df['fips'] = (df['state_code'].astype(str).str.zfill(2) +
                   df['county_code'].astype(str).str.zfill(3))
 
-    df = df.drop(['parameter_code', 'datum', 'parameter_name',
-                  'site_number', 'poc', 'units_of_measure',
-                  'state_code', 'county_code',
-                  'latitude', 'longitude',
-                  'arithmetic_standard_dev',
-                  '1st_max_value', '1st_max_datetime',
-                  '2nd_max_value', '2nd_max_datetime',
-                  '3rd_max_value', '3rd_max_datetime',
-                  '4th_max_value', '4th_max_datetime',
-                  '1st_max_non_overlapping_value',
-                  '1st_no_max_datetime',
-                  '2nd_max_non_overlapping_value',
-                  '2nd_no_max_datetime',
-                  '99th_percentile',
-                  '95th_percentile',
-                  '90th_percentile',
-                  '50th_percentile',
-                  '10th_percentile',
-                  'local_site_name',
-                  'address',
-                  'state_name',
-                  'county_name',
-                  'city_name',
-                  'cbsa_name',
-                  'date_of_last_change'],
-                 axis=1)
-
-    df = df.rename(columns={'latitude': 'y',
-                            'longitude': 'x'})
-
-    df = df[df['event_type'].isin(('No Events', 'Concurred Events Excluded'))]
-    df = df[df['pollutant_standard'] == 'PM25 Annual 2006']
-
-    assert df.shape == df.drop_duplicates(['year', 'monitor_id']).shape
+    for col in SUMMARY_CATEGORICALS:
+        df[col] = df[col].astype('category')
 
     return df
 
@@ -222,10 +316,9 @@ def monitors_summary_panel() -> pd.DataFrame:
 def monitors_summary_clean(year: int) -> pd.DataFrame:
     df = monitors_annual_summary(year)
 
-    try:
-        df = df[df['state_code'] != 'CC']
-    except TypeError:
-        pass
+    # Canadian sites have state code 'CC'; every other code is numeric
+    is_us = pd.to_numeric(df['state_code'], errors='coerce').notnull()
+    df = df[is_us]
 
     return df
 
@@ -0,0 +1,170 @@
+"""
+Misclassification as a function of the NAAQS limit.
+
+For a year, rule and dataset, exposures of blocks in attainment areas are
+sorted once within each state (blocks are already grouped by state in
+`misclass_cube`). Each candidate limit is then a binary search, and the
+misclassified population is a difference of cumulative population sums, so a
+whole curve of limits costs about as much as one.
+
+`threshold_sweeps` keeps those sorted exposures and sums for every year in
+the memo tier, so a long-running process (`serve.py`) answers any limit
+with `misclass_at_threshold`, a binary search per state, without touching
+the block panels again.
+"""
+import numpy as np
+import pandas as pd
+
+from util.cache import memoized
+from util.profiling import profiled
+from analysis.sources import blocks_population
+from analysis.misclass import (misclass_cube, _misclass_exposure_panel,
+                               MISCLASS_YEARS)
+
+
+SWEEP_THRESHOLDS = np.round(np.arange(8, 12 + .05, .1), 1)
+
+
+@profiled
+def misclass_threshold_curve(year: int, rule: str, data: str,
+                             thresholds=SWEEP_THRESHOLDS) -> pd.DataFrame:
+    """
+    Misclassified `pop`, `blocks` and `counties` by state and threshold: blocks
+    outside `rule`'s nonattainment areas with `data` exposure >= threshold,
+    and counties with any such block.
+    """
+    df = misclass_threshold_panel(rule, data, thresholds, years=[year])
+    return df.xs(year, level='year')
+
+
+@profiled
+def misclass_threshold_panel(rule: str, data: str,
+                             thresholds=SWEEP_THRESHOLDS,
+                             years=MISCLASS_YEARS) -> pd.DataFrame:
+    """ `misclass_threshold_curve` for each of `years`, stacked """
+    cube = misclass_cube()
+    thresholds = np.asarray(thresholds, dtype=float)
+
+    dfs = []
+    for year, blocks, counties in _year_sweeps(rule, data, years):
+        block_sums = _sums_at(blocks, thresholds)
+        county_sums = _sums_at(counties, thresholds)
+        dfs.append(_sums_frame(year, cube.states, thresholds, block_sums,
+                               county_sums))
+
+    return pd.concat(dfs)
+
+
+@memoized
+def threshold_sweeps(rule: str, data: str) -> dict:
+    """
+    For each of `MISCLASS_YEARS`, the sorted exposures and cumulative sums
+    of `misclass_threshold_panel`, by state: {year: (blocks, counties)}, each
+    as from `_sorted_sums`. Blocks that can't be misclassified are left out.
+    """
+    return {year: (blocks, counties) for year, blocks, counties
+            in _year_sweeps(rule, data, MISCLASS_YEARS, drop_never=True)}
+
+
+@profiled
+def misclass_at_threshold(year: int, rule: str, data: str,
+                          threshold: float) -> pd.DataFrame:
+    """
+    `misclass_threshold_curve` at one `threshold`, by state, from
+    `threshold_sweeps`
+    """
+    blocks, counties = threshold_sweeps(rule, data)[year]
+    thresholds = np.array([threshold], dtype=float)
+    block_sums = _sums_at(blocks, thresholds)[:, 0]
+    county_sums = _sums_at(counties, thresholds)[:, 0]
+    return pd.DataFrame({
+        'pop': block_sums[:, 0],
+        'blocks': block_sums[:, 1].astype(np.int64),
+        'counties': county_sums[:, 0].astype(np.int64),
+    }, index=pd.Index(misclass_cube().states, name='state'))
+
+
+def _year_sweeps(rule, data, years, drop_never=False):
+    """
+    For each of `years`, (year, blocks, counties) as in `threshold_sweeps`
+    """
+    cube = misclass_cube()
+    attain = cube.array(('in_sample', data)) & ~cube.array(('nonattain', rule))
+    pop = blocks_population().reindex(cube.index).fillna(0).values
+    weights = np.column_stack((pop, np.ones(cube.n)))
+
+    panel = _misclass_exposure_panel(data)
+    pos = cube.positions(panel.index)
+    found = pos >= 0
+
+    # States of each county, for the county sweep
+    county_state = np.searchsorted(cube.state_starts, cube.county_starts,
+                                   side='right') - 1
+    county_state_starts = np.flatnonzero(
+        np.diff(np.append(-1, county_state)))
+
+    for year in years:
+        # Blocks that can't be misclassified never clear a threshold
+        exp = np.full(cube.n, -np.inf)
+        exp[pos[found]] = panel[year].values[found]
+        exp[~attain | np.isnan(exp)] = -np.inf
+
+        county_max = np.maximum.reduceat(exp, cube.county_starts)
+        yield (year,
+               _sorted_sums(exp, weights, cube.state_starts, drop_never),
+               _sorted_sums(county_max, np.ones((len(county_max), 1)),
+                            county_state_starts, drop_never))
+
+
+def _sums_frame(year, states, thresholds, block_sums, county_sums):
+    index = pd.MultiIndex.from_product(
+        [[year], states, thresholds], names=['year', 'state', 'threshold'])
+    return pd.DataFrame({
+        'pop': block_sums[:, :, 0].ravel(),
+        'blocks': block_sums[:, :, 1].ravel().astype(np.int64),
+        'counties': county_sums[:, :, 0].ravel().astype(np.int64),
+    }, index=index)
+
+
+def _sorted_sums(values, weights, group_starts, drop_never=False) -> tuple:
+    """
+    Per group of contiguous rows, `values` sorted and the cumulative sums of
+    `weights` in that order (with a leading row of zeros), packed as
+    (`values`, `cum`, `starts`): group g is `values[starts[g]:starts[g+1]]`
+    and `cum[starts[g] + g:starts[g+1] + g + 1]`. With `drop_never`, -inf
+    values (never over any threshold) are left out.
+    """
+    edges = np.append(group_starts, len(values))
+    vals_out, cum_out, sizes = [], [], []
+    for start, end in zip(edges[:-1], edges[1:]):
+        vals, w = values[start:end], weights[start:end]
+        if drop_never:
+            keep = vals > -np.inf
+            vals, w = vals[keep], w[keep]
+        order = np.argsort(vals, kind='stable')
+        cum = np.zeros((len(vals) + 1, weights.shape[1]))
+        np.cumsum(w[order], axis=0, out=cum[1:])
+        vals_out.append(vals[order])
+        cum_out.append(cum)
+        sizes.append(len(vals))
+    starts = np.append(0, np.cumsum(sizes))
+    return np.concatenate(vals_out), np.concatenate(cum_out), starts
+
+
+def _sums_at(sorted_sums, thresholds):
+    """
+    Sum of weights with values >= each threshold, per group of
+    `_sorted_sums`. Returns groups x thresholds x weight columns.
+    """
+    values, cum, starts = sorted_sums
+    out = np.zeros((len(starts) - 1, len(thresholds), cum.shape[1]))
+    for g in range(len(starts) - 1):
+        vals = values[starts[g]:starts[g + 1]]
+        group_cum = cum[starts[g] + g:starts[g + 1] + g + 1]
+        first_over = np.searchsorted(vals, thresholds)
+        out[g] = group_cum[-1] - group_cum[first_over]
+    return out
+
+
+if __name__ == '__main__':
+    df = misclass_threshold_curve(2015, 'pm25_12', 'msatna')
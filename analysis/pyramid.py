@@ -0,0 +1,176 @@
+"""
+Coarse-resolution exposure rasters for maps and regional summaries.
+
+For each satellite dataset and year, `exposure_pyramid(data, year, factor)`
+is the 0.01 degree surface (`analysis.satellite_grid`) aggregated to cells
+`factor` times larger, over `conus_bounds` (the top rows are padded so every
+level tiles the grid). Each level holds, per cell,
+
+    pop             block population in cells with data
+    pop_weighted    population-weighted mean exposure
+    area            area with data, in 0.01 degree cells at the equator
+    area_weighted   area-weighted mean exposure
+
+Each level is built from the next finer one, so the whole pyramid costs about
+one pass over the base raster, and levels are cached separately, so a
+national map reads kilobytes to a few megabytes. `pyramid_factor` picks the
+level for a map of a given size. `regional_exposure` gives the mean over a
+bounding box.
+"""
+import numpy as np
+
+from util import conus_bounds
+from util.cache import load_or_build
+from util.env import data_path
+from util.profiling import profiled
+from analysis.sources import (load_blocks_shape_info, blocks_population,
+                              SATELLITE_SURFACES, SATELLITE_YEARS)
+from analysis.satellite_grid import satellite_raster
+from analysis.geo_exposure import _xy_to_cell_multisat
+from analysis.zonal import GRID_STEP, GRID_NX, GRID_NY, grid_cells
+
+
+PYRAMID_FACTORS = (5, 10, 50, 100)      # 0.05, 0.1, 0.5 and 1 degree
+PYRAMID_NY = -(-GRID_NY // PYRAMID_FACTORS[-1]) * PYRAMID_FACTORS[-1]
+PYRAMID_WEIGHTS = ('pop', 'area')
+
+
+@load_or_build(data_path('exposure_pyramid_{data}_{year}_{factor}.pkl'))
+def exposure_pyramid(data: str, year: int, factor: int) -> dict:
+    """ Level `factor` of the pyramid; see module docstring """
+    if factor not in PYRAMID_FACTORS:
+        raise ValueError(f"factor must be one of {PYRAMID_FACTORS}")
+    i = PYRAMID_FACTORS.index(factor)
+    if i == 0:
+        sums = _base_sums(data, year)
+        ratio = factor
+    else:
+        finer = PYRAMID_FACTORS[i - 1]
+        sums = _level_sums(exposure_pyramid(data, year, finer))
+        ratio = factor // finer
+
+    sums = {k: _block_sum(v, ratio) for k, v in sums.items()}
+    level = {'factor': factor, 'step': factor * GRID_STEP,
+             'x0': conus_bounds[0], 'y0': conus_bounds[2]}
+    for w in PYRAMID_WEIGHTS:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(sums[w] > 0, sums[w + '_exp'] / sums[w], np.nan)
+        level[w] = sums[w].astype(np.float32)
+        level[w + '_weighted'] = mean.astype(np.float32)
+
+    return level
+
+
+def build_exposure_pyramids(datas=None, years=SATELLITE_YEARS):
+    """ Every level for every dataset and year """
+    datas = list(SATELLITE_SURFACES) if datas is None else datas
+    for data in datas:
+        for year in years:
+            for factor in PYRAMID_FACTORS:
+                exposure_pyramid(data, year, factor, _load=False)
+
+
+def pyramid_factor(bbox=None, max_cells: int=1_000_000) -> int:
+    """
+    Finest level with at most `max_cells` cells over `bbox` (xmin, xmax,
+    ymin, ymax; default CONUS)
+    """
+    xmin, xmax, ymin, ymax = conus_bounds if bbox is None else bbox
+    for factor in PYRAMID_FACTORS:
+        step = factor * GRID_STEP
+        if (xmax - xmin) / step * (ymax - ymin) / step <= max_cells:
+            return factor
+    return PYRAMID_FACTORS[-1]
+
+
+def level_window(level: dict, bbox=None):
+    """
+    (rows, cols) slices of `level` covering `bbox` and the bbox they span,
+    for plotting
+    """
+    xmin, xmax, ymin, ymax = conus_bounds if bbox is None else bbox
+    step, x0, y0 = level['step'], level['x0'], level['y0']
+    ny, nx = level['pop'].shape
+    c0 = int(np.clip(np.floor((xmin - x0) / step), 0, nx))
+    c1 = int(np.clip(np.ceil((xmax - x0) / step), 0, nx))
+    r0 = int(np.clip(np.floor((ymin - y0) / step), 0, ny))
+    r1 = int(np.clip(np.ceil((ymax - y0) / step), 0, ny))
+    extent = (x0 + c0 * step, x0 + c1 * step, y0 + r0 * step, y0 + r1 * step)
+    return (slice(r0, r1), slice(c0, c1)), extent
+
+
+@profiled
+def regional_exposure(data: str, year: int, bbox, weight: str='pop',
+                      factor: int=None) -> float:
+    """
+    `weight`-weighted mean exposure over cells whose centers are in `bbox`
+    (xmin, xmax, ymin, ymax), from level `factor` (default the finest with
+    at most a million cells over `bbox`)
+    """
+    if weight not in PYRAMID_WEIGHTS:
+        raise ValueError(f"weight must be one of {PYRAMID_WEIGHTS}")
+    factor = pyramid_factor(bbox) if factor is None else factor
+    level = exposure_pyramid(data, year, factor)
+
+    xmin, xmax, ymin, ymax = bbox
+    step = level['step']
+    ny, nx = level['pop'].shape
+    xc = level['x0'] + (np.arange(nx) + .5) * step
+    yc = level['y0'] + (np.arange(ny) + .5) * step
+    rows = (yc >= ymin) & (yc <= ymax)
+    cols = (xc >= xmin) & (xc <= xmax)
+
+    w = level[weight][np.ix_(rows, cols)].astype(float)
+    mean = level[weight + '_weighted'][np.ix_(rows, cols)].astype(float)
+    have = w > 0
+    if not have.any():
+        return np.nan
+    return float((w[have] * mean[have]).sum() / w[have].sum())
+
+
+def _base_sums(data, year):
+    """ Weights and weighted exposure on the 0.01 degree grid, padded """
+    raster = satellite_raster(data, year).astype(float)
+    have = np.isfinite(raster)
+    exp = np.where(have, raster, 0)
+
+    pop = np.where(have, cell_population(), 0)
+    area = np.where(have, _cell_area()[:, None], 0)
+
+    pad = ((0, PYRAMID_NY - GRID_NY), (0, 0))
+    return {name: np.pad(a, pad) for name, a in (
+        ('pop', pop), ('pop_exp', pop * exp),
+        ('area', area), ('area_exp', area * exp))}
+
+
+def _level_sums(level):
+    sums = {}
+    for w in PYRAMID_WEIGHTS:
+        weight = level[w].astype(float)
+        mean = np.nan_to_num(level[w + '_weighted'].astype(float))
+        sums[w] = weight
+        sums[w + '_exp'] = weight * mean
+    return sums
+
+
+def _block_sum(a, ratio):
+    ny, nx = a.shape
+    return a.reshape(ny // ratio, ratio, nx // ratio, ratio).sum(axis=(1, 3))
+
+
+@load_or_build(data_path('tmp_cell_population.pkl'))
+def cell_population() -> np.ndarray:
+    """ Block population summed by 0.01 degree grid cell, dense (y, x) """
+    blocks = load_blocks_shape_info()
+    pop = blocks_population().reindex(blocks.index).fillna(0).values
+    cells, inside = grid_cells(_xy_to_cell_multisat(blocks['x'].values),
+                               _xy_to_cell_multisat(blocks['y'].values))
+    out = np.bincount(cells[inside], weights=pop[inside],
+                      minlength=GRID_NY * GRID_NX)
+    return out.astype(np.float32).reshape(GRID_NY, GRID_NX)
+
+
+def _cell_area():
+    """ Area of each grid row's cells relative to a cell at the equator """
+    lat = conus_bounds[2] + (np.arange(GRID_NY) + .5) * GRID_STEP
+    return np.cos(np.radians(lat))
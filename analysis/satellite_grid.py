@@ -0,0 +1,165 @@
+"""
+Satellite PM2.5 at arbitrary points.
+
+Each year of a satellite surface is stored once as a dense CONUS raster on the
+0.01 degree grid of `analysis.zonal`, so looking up any number of points is
+array indexing rather than a merge. `point_exposure` returns, for arrays of
+lon/lat, either the value of the cell holding each point (`nearest`, which
+matches the block-level merges in `analysis.basic_data`) or a bilinear
+interpolation between the four nearest cell centers.
+
+`monitor_satellite_comparison` uses it to set every monitor's annual mean
+beside the satellite estimate at the monitor, for every year.
+"""
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from util.cache import load_or_build
+from util.env import data_path
+from util.prefetch import prefetch_map
+from util.profiling import profiled
+from analysis.sources import (SATELLITE_SURFACES, SATELLITE_YEARS,
+                              monitors_data)
+from analysis.zonal import GRID_STEP, GRID_NX, GRID_NY, grid_cells
+from analysis.geo_exposure import _xy_to_cell_multisat
+from analysis.monitor_sample import monitors_summary_panel
+
+
+@profiled
+def point_exposure(lon, lat, years=SATELLITE_YEARS, data: str='msatna',
+                   method: str='bilinear') -> pd.DataFrame:
+    """
+    Satellite PM2.5 at points (`lon`, `lat`) for each of `years`, as a
+    (points x years) DataFrame. Points off the grid, or whose cells are all
+    missing, are NaN.
+    """
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    years = [years] if np.isscalar(years) else list(years)
+
+    if method == 'nearest':
+        lookup = _nearest_lookup(lon, lat)
+    elif method == 'bilinear':
+        lookup = _bilinear_lookup(lon, lat)
+    else:
+        raise ValueError(f"Invalid method: {method}")
+
+    out = np.empty((len(lon), len(years)))
+    rasters = prefetch_map(partial(satellite_raster, data), years)
+    for j, raster in enumerate(rasters):
+        out[:, j] = _interpolate(raster.ravel(), *lookup)
+
+    return pd.DataFrame(out, columns=pd.Index(years, name='year'))
+
+
+@load_or_build(data_path('tmp_satellite_raster_{data}_{year}.pkl'))
+def satellite_raster(data: str, year: int) -> np.ndarray:
+    """ Dense (y, x) float32 raster of a satellite surface, NaN off-data """
+    exp = SATELLITE_SURFACES[data](year).squeeze()
+    x = exp.index.get_level_values('x').values
+    y = exp.index.get_level_values('y').values
+    cells, inside = grid_cells(_xy_to_cell_multisat(x),
+                               _xy_to_cell_multisat(y))
+
+    raster = np.full(GRID_NY * GRID_NX, np.nan, dtype=np.float32)
+    raster[cells[inside]] = exp.values[inside]
+
+    return raster.reshape(GRID_NY, GRID_NX)
+
+
+def _nearest_lookup(lon, lat):
+    """ Grid position of the cell holding each point, weight 1 """
+    # Same cells as the block merges (`geo_exposure._xy_to_int_multisat`)
+    cells, inside = grid_cells(_xy_to_cell_multisat(_nan_far(lon)),
+                               _xy_to_cell_multisat(_nan_far(lat)))
+    cells = np.where(inside, cells, 0)[:, None]
+    weights = inside.astype(float)[:, None]
+    return cells, weights
+
+
+def _bilinear_lookup(lon, lat):
+    """ Grid positions and weights of the 4 cell centers around each point """
+    # Position in units of cells, relative to the centers
+    fx = lon / GRID_STEP - .5
+    fy = lat / GRID_STEP - .5
+    ix0 = np.floor(_nan_far(fx)).astype(np.int64)
+    iy0 = np.floor(_nan_far(fy)).astype(np.int64)
+    tx = fx - ix0
+    ty = fy - iy0
+
+    cells, weights = [], []
+    for dx, dy, w in ((0, 0, (1 - tx) * (1 - ty)), (1, 0, tx * (1 - ty)),
+                      (0, 1, (1 - tx) * ty), (1, 1, tx * ty)):
+        c, inside = grid_cells(ix0 + dx, iy0 + dy)
+        cells.append(np.where(inside, c, 0))
+        weights.append(np.where(inside, w, 0))
+
+    return np.column_stack(cells), np.column_stack(weights)
+
+
+def _interpolate(flat_raster, cells, weights):
+    """
+    Weighted mean of raster cells per point (rows of `cells`), leaving out
+    missing cells and rescaling the weights of the rest.
+    """
+    vals = flat_raster[cells].astype(float)
+    have = np.isfinite(vals) & (weights > 0)
+    w = np.where(have, weights, 0)
+    total = (np.where(have, vals, 0) * w).sum(axis=1)
+    covered = w.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(covered > 0, total / covered, np.nan)
+
+
+def _nan_far(a):
+    # NaN coordinates map to a far-off cell, so they come out missing
+    return np.nan_to_num(a, nan=-1e7)
+
+
+@profiled
+def monitor_satellite_comparison(data: str='msatna',
+                                 method: str='bilinear') -> pd.DataFrame:
+    """
+    Monitor annual means beside the satellite estimate at the monitor, one
+    row per monitor-year (years with satellite data only).
+    """
+    df = monitors_summary_panel()[['monitor_id', 'year', 'arithmetic_mean']]
+    df = df[df['year'].isin(SATELLITE_YEARS)]
+
+    sites = (monitors_data()
+             .drop_duplicates('monitor_id')
+             .set_index('monitor_id')[['longitude', 'latitude']])
+    sites = sites.reindex(df['monitor_id'].unique())
+
+    years = sorted(df['year'].unique())
+    sat = point_exposure(sites['longitude'].values, sites['latitude'].values,
+                         years=years, data=data, method=method)
+    sat.index = sites.index
+    sat = sat.stack().rename('satellite')
+
+    df = df.join(sat, on=['monitor_id', 'year'])
+    df = df.rename(columns={'arithmetic_mean': 'monitor'})
+    df['diff'] = df['satellite'] - df['monitor']
+
+    return df.reset_index(drop=True)
+
+
+def comparison_stats(df: pd.DataFrame, by='year') -> pd.DataFrame:
+    """ N, mean bias, RMSE and correlation of `monitor_satellite_comparison` """
+    df = df.dropna(subset=['monitor', 'satellite'])
+    grouped = df.groupby(by)
+    out = pd.DataFrame({
+        'N': grouped.size(),
+        'bias': grouped['diff'].mean(),
+        'rmse': np.sqrt((df['diff'] ** 2).groupby(df[by]).mean()),
+        'corr': grouped[['monitor', 'satellite']].apply(
+            lambda g: g['monitor'].corr(g['satellite'])),
+    })
+    return out
+
+
+if __name__ == '__main__':
+    df = monitor_satellite_comparison()
+    print(comparison_stats(df))
@@ -0,0 +1,185 @@
+"""
+External data loaders (`epa_airpoll`, `multisatpm`, `modis`) used by
+`analysis`, wrapped so each load shows up as a profiling stage.
+
+The packages are imported on first call, so importing `analysis` (and running
+off the disk cache) doesn't pay for them. Census and monitor tables, which
+many builders reload, are memoized in-process (see `util.cache`).
+
+Under a state or bounding-box subset (`util.subset`) every loader here keeps
+only what is in the subset.
+"""
+from util.cache import memoized
+from util.profiling import profiled
+from util.subset import subset, in_bbox
+
+
+SUBSET_SAT_BUFFER = .05     # degrees of satellite grid kept around states
+
+
+# Census
+@memoized
+def load_blocks_shape_info():
+    from epa_airpoll import load_blocks_shape_info
+    df = load_blocks_shape_info()
+    sub = subset()
+    if sub is not None and sub.states is not None:
+        df = df[_block_states(df.index).isin(sub.states)]
+    elif sub is not None:
+        df = df[in_bbox(df['x'], df['y'], sub.bbox)]
+    return df
+
+
+@profiled
+def load_block_shape(state_fips):
+    from epa_airpoll import load_block_shape
+    return load_block_shape(state_fips)
+
+
+@profiled
+def load_bg_shape(state_fips):
+    from epa_airpoll.clean.census.shapefiles import load_bg_shape
+    return load_bg_shape(state_fips)
+
+
+@memoized
+def blocks_population():
+    from epa_airpoll import blocks_population
+    return _subset_blocks(blocks_population())
+
+
+def name_to_fips_xwalk() -> dict:
+    from epa_airpoll.util import name_to_fips_xwalk
+    if subset() is None:
+        return name_to_fips_xwalk
+    states = subset_states()
+    return {name: fips for name, fips in name_to_fips_xwalk.items()
+            if fips in states}
+
+
+# Monitors and regulation
+@profiled
+def monitors_annual_summary(year):
+    from epa_airpoll import monitors_annual_summary
+    return _subset_monitors(monitors_annual_summary(year))
+
+
+@memoized
+def monitors_data():
+    from epa_airpoll import monitors_data
+    return _subset_monitors(monitors_data())
+
+
+@memoized
+def valid_flag_panel():
+    from epa_airpoll import valid_flag_panel
+    return valid_flag_panel()
+
+
+@memoized
+def naaqs_assessment_monitors():
+    from epa_airpoll import naaqs_assessment_monitors
+    return naaqs_assessment_monitors()
+
+
+@memoized
+def nonattainment_block_panel(rule):
+    from epa_airpoll import nonattainment_block_panel
+    return _subset_blocks(nonattainment_block_panel(rule))
+
+
+# Satellites
+@profiled
+def multisat_conus_year(year):
+    from multisatpm import multisat_conus_year
+    return _subset_grid(multisat_conus_year(year))
+
+
+@profiled
+def msat_northamer_1year(year):
+    from multisatpm import msat_northamer_1year
+    return _subset_grid(msat_northamer_1year(year))
+
+
+@profiled
+def msat_northamer_conus_3year(year):
+    from multisatpm import msat_northamer_conus_3year
+    return _subset_grid(msat_northamer_conus_3year(year))
+
+
+@profiled
+def load_modis_year(year):
+    from modis.clean.raw import load_modis_year
+    return _subset_grid(load_modis_year(year))
+
+
+def modis_annual_mean(df):
+    from modis.util import annual_mean
+    return annual_mean(df)
+
+
+# Yearly 0.01 degree grid surfaces, by name, and their years
+SATELLITE_SURFACES = {
+    'msatna': msat_northamer_1year,
+    'multisatpm': multisat_conus_year,
+}
+SATELLITE_YEARS = range(2002, 2016 + 1)
+
+
+# Subsets
+@memoized
+def subset_states() -> tuple:
+    """ State fips in the subset (for a bbox, states with blocks in it) """
+    sub = subset()
+    if sub.states is not None:
+        return sub.states
+    return tuple(sorted(_block_states(load_blocks_shape_info().index)
+                        .unique()))
+
+
+@memoized
+def subset_bbox() -> tuple:
+    """ (xmin, xmax, ymin, ymax) of the subset; for states, their blocks' """
+    sub = subset()
+    if sub.bbox is not None:
+        return sub.bbox
+    df = load_blocks_shape_info()
+    pad = SUBSET_SAT_BUFFER
+    return (df['x'].min() - pad, df['x'].max() + pad,
+            df['y'].min() - pad, df['y'].max() + pad)
+
+
+def _block_states(block_ids):
+    return block_ids.astype(str).str[:2]
+
+
+def _subset_blocks(df):
+    """ Rows of a block-indexed frame in the subset """
+    sub = subset()
+    if sub is None:
+        return df
+    elif sub.states is not None:
+        return df[_block_states(df.index).isin(sub.states)]
+    return df[df.index.isin(load_blocks_shape_info().index)]
+
+
+def _subset_monitors(df):
+    sub = subset()
+    if sub is None:
+        return df
+    elif sub.states is not None:
+        state = df['state_code'].astype(str).str.zfill(2)
+        return df[state.isin(sub.states)]
+    return df[in_bbox(df['longitude'], df['latitude'], sub.bbox)]
+
+
+def _subset_grid(df):
+    """ Cells of a satellite surface (x, y in index or columns) in the subset """
+    if subset() is None:
+        return df
+    if 'x' in (df.index.names or []):
+        x = df.index.get_level_values('x')
+        y = df.index.get_level_values('y')
+    else:
+        x, y = df['x'], df['y']
+    return df[in_bbox(x, y, subset_bbox())]
@@ -0,0 +1,165 @@
+"""
+Zonal means of the 0.01 degree satellite grid over census polygons.
+
+For each state and geography (blocks or block groups) we compute once, from
+true polygon/cell intersections, a sparse matrix of weights: the share of each
+polygon's area that falls in each grid cell. The area-weighted mean of any
+grid surface over every polygon is then a sparse mat-vec, and a whole panel
+of years is one sparse-dense product, so all years together cost about as
+much as building the weights.
+
+Cells where a surface is missing are left out and the remaining weights
+rescaled, so a polygon is missing only if none of its cells have data.
+
+`geo_exposure.multisatpm_exposure_area_conus` builds area-weighted block and
+block group exposure with `zonal_mean` (the `multisatpm_area` dataset of
+`analysis.exposure_cube`). `weighted_mean` applies any weights in the same
+layout; population-weighted block group exposure
+(`geo_exposure.multisatpm_exposure_bg_conus`) uses it with weights of block
+centroids.
+"""
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from util import conus_bounds
+from util.cache import load_or_build
+from util.env import data_path
+from util.prefetch import prefetch_map
+from util.profiling import profiled
+from analysis.sources import name_to_fips_xwalk
+from analysis.geometry_store import read_geometries
+
+
+GRID_STEP = .01     # Cell edges at multiples; see `_xy_to_int_multisat`
+GRID_IX0 = int(np.floor(conus_bounds[0] / GRID_STEP))
+GRID_IY0 = int(np.floor(conus_bounds[2] / GRID_STEP))
+GRID_NX = int(round((conus_bounds[1] - conus_bounds[0]) / GRID_STEP))
+GRID_NY = int(round((conus_bounds[3] - conus_bounds[2]) / GRID_STEP))
+
+PAIRS_PER_CHUNK = 2_000_000     # polygon-cell intersections per shapely call
+
+
+@profiled
+def zonal_mean(values, geounit: str='bg', states=None):
+    """
+    Area-weighted mean of grid `values` (Series or DataFrame indexed by cell
+    center `x`, `y`) over every `geounit` polygon in `states` (default all).
+    Returns the same type, indexed by `block_id` or `bg_id`.
+    """
+    if states is None:
+        states = sorted(name_to_fips_xwalk().values())
+
+    state_weights = prefetch_map(partial(zonal_weights, geounit), states)
+    surface = _GridSurface(values)
+    df = pd.concat([surface.mean(w) for w in state_weights])
+    df.index.name = 'block_id' if geounit == 'block' else 'bg_id'
+
+    return surface.same_type(df)
+
+
+@profiled
+def weighted_mean(values, weights: dict, rescale: bool=True):
+    """
+    Mean of grid `values` (as in `zonal_mean`) with `weights` in the layout
+    of `zonal_weights`, one row per `weights['ids']`. Without `rescale`,
+    missing cells count as zero instead of being left out.
+    """
+    surface = _GridSurface(values)
+    return surface.same_type(surface.mean(weights, rescale=rescale))
+
+
+class _GridSurface(object):
+    """ Grid values sorted by flat grid position, for lookup by cell """
+
+    def __init__(self, values):
+        self.is_series = isinstance(values, pd.Series)
+        frame = values.to_frame() if self.is_series else values
+        self.columns = frame.columns
+
+        x = frame.index.get_level_values('x').values
+        y = frame.index.get_level_values('y').values
+        keys, inside = grid_cells(np.floor(x / GRID_STEP).astype(np.int64),
+                                  np.floor(y / GRID_STEP).astype(np.int64))
+        order = np.argsort(keys[inside], kind='stable')
+        self.keys = keys[inside][order]
+        self.values = frame.values[inside][order].astype(float)
+
+    def mean(self, w, rescale=True) -> pd.DataFrame:
+        pos = np.searchsorted(self.keys, w['cells'])
+        found = pos < len(self.keys)
+        found[found] = self.keys[pos[found]] == w['cells'][found]
+        grid = np.full((len(pos), self.values.shape[1]), np.nan)
+        grid[found] = self.values[pos[found]]
+        have = np.isfinite(grid)
+        mean = w['weights'] @ np.where(have, grid, 0)
+        if rescale:
+            covered = w['weights'] @ have.astype(float)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = mean / covered
+        return pd.DataFrame(mean, index=w['ids'], columns=self.columns)
+
+    def same_type(self, df):
+        return df.iloc[:, 0] if self.is_series else df
+
+
+def grid_cells(ix, iy):
+    """ Flat CONUS grid position of integer cells; and which are inside """
+    ix, iy = ix - GRID_IX0, iy - GRID_IY0
+    inside = (ix >= 0) & (ix < GRID_NX) & (iy >= 0) & (iy < GRID_NY)
+    return iy * GRID_NX + ix, inside
+
+
+@load_or_build(data_path('zonal_weights_{geounit}_{state_fips}.pkl'))
+def zonal_weights(geounit: str, state_fips: str) -> dict:
+    """
+    Sparse (polygons x cells) share of each polygon's area in each grid cell,
+    as a dict: `weights` (scipy CSR), `ids` (row labels) and `cells` (flat
+    CONUS grid position of each column).
+    """
+    import shapely
+    from scipy import sparse
+
+    gdf = read_geometries(geounit, state_fips)
+    if gdf.empty:
+        # e.g., nothing of this state is in the subset
+        return {'weights': sparse.csr_matrix((0, 0)), 'ids': gdf.index.values,
+                'cells': np.empty(0, dtype=np.int64)}
+    geoms = np.asarray(gdf.geometry.array)
+    poly_area = shapely.area(geoms)
+
+    # Every cell overlapping each polygon's bounding box is a candidate
+    ix0 = np.floor(gdf['xmin'].values / GRID_STEP).astype(np.int64)
+    iy0 = np.floor(gdf['ymin'].values / GRID_STEP).astype(np.int64)
+    nx = np.floor(gdf['xmax'].values / GRID_STEP).astype(np.int64) - ix0 + 1
+    ny = np.floor(gdf['ymax'].values / GRID_STEP).astype(np.int64) - iy0 + 1
+    n_pairs = nx * ny
+    pair_end = np.cumsum(n_pairs)
+    total_pairs = int(pair_end[-1])
+
+    rows, cols, vals = [], [], []
+    for start in range(0, total_pairs, PAIRS_PER_CHUNK):
+        end = min(start + PAIRS_PER_CHUNK, total_pairs)
+        pair = np.arange(start, end)
+        poly = np.searchsorted(pair_end, pair, side='right')
+        k = pair - (pair_end[poly] - n_pairs[poly])
+        ix = ix0[poly] + k % nx[poly]
+        iy = iy0[poly] + k // nx[poly]
+
+        cells = shapely.box(ix * GRID_STEP, iy * GRID_STEP,
+                            (ix + 1) * GRID_STEP, (iy + 1) * GRID_STEP)
+        share = (shapely.area(shapely.intersection(geoms[poly], cells)) /
+                 poly_area[poly])
+        flat, inside = grid_cells(ix, iy)
+        keep = inside & (share > 0)
+        rows.append(poly[keep])
+        cols.append(flat[keep])
+        vals.append(share[keep])
+
+    rows, cols, vals = (np.concatenate(a) for a in (rows, cols, vals))
+    cells, cols = np.unique(cols, return_inverse=True)
+    weights = sparse.csr_matrix((vals.astype(float), (rows, cols)),
+                                shape=(len(geoms), len(cells)))
+
+    return {'weights': weights, 'ids': gdf.index.values, 'cells': cells}
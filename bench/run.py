@@ -0,0 +1,228 @@
+"""
+Benchmark the exposure and misclassification hot paths on synthetic data.
+
+    python -m bench.run --blocks 50000 [--check]
+
+Each run appends its timings to a JSON-lines history file. A benchmark that is
+slower than the median of its last few runs at the same scale (by more than
+`--tolerance`) is reported as a regression; with `--check` the process then
+exits non-zero, so it can gate a production run. A benchmark that raises is
+logged as failed, the rest still run and are recorded, and `--check` fails.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import numpy as np
+
+from bench import synthetic
+
+
+HISTORY_PATH = os.path.join(os.path.dirname(__file__), 'history.jsonl')
+BASELINE_RUNS = 5
+
+
+def main(n_blocks=50_000, n_states=4, repeats=3, history_path=HISTORY_PATH,
+         tolerance=.25, check=False):
+    world = synthetic.make_world(n_blocks=n_blocks, n_states=n_states)
+    synthetic.install(world)
+
+    with tempfile.TemporaryDirectory(prefix='moncov-bench-') as cache_dir:
+        benchmarks = _setup(world, cache_dir)
+        results, failed = {}, []
+        for name, func in benchmarks:
+            try:
+                times = _time(func, repeats)
+            except Exception:
+                # Keep timing the rest; the failure is recorded below
+                traceback.print_exc()
+                failed.append(name)
+                print(f"{name:<28} FAILED", flush=True)
+                continue
+            results[name] = {'median': float(np.median(times)),
+                             'min': float(min(times)),
+                             'repeats': repeats}
+            print(f"{name:<28} median {results[name]['median']:8.3f}s"
+                  f"   min {results[name]['min']:8.3f}s", flush=True)
+
+    record = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'host': socket.gethostname(),
+        'python': platform.python_version(),
+        'n_blocks': n_blocks,
+        'n_states': n_states,
+        'results': results,
+        'failed': failed,
+    }
+    regressions = _regressions(record, _read_history(history_path), tolerance)
+    with open(history_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+    for name, (now, base) in regressions.items():
+        print(f"REGRESSION {name}: {now:.3f}s vs baseline {base:.3f}s")
+
+    if check and (regressions or failed):
+        sys.exit(1)
+
+    return record
+
+
+def _setup(world, cache_dir):
+    """ Import the code under test against a scratch cache and warm inputs """
+    os.environ['MONCOV_DATA_ROOT'] = cache_dir
+    from util.env import data_path
+    from util.cache import enable_copy_on_write
+    os.makedirs(data_path())
+    # As the top-level scripts run
+    enable_copy_on_write()
+
+    from util.weighted_quantile import weighted_quantile
+    from analysis import (basic_data, geo_exposure, misclass, naaqs_sweep,
+                          satellite_grid, zonal)
+    from reg_nonattain import regs
+
+    # Inputs (built and cached once, untimed)
+    basic_data.monitors_block()
+    panel = basic_data.msatna_panel()
+    panel_3lag = basic_data.msatna_3lag_panel()
+    year, rule = 2014, 'pm25_12'
+    misclass_df = misclass.blocks_misclass_flag(year, rule, 'msatna')
+    misclass.misclass_cube()
+    naaqs_sweep.threshold_sweeps(rule, 'msatna')
+    state = sorted(world['states'])[0]
+    modis_data = world['modis'][year].reset_index()
+    state_fips = world['states'][state]
+    geo_exposure.multisatpm_exposure_area_conus('bg', year)
+    blocks = world['blocks']
+    satellite_grid.point_exposure(blocks['x'][:1], blocks['y'][:1])
+    _check_reg_cache(regs, rule)
+
+    benchmarks = [
+        ('monitors_block', lambda: basic_data.monitors_block.__wrapped__()),
+        ('panel_to_3lag', lambda: basic_data.panel_to_3lag(panel)),
+        ('merge_blocks_msatna',
+         lambda: basic_data.merge_blocks_msatna(panel_3lag)),
+        ('state_modis_exposure_bg',
+         lambda: geo_exposure.state_modis_exposure_bg.__wrapped__(
+             state, year, modis_data=modis_data)),
+        ('zonal_weights_bg',
+         lambda: zonal.zonal_weights.__wrapped__('bg', state_fips)),
+        ('multisatpm_exposure_area_bg',
+         lambda: geo_exposure.multisatpm_exposure_area_conus.__wrapped__(
+             'bg', year)),
+        ('blocks_misclass_flag',
+         lambda: misclass.blocks_misclass_flag.__wrapped__(
+             year, rule, 'msatna')),
+        ('misclass_cube', lambda: misclass.misclass_cube.__wrapped__()),
+        ('fips_misclass_flag',
+         lambda: misclass.fips_misclass_flag(year, rule, 'msatna',
+                                             use_cube=True)),
+        ('fips_misclass_flag_year',
+         lambda: misclass.fips_misclass_flag(year, rule, 'msatna')),
+        ('misclass_threshold_curve',
+         lambda: naaqs_sweep.misclass_threshold_curve(year, rule, 'msatna')),
+        ('misclass_at_threshold',
+         lambda: naaqs_sweep.misclass_at_threshold(year, rule, 'msatna', 11.)),
+        ('point_exposure',
+         lambda: satellite_grid.point_exposure(blocks['x'], blocks['y'])),
+        ('weighted_quantile',
+         lambda: weighted_quantile(misclass_df, 'exp', 'pop',
+                                   q=[.1, .25, .5, .75, .9])),
+        ('regs', lambda: regs(rule=rule)),
+    ]
+
+    return benchmarks
+
+
+def _check_reg_cache(regs, rule):
+    """
+    Fits read back from the regression cache match fresh fits, without the
+    per-observation arrays
+    """
+    import econtools.metrics as mt
+    from util.cache import memo_clear
+
+    regs(rule=rule)
+    memo_clear()    # So the next call reads the pickles
+    ols, ols_w_flag, df, _I = regs(rule=rule)
+    specs = ((ols, ['nonattain_post'] + _I),
+             (ols_w_flag, ['targeted_post', 'untargeted_post'] + _I))
+    for cached, x_name in specs:
+        fresh = mt.reg(df, 'arithmetic_mean', x_name, a_name='monitor_id',
+                       cluster='monitor_id')
+        for attr in ('beta', 'se', 'pt', 'ci_lo', 'ci_hi', 'vce', 'r2',
+                     'r2_a', 'N'):
+            np.testing.assert_allclose(np.asarray(getattr(cached, attr)),
+                                       np.asarray(getattr(fresh, attr)),
+                                       err_msg=f"cached `{attr}`")
+        assert not hasattr(cached, 'resid'), "cached fit kept `resid`"
+
+
+def _time(func, repeats):
+    times = []
+    for __ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _read_history(path):
+    if not os.path.isfile(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _regressions(record, history, tolerance):
+    """ Benchmarks slower than the median of recent comparable runs """
+    same = [r for r in history
+            if (r['n_blocks'], r['n_states'], r['host']) ==
+            (record['n_blocks'], record['n_states'], record['host'])]
+    same = same[-BASELINE_RUNS:]
+
+    out = {}
+    for name, res in record['results'].items():
+        past = [r['results'][name]['median'] for r in same
+                if name in r['results']]
+        if not past:
+            continue
+        base = float(np.median(past))
+        if res['median'] > base * (1 + tolerance):
+            out[name] = (res['median'], base)
+
+    return out
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(__file__), stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    opts = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    opts.add_argument('--blocks', type=int, default=50_000)
+    opts.add_argument('--states', type=int, default=4)
+    opts.add_argument('--repeats', type=int, default=3)
+    opts.add_argument('--history', type=str, default=HISTORY_PATH)
+    opts.add_argument('--tolerance', type=float, default=.25)
+    opts.add_argument('--check', action='store_true')
+    args = opts.parse_args()
+
+    main(n_blocks=args.blocks, n_states=args.states, repeats=args.repeats,
+         history_path=args.history, tolerance=args.tolerance,
+         check=args.check)
@@ -0,0 +1,448 @@
+"""
+Synthetic stand-ins for the `epa_airpoll`, `multisatpm` and `modis` loaders.
+
+`make_world` lays out a nested grid of states > counties > tracts > block
+groups inside `conus_bounds`, scatters blocks (with x/y/pop) inside the block
+groups and puts smooth PM2.5 surfaces on the 0.01 degree satellite grid.
+Block groups are boxes, and blocks are strips of their block group's box.
+`install` registers fake modules that serve this data with the same schemas
+as the real loaders, so `analysis` runs unchanged on it. It must be called
+before anything in `analysis` is imported.
+"""
+import sys
+import types
+
+import numpy as np
+import pandas as pd
+
+from util import conus_bounds, pmrule_imp_year
+
+
+STATE_FIPS = ('06', '41', '53', '32', '16', '04', '49', '08', '35', '56',
+              '30', '38', '46', '31', '20', '40')
+COUNTIES_PER_SIDE = 3
+BGS_PER_TRACT = 3
+BLOCKS_PER_BG_MAX = 999
+SAT_YEARS = range(2000, 2017 + 1)
+MONITOR_YEARS = range(2000, 2017 + 1)
+NONATTAIN_YEARS = range(2005, 2017 + 1)
+RULES = ('pm25_97', 'pm25_06', 'pm25_12')
+MONITORS_PER_COUNTY = 4
+# Share of monitors next to a big source, and how much higher they read
+SOURCE_SHARE = .2
+SOURCE_BUMP = 4.
+
+
+def make_world(n_blocks: int=200_000, n_states: int=4, seed: int=0) -> dict:
+    """
+    Synthetic data at scale `n_blocks`. The region covered grows with the
+    number of blocks so that block density, and so block/grid-cell ratios,
+    stay about the same.
+    """
+    rng = np.random.RandomState(seed)
+    if not 1 <= n_states <= len(STATE_FIPS):
+        raise ValueError(f"n_states must be 1 to {len(STATE_FIPS)}")
+
+    # Region: about 2000 blocks per square degree, anchored in the West
+    side = max(np.sqrt(n_blocks / 2000), 0.5)
+    x0, y0 = conus_bounds[0] + 4, conus_bounds[2] + 8
+    width, height = side * n_states ** .5, side / n_states ** .5
+    height = min(height, conus_bounds[3] - y0 - 0.5)
+
+    bgs = _make_bgs(n_blocks, n_states, x0, y0, width, height)
+    blocks = _make_blocks(bgs, n_blocks, rng)
+    grid = _make_grid(x0, y0, width, height, rng)
+    monitors = _make_monitors(blocks, grid, rng)
+
+    world = {
+        'bgs': bgs,
+        'blocks': blocks,
+        'grid': grid,
+        'monitors': monitors,
+        'states': {f'State{fips}': fips for fips in STATE_FIPS[:n_states]},
+        'nonattain': _make_nonattain(blocks, monitors, rng),
+        'modis': _make_modis(grid, rng),
+        'rng_seed': seed,
+    }
+
+    return world
+
+
+def _make_bgs(n_blocks, n_states, x0, y0, width, height):
+    n_counties = n_states * COUNTIES_PER_SIDE ** 2
+    bgs_needed = n_blocks / (BLOCKS_PER_BG_MAX / 2)
+    tracts_per_side = max(int(np.ceil(
+        np.sqrt(bgs_needed / (n_counties * BGS_PER_TRACT)))), 1)
+
+    state_w = width / n_states
+    county_w = state_w / COUNTIES_PER_SIDE
+    county_h = height / COUNTIES_PER_SIDE
+    tract_w = county_w / tracts_per_side
+    tract_h = county_h / tracts_per_side
+    bg_h = tract_h / BGS_PER_TRACT
+
+    s, cx, cy, tx, ty, b = np.meshgrid(
+        np.arange(n_states), np.arange(COUNTIES_PER_SIDE),
+        np.arange(COUNTIES_PER_SIDE), np.arange(tracts_per_side),
+        np.arange(tracts_per_side), np.arange(BGS_PER_TRACT),
+        indexing='ij')
+    s, cx, cy, tx, ty, b = (a.ravel() for a in (s, cx, cy, tx, ty, b))
+
+    bgs = pd.DataFrame({
+        'STATE': np.array(STATE_FIPS)[s],
+        'COUNTY': (cx * COUNTIES_PER_SIDE + cy) * 2 + 1,
+        'TRACT': (tx * tracts_per_side + ty + 1) * 100,
+        'BLKGRP': b + 1,
+    })
+    bgs['x0'] = x0 + s * state_w + cx * county_w + tx * tract_w
+    bgs['y0'] = y0 + cy * county_h + ty * tract_h + b * bg_h
+    bgs['x1'] = bgs['x0'] + tract_w
+    bgs['y1'] = bgs['y0'] + bg_h
+    bgs['bg_id'] = (bgs['STATE'] +
+                    bgs['COUNTY'].astype(str).str.zfill(3) +
+                    bgs['TRACT'].astype(str).str.zfill(6) +
+                    bgs['BLKGRP'].astype(str))
+
+    return bgs
+
+
+def _make_blocks(bgs, n_blocks, rng):
+    per_bg = rng.multinomial(n_blocks, np.ones(len(bgs)) / len(bgs))
+    per_bg = np.minimum(per_bg, BLOCKS_PER_BG_MAX)
+    bg_idx = np.repeat(np.arange(len(bgs)), per_bg)
+    starts = np.repeat(np.cumsum(per_bg) - per_bg, per_bg)
+    block_num = np.arange(len(bg_idx)) - starts
+
+    bg = bgs.iloc[bg_idx]
+    u, v = rng.rand(2, len(bg_idx))
+    blocks = pd.DataFrame({
+        'x': bg['x0'].values + u * (bg['x1'].values - bg['x0'].values),
+        'y': bg['y0'].values + v * (bg['y1'].values - bg['y0'].values),
+        'area': rng.lognormal(10, 1, len(bg_idx)),
+    }, index=pd.Index(
+        bg['bg_id'].values.astype(object) +
+        pd.Series(block_num).astype(str).str.zfill(3).values,
+        name='block_id'))
+    # Census has lots of empty blocks
+    blocks['pop'] = np.where(rng.rand(len(blocks)) < .3, 0,
+                             rng.poisson(40, len(blocks)))
+
+    return blocks
+
+
+def _make_grid(x0, y0, width, height, rng):
+    """ 0.01 degree cell centers with a smooth PM2.5 surface per year """
+    xs = (np.arange(np.floor(x0 * 100), np.ceil((x0 + width) * 100)) + .5)
+    ys = (np.arange(np.floor(y0 * 100), np.ceil((y0 + height) * 100)) + .5)
+    xx, yy = np.meshgrid(xs / 100, ys / 100)
+    xx, yy = xx.ravel(), yy.ravel()
+
+    base = (9 + 3 * np.sin(xx * 1.7) * np.cos(yy * 2.3) +
+            5 * np.exp(-((xx - xx.mean()) ** 2 + (yy - yy.mean()) ** 2)))
+    # Holes, like water and missing retrievals
+    holes = rng.rand(len(xx)) < .02
+
+    index = pd.MultiIndex.from_arrays([xx, yy], names=['x', 'y'])
+    grid = {}
+    for i, year in enumerate(SAT_YEARS):
+        vals = base * (1.15 - .02 * i) + rng.normal(0, .5, len(xx))
+        vals[holes] = np.nan
+        grid[year] = pd.Series(vals, index=index)
+
+    return grid
+
+
+def _make_monitors(blocks, grid, rng):
+    """
+    About one PM2.5 monitor per 500 blocks, plus other pollutants, with at
+    least `MONITORS_PER_COUNTY` sites in every county. Some sites sit next to
+    a big source and read well above the surface around them.
+    """
+    fips = blocks.index.str[:5]
+    per_county = max(len(blocks) // 500 // fips.nunique(),
+                     MONITORS_PER_COUNTY)
+    sites = (blocks.groupby(fips, group_keys=False)
+             .apply(lambda df: df.sample(min(per_county, len(df)),
+                                         random_state=rng)))
+    n = len(sites)
+    fips = sites.index.str[:5]
+    site_num = np.arange(1, n + 1)
+
+    monitors = pd.DataFrame({
+        'state_code': fips.str[:2].astype(int),
+        'county_code': fips.str[2:].astype(int),
+        'site_number': site_num,
+        'parameter_code': np.where(rng.rand(n) < .85, 88101, 88502),
+        'poc': 1,
+        'latitude': sites['y'].values,
+        'longitude': sites['x'].values,
+        'block_id': sites.index.values,
+        'naaqs_primary_monitor': np.where(rng.rand(n) < .9, 'Y', 'N'),
+    })
+    monitors['site_id'] = (fips.values + '_' +
+                           monitors['site_number'].astype(str))
+    monitors['monitor_id'] = (monitors['site_id'] + '_' +
+                              monitors['parameter_code'].astype(str) +
+                              monitors['poc'].astype(str))
+    monitors['level'] = (rng.normal(0, 1.5, n) +
+                         SOURCE_BUMP * (rng.rand(n) < SOURCE_SHARE))
+
+    # Annual means track the satellite surface plus a monitor effect
+    cell = pd.MultiIndex.from_arrays([
+        (np.floor(monitors['longitude'] * 100) + .5) / 100,
+        (np.floor(monitors['latitude'] * 100) + .5) / 100])
+    for year in MONITOR_YEARS:
+        sat = grid[min(year, max(SAT_YEARS))].reindex(cell).values
+        monitors[year] = (np.nan_to_num(sat, nan=9.) + monitors['level'] +
+                          rng.normal(0, .5, n))
+        # Some monitors are not running every year
+        monitors.loc[rng.rand(n) < .05, year] = np.nan
+
+    return monitors
+
+
+def _make_nonattain(blocks, monitors, rng):
+    """
+    Per rule, a few whole counties are designated nonattainment: the ones
+    with the highest readings in the rule's implementation year, so some
+    monitors are over the NAAQS in them, and as many again at random
+    """
+    fips = blocks.index.str[:5]
+    counties = np.unique(fips)
+    n_bad = max(len(counties) // 12, 1)
+    out = {}
+    for rule in RULES:
+        readings = (monitors.groupby(monitors['site_id'].str[:5])
+                    [pmrule_imp_year[rule]].max())
+        dirty = readings.sort_values(ascending=False).index[:n_bad]
+        rest = np.setdiff1d(counties, dirty)
+        bad = np.union1d(dirty, rng.choice(rest, n_bad, replace=False))
+        flag = pd.Series(fips.isin(bad), index=blocks.index)
+        out[rule] = pd.DataFrame({year: flag for year in NONATTAIN_YEARS})
+    return out
+
+
+def _make_modis(grid, rng):
+    """ MODIS-like retrievals: a random subset of points, jittered """
+    out = {}
+    cells = grid[min(SAT_YEARS)].index
+    xx = cells.get_level_values('x').values
+    yy = cells.get_level_values('y').values
+    for year in SAT_YEARS:
+        keep = rng.rand(len(xx)) < .25
+        out[year] = pd.DataFrame({
+            'x': xx[keep] + rng.uniform(-.005, .005, keep.sum()),
+            'y': yy[keep] + rng.uniform(-.005, .005, keep.sum()),
+            'pm25': grid[year].values[keep],
+        })
+    return out
+
+
+# Fake loaders
+def install(world: dict) -> None:
+    """ Register fake `epa_airpoll`, `multisatpm` and `modis` modules """
+    if any(m.startswith('analysis') for m in sys.modules):
+        raise RuntimeError("`install` must run before importing `analysis`")
+
+    blocks, mons = world['blocks'], world['monitors']
+
+    def blocks_population():
+        return blocks['pop'].rename('pop').rename_axis(None)
+
+    def load_blocks_shape_info():
+        return blocks[['x', 'y', 'area']].copy()
+
+    def monitors_annual_summary(year):
+        return _annual_summary(mons, year)
+
+    def monitors_data():
+        cols = ['monitor_id', 'site_id', 'state_code', 'county_code',
+                'parameter_code', 'latitude', 'longitude',
+                'naaqs_primary_monitor']
+        df = mons[cols].copy()
+        df['state_code'] = df['state_code'].astype(str).str.zfill(2)
+        df['start_date'] = '2000-01-01'
+        df['end_date'] = ''
+        # Canada shows up in the real thing
+        cc = df.iloc[:1].copy()
+        cc['state_code'] = 'CC'
+        cc['monitor_id'] = 'CC001_1_881011'
+        return pd.concat([df, cc], ignore_index=True)
+
+    def valid_flag_panel():
+        rng = np.random.RandomState(world['rng_seed'])
+        flags = rng.rand(len(mons), len(MONITOR_YEARS)) < .9
+        return pd.DataFrame(flags, index=mons['monitor_id'].values,
+                            columns=list(MONITOR_YEARS))
+
+    def naaqs_assessment_monitors():
+        primary = mons[mons['naaqs_primary_monitor'] == 'Y']
+        # Each county's highest reading monitor sets its design value
+        fips = primary['site_id'].str[:5]
+        top = primary[list(MONITOR_YEARS)].mean(axis=1).groupby(fips).idxmax()
+        listed = primary[primary.index.isin(top.values) |
+                         (np.arange(len(primary)) % 3 == 0)]
+        return pd.DataFrame({
+            'fips': listed['site_id'].str[:5].values,
+            'site_id': [a + b.zfill(4) for a, b in
+                        listed['site_id'].str.split('_')],
+        })
+
+    def nonattainment_block_panel(rule):
+        return world['nonattain'][rule].copy()
+
+    def load_bg_shape(state_fips):
+        import geopandas as gpd
+        from shapely.geometry import box
+        bgs = world['bgs']
+        bgs = bgs[bgs['STATE'] == state_fips].reset_index(drop=True)
+        geoms = [box(*r) for r in bgs[['x0', 'y0', 'x1', 'y1']].values]
+        return gpd.GeoDataFrame(
+            bgs[['STATE', 'COUNTY', 'TRACT', 'BLKGRP']].astype(int),
+            geometry=geoms)
+
+    def load_block_shape(state_fips):
+        import geopandas as gpd
+        from shapely.geometry import box
+        df = _block_boxes(blocks, world['bgs'])
+        df = df[df.index.str[:2] == state_fips]
+        geoms = [box(*r) for r in df[['x0', 'y0', 'x1', 'y1']].values]
+        return gpd.GeoDataFrame({'GEOID10': df.index.values,
+                                 'COUNTYFP10': df.index.str[2:5].values},
+                                geometry=geoms)
+
+    def multisat_conus_year(year):
+        return world['grid'][year].copy()
+
+    def msat_northamer_conus_3year(year):
+        years = [y for y in range(year - 2, year + 1) if y in world['grid']]
+        return pd.concat([world['grid'][y] for y in years], axis=1).mean(1)
+
+    def load_modis_year(year):
+        return world['modis'][year].copy()
+
+    def annual_mean(df):
+        return df['pm25'].mean()
+
+    modules = {
+        'epa_airpoll': dict(
+            blocks_population=blocks_population,
+            monitors_annual_summary=monitors_annual_summary,
+            load_blocks_shape_info=load_blocks_shape_info,
+            monitors_data=monitors_data,
+            load_block_shape=load_block_shape,
+            valid_flag_panel=valid_flag_panel,
+            naaqs_assessment_monitors=naaqs_assessment_monitors,
+            nonattainment_block_panel=nonattainment_block_panel),
+        'epa_airpoll.util': dict(name_to_fips_xwalk=world['states']),
+        'epa_airpoll.clean': {},
+        'epa_airpoll.clean.census': {},
+        'epa_airpoll.clean.census.shapefiles': dict(
+            load_bg_shape=load_bg_shape,
+            load_blocks_shape_info=load_blocks_shape_info),
+        'multisatpm': dict(
+            multisat_conus_year=multisat_conus_year,
+            msat_northamer_1year=multisat_conus_year,
+            msat_northamer_conus_3year=msat_northamer_conus_3year),
+        'modis': {},
+        'modis.util': dict(annual_mean=annual_mean),
+        'modis.clean': {},
+        'modis.clean.raw': dict(load_modis_year=load_modis_year),
+    }
+    for name, attrs in modules.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        module.__path__ = []
+        sys.modules[name] = module
+        parent, __, child = name.rpartition('.')
+        if parent:
+            setattr(sys.modules[parent], child, module)
+
+
+def _block_boxes(blocks, bgs):
+    """
+    Each block's piece of its block group's box: a full-height strip around
+    the block's point, split halfway to the blocks beside it
+    """
+    df = pd.DataFrame({'bg_id': blocks.index.str[:12], 'x': blocks['x']},
+                      index=blocks.index).sort_values(['bg_id', 'x'])
+    bg = bgs.set_index('bg_id').reindex(df['bg_id'])
+    x = df.groupby('bg_id')['x']
+    prev, next_ = x.shift(1).values, x.shift(-1).values
+    return pd.DataFrame({
+        'x0': np.where(np.isnan(prev), bg['x0'].values,
+                       (prev + df['x'].values) / 2),
+        'y0': bg['y0'].values,
+        'x1': np.where(np.isnan(next_), bg['x1'].values,
+                       (df['x'].values + next_) / 2),
+        'y1': bg['y1'].values,
+    }, index=df.index)
+
+
+def _annual_summary(mons, year):
+    """ One row per monitor and standard, like AQS `annual_conc_by_monitor` """
+    df = mons[mons[year].notnull()]
+    df = pd.DataFrame({
+        'state_code': df['state_code'].values,
+        'county_code': df['county_code'].values,
+        'site_number': df['site_number'].values,
+        'parameter_code': df['parameter_code'].values,
+        'poc': df['poc'].values,
+        'latitude': df['latitude'].values,
+        'longitude': df['longitude'].values,
+        'datum': 'WGS84',
+        'parameter_name': 'PM2.5 - Local Conditions',
+        'sample_duration': '24 HOUR',
+        'pollutant_standard': 'PM25 Annual 2006',
+        'metric_used': 'Daily Mean',
+        'method_name': 'R & P Model 2025 PM-2.5 Sequential Air Sampler',
+        'year': year,
+        'units_of_measure': 'Micrograms/cubic meter (LC)',
+        'event_type': 'No Events',
+        'observation_count': 120,
+        'observation_percent': 98,
+        'completeness_indicator': 'Y',
+        'valid_day_count': 120,
+        'required_day_count': 122,
+        'exceptional_data_count': 0,
+        'null_data_count': 2,
+        'primary_exceedance_count': 0,
+        'secondary_exceedance_count': 0,
+        'certification_indicator': 'Certified',
+        'num_obs_below_mdl': 0,
+        'arithmetic_mean': df[year].values,
+        'arithmetic_standard_dev': 2.,
+        '1st_max_value': df[year].values * 3,
+        '1st_max_datetime': f'{year}-01-01',
+        '2nd_max_value': df[year].values * 2.8,
+        '2nd_max_datetime': f'{year}-01-02',
+        '3rd_max_value': df[year].values * 2.6,
+        '3rd_max_datetime': f'{year}-01-03',
+        '4th_max_value': df[year].values * 2.4,
+        '4th_max_datetime': f'{year}-01-04',
+        '1st_max_non_overlapping_value': np.nan,
+        '1st_no_max_datetime': '',
+        '2nd_max_non_overlapping_value': np.nan,
+        '2nd_no_max_datetime': '',
+        '99th_percentile': df[year].values * 2.5,
+        '98th_percentile': df[year].values * 2.3,
+        '95th_percentile': df[year].values * 2,
+        '90th_percentile': df[year].values * 1.7,
+        '75th_percentile': df[year].values * 1.3,
+        '50th_percentile': df[year].values,
+        '10th_percentile': df[year].values * .5,
+        'local_site_name': 'Synthetic',
+        'address': '1 Main St',
+        'state_name': 'State',
+        'county_name': 'County',
+        'city_name': 'City',
+        'cbsa_name': 'CBSA',
+        'date_of_last_change': f'{year + 1}-06-01',
+        'monitor_id': df['monitor_id'].values,
+    })
+    # Exceptional-event and 24-hour standard duplicates get filtered out
+    extra = df.iloc[::7].copy()
+    extra['event_type'] = 'Events Included'
+    extra24 = df.iloc[::5].copy()
+    extra24['pollutant_standard'] = 'PM25 24-hour 2006'
+    return pd.concat([df, extra, extra24], ignore_index=True)
@@ -6,9 +6,12 @@ See Section 5.4.2 of "Using Satellite Data to Fill the Gaps in the US Air
 Pollution Monitoring Network"
 """
 import numpy as np
-from econtools import state_fips_to_name
 
+from util import pm_naaqs_limit
+from util.cache import enable_copy_on_write
 from util.env import out_path
+from util.profiling import profiled
+from util.subset import subset_cli
 from clean.mortality import mortality
 from analysis.misclass import blocks_misclass_flag
 
@@ -17,9 +20,54 @@ from reg_nonattain import regs
 
 DOSE_RATE = .14 / 10     # per 10 ug/m3 (Lepeule el al. 2012)
 VSL = 9                  # Values in millions
+# The counterfactuals lower exposure to the current standard for every rule
+COUNTERFACTUAL_NAAQS = pm_naaqs_limit['pm25_12']
+# Exposure year for each rule's mortality calculation
+EXPOSURE_YEAR = {'pm25_97': 2007, 'pm25_06': 2007, 'pm25_12': 2014}
 
 
+@profiled
 def main(rule='pm25_12', data='msatna', save=False):
+    stats, by_state, df = excess_deaths(rule=rule, data=data)
+
+    # Output results
+    out_str = (
+        f"Extra deaths:\t{stats['extra_deaths']:.1f}\n" +
+        "VSL value:\t{:.1f}\n".format(stats['extra_deaths'] * VSL) +
+        "\n" +
+        f"In areas over NAAQS:\t{stats['targeted_deaths']:.1f}\n" +
+        "VSL value:\t{:.1f}\n".format(stats['targeted_deaths'] * VSL) +
+        "\n" +
+        f"Under NAAQS:\t{stats['untargeted_deaths']:.1f}\n" +
+        "VSL value:\t{:.1f}\n".format(stats['untargeted_deaths'] * VSL) +
+        "\n" +
+        by_state.to_string() +
+        "\n---------------\n" +
+        "Lowering to NAAQS only\n" +
+        f"Extra deaths:\t{stats['to_naaqs_deaths']:.1f}\n" +
+        "VSL value:\t{:.1f}\n".format(stats['to_naaqs_deaths'] * VSL) +
+        f"Decrease in exposure:\t{stats['to_naaqs_decrease']:.2f}\n" +
+        "\n---------------\n" +
+        f"Scaling the peak down to {COUNTERFACTUAL_NAAQS}\n" +
+        f"Extra deaths:\t{stats['scale_deaths']:.1f}\n" +
+        "VSL value\t{:.1f}\n".format(stats['scale_deaths'] * VSL) +
+        f"Decrease in exposure:\t{stats['scale_decrease']:.2f}\n"
+    )
+    print(out_str)
+    if save:
+        with open(out_path('calc_mortality.txt'), 'w') as f:
+            f.write(out_str)
+
+    return df
+
+
+@profiled
+def excess_deaths(rule='pm25_12', data='msatna'):
+    """
+    Excess deaths in misclassified counties. Returns a dict of totals, deaths
+    and cost by state, and the block-level frame they come from.
+    """
+    from econtools import state_fips_to_name
 
     # Full regression-based method
     ols, ols_w_flag, df_reg, __ = regs(rule=rule)
@@ -33,53 +81,39 @@ def main(rule='pm25_12', data='msatna', save=False):
     extra_deaths = df['extra_deaths'].sum()
     targeted_deaths = df.loc[df['is_over'], 'extra_deaths'].sum()
     untargeted_deaths = df.loc[~df['is_over'], 'extra_deaths'].sum()
-    df['state'] = df['fips'].apply(lambda x: state_fips_to_name(int(x[:2])))
+    state_fips = df['fips'].str[:2]
+    df['state'] = state_fips.map({s: state_fips_to_name(int(s))
+                                  for s in state_fips.unique()})
     by_state = df.groupby('state')['extra_deaths'].sum().to_frame()
     by_state['cost'] = by_state['extra_deaths'] * VSL
 
+    naaqs = COUNTERFACTUAL_NAAQS
+
     # Simple peak-shaving Method (lower to NAAQS only)
-    df['to_naaqs'] = (df['exp'] - 12).clip_lower(0)
+    df['to_naaqs'] = (df['exp'] - naaqs).clip(lower=0)
     df['to_naaqs_deaths'] = _dose_rate(df['to_naaqs']) * df['block_deaths']
     to_naaqs_deaths = df['to_naaqs_deaths'].sum()
     to_naaqs_decrease = df.loc[df['to_naaqs'] > 0, 'to_naaqs'].mean()
 
     # Scale whole county down by max
     df['county_max'] = df.groupby('fips')['exp'].transform('max')
-    df['scale'] = 12 / df['county_max']
+    df['scale'] = naaqs / df['county_max']
     df['scale_diff'] = df['exp'] * (1 - df['scale'])
     df['scale_deaths'] = _dose_rate(df['scale_diff']) * df['block_deaths']
     scale_deaths = df['scale_deaths'].sum()
     scale_decrease = df['scale_diff'].mean()
 
-    # Output results
-    out_str = (
-        f"Extra deaths:\t{extra_deaths:.1f}\n" +
-        "VSL value:\t{:.1f}\n".format(extra_deaths * VSL) +
-        "\n" +
-        f"In areas over NAAQS:\t{targeted_deaths:.1f}\n" +
-        "VSL value:\t{:.1f}\n".format(targeted_deaths * VSL) +
-        "\n" +
-        f"Under NAAQS:\t{untargeted_deaths:.1f}\n" +
-        "VSL value:\t{:.1f}\n".format(untargeted_deaths * VSL) +
-        "\n" +
-        by_state.to_string() +
-        "\n---------------\n" +
-        "Lowering to NAAQS only\n" +
-        f"Extra deaths:\t{to_naaqs_deaths:.1f}\n" +
-        "VSL value:\t{:.1f}\n".format(to_naaqs_deaths * VSL) +
-        f"Decrease in exposure:\t{to_naaqs_decrease:.2f}\n" +
-        "\n---------------\n" +
-        "Scaling the peak down to 12\n" +
-        f"Extra deaths:\t{scale_deaths:.1f}\n" +
-        "VSL value\t{:.1f}\n".format(scale_deaths * VSL) +
-        f"Decrease in exposure:\t{scale_decrease:.2f}\n"
-    )
-    print(out_str)
-    if save:
-        with open(out_path('calc_mortality.txt'), 'w') as f:
-            f.write(out_str)
+    stats = {
+        'extra_deaths': extra_deaths,
+        'targeted_deaths': targeted_deaths,
+        'untargeted_deaths': untargeted_deaths,
+        'to_naaqs_deaths': to_naaqs_deaths,
+        'to_naaqs_decrease': to_naaqs_decrease,
+        'scale_deaths': scale_deaths,
+        'scale_decrease': scale_decrease,
+    }
 
-    return df
+    return stats, by_state, df
 
 
 def _dose_rate(x):
@@ -87,11 +121,20 @@ def _dose_rate(x):
     return -1 * (1 - np.exp(DOSE_RATE * x))
 
 
+@profiled
 def prep_exposure_data(rule='pm25_12', data='msatna'):
-    exp_year = 2014 if rule == 'pm25_12' else 2007
+    exp_year = EXPOSURE_YEAR[rule]
 
     df = blocks_misclass_flag(exp_year, rule, data)
 
+    # Filter first so mortality is only merged onto the blocks we keep
+    df = df[~df['nonattain']]
+
+    has_misclass = df.groupby('fips')['is_over'].max()
+    df = df.join(has_misclass.to_frame('has_misclass'), on='fips')
+
+    df = df[df['has_misclass']]
+
     # mortality
     mort = mortality()[['fips', 'year', 'deaths', 'rate']]
     mort = (mort[mort['year'] == exp_year]
@@ -101,18 +144,13 @@ def prep_exposure_data(rule='pm25_12', data='msatna'):
 
     df['block_deaths'] = df['pop'] * df['deaths'] / df['fips_pop']
 
-    df = df[~df['nonattain']]
-
-    has_misclass = df.groupby('fips')['is_over'].max()
-    df = df.join(has_misclass.to_frame('has_misclass'), on='fips')
-
-    df = df[df['has_misclass']]
-
     return df
 
 
 if __name__ == '__main__':
     import argparse
+    subset_cli()
+    enable_copy_on_write()
     opts = argparse.ArgumentParser()
     opts.add_argument('--rule', type=str, default='pm25_12')
     opts.add_argument('--data', type=str, default='msatna',
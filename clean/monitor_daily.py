@@ -0,0 +1,195 @@
+"""
+PM2.5 monitor-years from EPA daily files (`daily_88101_<year>.zip`,
+https://aqs.epa.gov/aqsweb/airdata/download_files.html).
+
+Each year's file is read in chunks of `DAILY_CHUNK_ROWS`, keeping only sums
+and counts per monitor and quarter, so memory doesn't grow with the file.
+Years are read in parallel processes (`MONCOV_DAILY_WORKERS`, default the
+number of CPUs up to 8); the parent looks up each year's required sample
+counts and hands them to the workers, so no worker loads an annual summary.
+
+From those, following 40 CFR 50 Appendix N:
+    arithmetic_mean     mean of the quarterly means
+    qN_completeness     samples in quarter N over samples scheduled, where
+                        the required schedule (every 1, 3 or 6 days) comes
+                        from the annual summary's `required_day_count`, or
+                        every 3 days for monitors it doesn't list
+    complete            every quarter at least 75% complete
+    design_value        mean of this and the 2 prior years' means, if all 3
+                        are complete
+
+`monitors_daily_panel` has the same monitor-year shape as
+`analysis.monitor_sample.monitors_summary_panel`, so the monitor panels can
+be built from it instead (`source='daily'`).
+"""
+import calendar
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from util import MONITOR_MAX_YEAR
+from util.cache import load_or_build
+from util.env import data_path, src_path
+from util.mirror import local_path
+from util.profiling import profiled, disable_report
+from util.subset import subset, in_bbox
+from analysis.sources import monitors_annual_summary
+
+
+DAILY_YEARS = range(2000, MONITOR_MAX_YEAR + 1)
+DAILY_CHUNK_ROWS = 500_000
+DAILY_WORKERS = int(os.environ.get('MONCOV_DAILY_WORKERS',
+                                   min(os.cpu_count() or 1, 8)))
+
+DAILY_COLUMNS = ['State Code', 'County Code', 'Site Num', 'Parameter Code',
+                 'POC', 'Latitude', 'Longitude', 'Pollutant Standard',
+                 'Date Local', 'Event Type', 'Arithmetic Mean']
+DAILY_STANDARD = 'PM25 Annual 2006'
+# Days with no event, and event days with the event data excluded
+DAILY_EVENT_TYPES = ('None', 'Excluded')
+SAMPLE_INTERVALS = np.array([1, 3, 6])      # days
+DEFAULT_SAMPLE_INTERVAL = 3                 # 40 CFR 58.12(d)
+QUARTER_COMPLETENESS = .75
+QUARTERS = (1, 2, 3, 4)
+
+
+def daily_src_path(year: int) -> str:
+    return src_path('daily', f'daily_88101_{year}.zip')
+
+
+@load_or_build(data_path('tmp_monitor_daily_panel.pkl'))
+def monitors_daily_panel() -> pd.DataFrame:
+    """ Monitor-year panel from the daily files, with design values """
+    years = list(DAILY_YEARS)
+    # Only years still to build need their counts
+    required = [None if os.path.isfile(monitors_daily_year.cache_path(year))
+                else required_day_count(year) for year in years]
+    if DAILY_WORKERS > 1:
+        # Workers' stages aren't the parent's; only the parent reports
+        with ProcessPoolExecutor(max_workers=DAILY_WORKERS,
+                                 initializer=disable_report) as pool:
+            dfs = list(pool.map(monitors_daily_year, years, required))
+    else:
+        dfs = [monitors_daily_year(year, req)
+               for year, req in zip(years, required)]
+    df = pd.concat(dfs, ignore_index=True)
+    del dfs
+
+    df = df.join(_design_values(df), on=['monitor_id', 'year'])
+
+    assert df.shape == df.drop_duplicates(['year', 'monitor_id']).shape
+
+    return df
+
+
+@load_or_build(data_path('tmp_monitor_daily_{}.pkl'), path_args=[0])
+def monitors_daily_year(year: int, required: pd.Series=None) -> pd.DataFrame:
+    """
+    One row per monitor with data in `year`; see module docstring.
+    `required` is `required_day_count(year)`, looked up if not given.
+    """
+    # Per chunk: (monitor_id, quarter) sums and counts
+    parts = []
+    reader = pd.read_csv(local_path(daily_src_path(year)),
+                         usecols=DAILY_COLUMNS,
+                         dtype={'State Code': str, 'County Code': str,
+                                'Site Num': str},
+                         # Event type 'None' is not missing
+                         keep_default_na=False, na_values=[''],
+                         chunksize=DAILY_CHUNK_ROWS)
+    for chunk in reader:
+        parts.append(_chunk_sums(chunk))
+    sums = pd.concat(parts)
+    del parts
+
+    sums = sums.groupby(level=['monitor_id', 'quarter']).agg(
+        {'total': 'sum', 'n': 'sum'})
+    if required is None:
+        required = required_day_count(year)
+    return _monitor_year(sums, year, required)
+
+
+def required_day_count(year: int) -> pd.Series:
+    """ Samples required of each PM2.5 monitor in `year`, per AQS """
+    df = monitors_annual_summary(year)
+    df = df[(df['parameter_code'] == 88101) &
+            (df['pollutant_standard'] == DAILY_STANDARD)]
+    return df.groupby('monitor_id')['required_day_count'].max()
+
+
+@profiled
+def _chunk_sums(chunk: pd.DataFrame) -> pd.DataFrame:
+    df = chunk[(chunk['Parameter Code'] == 88101) &
+               (chunk['Pollutant Standard'] == DAILY_STANDARD) &
+               (chunk['Event Type'].isin(DAILY_EVENT_TYPES)) &
+               (chunk['State Code'] != 'CC')]
+
+    sub = subset()
+    if sub is not None and sub.states is not None:
+        df = df[df['State Code'].str.zfill(2).isin(sub.states)]
+    elif sub is not None:
+        df = df[in_bbox(df['Longitude'], df['Latitude'], sub.bbox)]
+
+    date = pd.to_datetime(df['Date Local'])
+    monitor_id = (df['State Code'].str.zfill(2) +
+                  df['County Code'].str.zfill(3) + '_' +
+                  df['Site Num'].astype(int).astype(str) + '_' +
+                  df['Parameter Code'].astype(str) +
+                  df['POC'].astype(str))
+    df = pd.DataFrame({'monitor_id': monitor_id.values,
+                       'quarter': date.dt.quarter.values,
+                       'value': df['Arithmetic Mean'].values})
+    grouped = df.groupby(['monitor_id', 'quarter'])['value']
+    return pd.DataFrame({'total': grouped.sum(), 'n': grouped.count()})
+
+
+def _monitor_year(sums: pd.DataFrame, year: int,
+                  required: pd.Series) -> pd.DataFrame:
+    """ Appendix N annual mean and completeness from quarter sums """
+    n = sums['n'].unstack('quarter').reindex(columns=QUARTERS).fillna(0)
+    total = sums['total'].unstack('quarter').reindex(columns=QUARTERS)
+    n_year = n.sum(axis=1)
+
+    # Required schedule: days per required sample, snapped
+    year_days = 366 if calendar.isleap(year) else 365
+    with np.errstate(divide='ignore'):
+        per_sample = year_days / required.reindex(n.index).values
+    nearest = np.abs(per_sample[:, None] - SAMPLE_INTERVALS).argmin(axis=1)
+    interval = np.where(np.isfinite(per_sample), SAMPLE_INTERVALS[nearest],
+                        DEFAULT_SAMPLE_INTERVAL)
+
+    quarters = pd.PeriodIndex([f'{year}Q{q}' for q in QUARTERS], freq='Q')
+    quarter_days = np.asarray(
+        (quarters.end_time - quarters.start_time).days + 1)
+    scheduled = np.ceil(quarter_days[None, :] / interval[:, None])
+    completeness = np.minimum(n.values / scheduled, 1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        quarter_mean = total.values / n.values
+    df = pd.DataFrame({
+        'monitor_id': n.index.values,
+        'year': year,
+        'fips': n.index.str[:5],
+        'arithmetic_mean': np.nanmean(quarter_mean, axis=1),
+        'observation_count': n_year.values.astype(int),
+        'sample_interval': interval,
+    })
+    for i, q in enumerate(QUARTERS):
+        df[f'q{q}_completeness'] = completeness[:, i]
+    df['complete'] = (completeness >= QUARTER_COMPLETENESS).all(axis=1)
+
+    return df
+
+
+def _design_values(df: pd.DataFrame) -> pd.Series:
+    """ 3-year mean of complete annual means, by (monitor_id, year) """
+    means = (df[df['complete']]
+             .pivot(index='monitor_id', columns='year',
+                    values='arithmetic_mean')
+             .reindex(columns=range(df['year'].min(), df['year'].max() + 1)))
+    dv = means.T.rolling(3, min_periods=3).mean().T
+    dv = dv.stack()
+    dv.index.names = ['monitor_id', 'year']
+    return dv.rename('design_value')
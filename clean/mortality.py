@@ -1,11 +1,15 @@
 import pandas as pd
 
+from util.cache import memoized
 from util.env import src_path
+from util.mirror import open_read
 
 
+@memoized
 def mortality():
     """ https://wonder.cdc.gov/cmf-icd10.html """
-    df = pd.read_table(src_path('Compressed Mortality, 1999-2016.txt'))
+    with open_read(src_path('Compressed Mortality, 1999-2016.txt')) as f:
+        df = pd.read_table(f)
     df = df.rename(columns=lambda x: x.lower().replace(' ', '_'))
     df = df.rename(columns={'county_code': 'fips'})
 
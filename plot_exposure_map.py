@@ -0,0 +1,75 @@
+"""
+Map satellite PM2.5 over CONUS, or a region of it, from the exposure pyramid
+(`analysis/pyramid.py`), at the finest level with at most `MAP_PIXELS` cells
+over the map.
+
+    python plot_exposure_map.py --data msatna --year 2014 [--weight pop]
+        [--bbox -124,-114,32,42] [--save]
+"""
+import numpy as np
+
+from util.cache import enable_copy_on_write
+from util.env import out_path
+from util.subset import subset_cli
+from analysis.pyramid import (exposure_pyramid, pyramid_factor, level_window,
+                              regional_exposure)
+
+
+MAP_PIXELS = 1_000_000      # Roughly the cells a printed map can show
+
+
+def plot_exposure_map(data='msatna', year=2014, weight='area', bbox=None,
+                      ax=None):
+    import matplotlib.pyplot as plt
+
+    factor = pyramid_factor(bbox, max_cells=MAP_PIXELS)
+    level = exposure_pyramid(data, year, factor)
+    window, extent = level_window(level, bbox)
+    values = level[f'{weight}_weighted'][window]
+
+    if ax is None:
+        __, ax = plt.subplots(figsize=(10, 5))
+    im = ax.imshow(np.ma.masked_invalid(values), origin='lower',
+                   extent=extent, cmap='viridis', interpolation='nearest')
+    ax.set_aspect(1 / np.cos(np.radians((extent[2] + extent[3]) / 2)))
+    ax.set_xlabel("Longitude")
+    ax.set_ylabel("Latitude")
+    ax.set_title(f"{data} PM$_{{2.5}}$, {year} "
+                 f"({weight}-weighted, {level['step']:g}$^\\circ$ cells)")
+    plt.colorbar(im, ax=ax, shrink=.7, label="$\\mu g/m^3$")
+
+    return ax
+
+
+if __name__ == '__main__':
+    import argparse
+    subset_cli()
+    enable_copy_on_write()
+    opts = argparse.ArgumentParser()
+    opts.add_argument('--data', type=str, default='msatna',
+                      choices=['multisatpm', 'msatna'])
+    opts.add_argument('--year', type=int, default=2014)
+    opts.add_argument('--weight', type=str, default='area',
+                      choices=['area', 'pop'])
+    opts.add_argument('--bbox', type=str, default=None,
+                      help="xmin,xmax,ymin,ymax")
+    opts.add_argument('--save', action='store_true')
+    args = opts.parse_args()
+
+    bbox = (None if args.bbox is None
+            else tuple(float(v) for v in args.bbox.split(',')))
+
+    import matplotlib.pyplot as plt
+    ax = plot_exposure_map(args.data, args.year, args.weight, bbox)
+    if bbox is not None:
+        mean = regional_exposure(args.data, args.year, bbox, weight='pop')
+        print(f"Population-weighted mean: {mean:.2f}")
+
+    if args.save:
+        filepath = out_path(f'exposure_map_{args.data}_{args.year}.pdf')
+        plt.savefig(filepath, bbox_inches='tight', transparent=True)
+        plt.savefig(filepath.replace('.pdf', '.png'), bbox_inches='tight',
+                    dpi=400, transparent=True)
+        plt.close()
+    else:
+        plt.show()
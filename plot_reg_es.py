@@ -6,17 +6,20 @@ Monitoring Network"
 """
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import econtools.metrics as mt
-from econtools import legend_below, save_cli
 
 
+from util.cache import enable_copy_on_write
 from util.env import out_path
+from util.reg_cache import cached_reg
+from util.subset import subset_cli
 from analysis.monitor_sample import (constant_monitor_panel,
                                      prep_monitor_analysis,)
 
 
 if __name__ == "__main__":
+    subset_cli()
+    enable_copy_on_write()
+
     # Prep data
     rule = 'pm25_12'
     df = constant_monitor_panel(rule=rule)
@@ -36,9 +39,9 @@ if __name__ == "__main__":
          df.filter(like='_I').columns.tolist())
 
     # Event study regression
-    res = mt.reg(df, 'arithmetic_mean', X,
-                 a_name='monitor_id',
-                 cluster='monitor_id')
+    res = cached_reg(df, 'arithmetic_mean', X,
+                     a_name='monitor_id',
+                     cluster='monitor_id')
     print(res)
 
     # Plot event study coefficients
@@ -59,6 +62,9 @@ if __name__ == "__main__":
     ci_hi = ci_hi.sort_index()
     ci_lo = ci_lo.sort_index()
 
+    import matplotlib.pyplot as plt
+    from econtools import legend_below, save_cli
+
     fig, ax = plt.subplots()
     styles = dict(zip(z_vars, (
         {
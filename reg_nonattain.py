@@ -5,15 +5,19 @@ monitors using Difference-in-difference regressions.
 Table 4 in "Using Satellite Data to Fill the Gaps in the US Air Pollution
 Monitoring Network"
 """
-import econtools.metrics as mt
-from econtools import outreg, table_statrow, save_cli, write_notes
-
+from util.cache import enable_copy_on_write
 from util.env import out_path
+from util.profiling import profiled
+from util.reg_cache import cached_reg
+from util.subset import subset_cli
 from analysis.monitor_sample import (constant_monitor_panel,
                                      prep_monitor_analysis,)
 
 
+@profiled
 def main(rule='pm25_12', save=False):
+    from econtools import write_notes
+
     ols, ols_w_flag, df, _I = regs(rule=rule)
 
     table_str = make_table(ols, ols_w_flag, _I)
@@ -45,6 +49,7 @@ def main(rule='pm25_12', save=False):
     return ols, ols_w_flag
 
 
+@profiled
 def regs(rule='pm25_12'):
     df = constant_monitor_panel(rule=rule)
     df = prep_monitor_analysis(df, rule=rule)
@@ -53,22 +58,24 @@ def regs(rule='pm25_12'):
     _I = df.filter(like='_I').columns.tolist()
 
     # Naive OLS
-    ols = mt.reg(df, 'arithmetic_mean',
+    ols = cached_reg(df, 'arithmetic_mean',
                      ['nonattain_post'] + _I,
                      a_name='monitor_id',
                      cluster='monitor_id')
 
     # Diff-in-diff
     z_vars = ['targeted_post', 'untargeted_post']
-    ols_w_flag = mt.reg(df, 'arithmetic_mean',
-                        z_vars + _I,
-                        a_name='monitor_id',
-                        cluster='monitor_id')
+    ols_w_flag = cached_reg(df, 'arithmetic_mean',
+                            z_vars + _I,
+                            a_name='monitor_id',
+                            cluster='monitor_id')
 
     return ols, ols_w_flag, df, _I
 
 
 def make_table(ols, ols_w_flag, _I):
+    from econtools import outreg, table_statrow
+
     var_names = (
         'nonattain_post',
         'targeted_post',
@@ -89,4 +96,7 @@ def make_table(ols, ols_w_flag, _I):
 
 
 if __name__ == "__main__":
+    from econtools import save_cli
+    subset_cli()
+    enable_copy_on_write()
     ols, ols_w_flag, df, _I = main(save=save_cli())
@@ -0,0 +1,180 @@
+"""
+Long-running query server. Loads the block panels, monitor panel and
+regression results once, then answers small questions over local HTTP.
+
+    python serve.py [--port 8765] [--memo-mb 32768] [--subset 06]
+
+    GET  /excess_deaths?rule=pm25_12&data=msatna
+    GET  /misclass?year=2014&rule=pm25_12&data=msatna[&state=06][&threshold=]
+    GET  /regs?rule=pm25_12
+    GET  /health
+    POST /reload        drop everything held in memory and load it again
+
+Responses are JSON; add `profile=1` to a query to get its stage report.
+/health includes per-stage call counts and times since the server started.
+
+Everything is held in the `util.cache` memo tier, which re-reads a cache file
+once it is rebuilt on disk, so queries pick up new caches on their own. Use
+/reload after the external source data changes. Pandas copy-on-write is
+turned on, so handing out memoized frames doesn't copy them.
+"""
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+import util.cache
+from util import pm_naaqs_limit, profiling
+from util.cache import memo_clear, memo_stats
+from util.prefetch import gather
+from util.profiling import profiled
+from util.subset import subset_cli
+from analysis.sources import blocks_population
+from analysis.misclass import (misclass_cube, blocks_misclass_flag,
+                               _misclass_exposure_panel, MISCLASS_RULES,
+                               MISCLASS_DATA)
+from analysis.monitor_sample import monitors_summary_panel
+from analysis.naaqs_sweep import threshold_sweeps, misclass_at_threshold
+from clean.mortality import mortality
+from calc_mortality import excess_deaths, EXPOSURE_YEAR
+from reg_nonattain import regs
+
+
+DEFAULT_PORT = 8765
+DEFAULT_MEMO_MB = 32768
+
+
+@profiled
+def warm():
+    """ Load everything queries use into the memo tier """
+    gather((misclass_cube,),
+           (monitors_summary_panel,),
+           (blocks_population,),
+           (mortality,),
+           *[(_misclass_exposure_panel, data) for data in MISCLASS_DATA])
+    for rule in MISCLASS_RULES:
+        regs(rule=rule)
+        for data in MISCLASS_DATA:
+            blocks_misclass_flag(EXPOSURE_YEAR[rule], rule, data)
+            # Sorted exposures, so /misclass is a binary search per state
+            threshold_sweeps(rule, data)
+
+
+# Queries
+def query_excess_deaths(rule='pm25_12', data='msatna'):
+    stats, by_state, __ = excess_deaths(rule=rule, data=data)
+    return dict(stats, rule=rule, data=data,
+                by_state=by_state.reset_index().to_dict('records'))
+
+
+def query_misclass(year, rule='pm25_12', data='msatna', state=None,
+                   threshold=None):
+    year = int(year)
+    threshold = (pm_naaqs_limit[rule] if threshold is None
+                 else float(threshold))
+    df = misclass_at_threshold(year, rule, data, threshold)
+    if state is not None:
+        df = df.loc[[str(state).zfill(2)]]
+    return {'year': year, 'rule': rule, 'data': data, 'threshold': threshold,
+            'total': {col: df[col].sum() for col in df},
+            'by_state': df.reset_index().to_dict('records')}
+
+
+def query_regs(rule='pm25_12'):
+    ols, ols_w_flag, __, __ = regs(rule=rule)
+    return {name: {'N': res.N, 'r2': res.r2,
+                   'coeff': res.beta.to_dict(), 'se': res.se.to_dict()}
+            for name, res in (('ols', ols), ('ols_w_flag', ols_w_flag))}
+
+
+QUERIES = {
+    '/excess_deaths': query_excess_deaths,
+    '/misclass': query_misclass,
+    '/regs': query_regs,
+    '/health': lambda: {'status': 'ok', 'memo': memo_stats(),
+                        'stages': profiling.totals()},
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        show_profile = params.pop('profile', None) == '1'
+        if url.path not in QUERIES:
+            return self._send(404, {'error': f"No query {url.path}"})
+
+        profiling.reset()
+        start = time.perf_counter()
+        try:
+            with profiling.recording(show_profile):
+                out = QUERIES[url.path](**params)
+        except (KeyError, ValueError, TypeError) as e:
+            return self._send(400, {'error': repr(e)})
+        except Exception as e:
+            return self._send(500, {'error': repr(e)})
+
+        out = {'result': out, 'seconds': time.perf_counter() - start}
+        if show_profile:
+            out['profile'] = profiling.report_text()
+            profiling.reset()
+        self._send(200, out)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/reload':
+            return self._send(404, {'error': f"No action {self.path}"})
+        start = time.perf_counter()
+        memo_clear()
+        warm()
+        profiling.reset()
+        self._send(200, {'result': 'reloaded',
+                         'seconds': time.perf_counter() - start})
+
+    def _send(self, code, obj):
+        body = json.dumps(obj, default=_to_json).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _to_json(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+
+def main(port=DEFAULT_PORT, memo_mb=DEFAULT_MEMO_MB):
+    util.cache.MEMO_BUDGET_MB = memo_mb
+    util.cache.enable_copy_on_write()
+
+    start = time.perf_counter()
+    warm()
+    print(f"Warm in {time.perf_counter() - start:.1f}s, "
+          f"{memo_stats()['bytes'] / 2**20:.0f} MB held")
+    profiling.reset()
+
+    # One request at a time; each resets the profiling stages it reports
+    server = HTTPServer(('127.0.0.1', port), Handler)
+    print(f"Serving on http://127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    subset_cli()
+    opts = argparse.ArgumentParser()
+    opts.add_argument('--port', type=int, default=DEFAULT_PORT)
+    opts.add_argument('--memo-mb', type=float, default=DEFAULT_MEMO_MB)
+    args = opts.parse_args()
+
+    main(port=args.port, memo_mb=args.memo_mb)
@@ -10,6 +10,11 @@ pm_rule_xwalk = {1997: 'pm25_97',
                  2006: 'pm25_06',
                  2012: 'pm25_12'}
 
+# Annual PM2.5 standard (ug/m3) each rule was implemented under
+pm_naaqs_limit = {'pm25_97': 15,
+                  'pm25_06': 15,
+                  'pm25_12': 12}
+
 conus_bounds = (-126, -66, 24, 49.5)
 
 MONITOR_MAX_YEAR = 2017
@@ -0,0 +1,433 @@
+"""
+Disk cache for builder functions, with an in-process memo tier on top.
+
+`load_or_build` is a drop-in replacement for `econtools.load_or_build` that
+reports every call to `util.profiling` as a stage, with cache hit/miss and
+bytes read/written.
+
+Objects loaded or built through `load_or_build` (and returned by functions
+decorated with `memoized`) are also kept in memory for the life of the
+process, so repeat calls skip unpickling. Entries are evicted least recently
+used first once they add up to more than `MONCOV_MEMO_MB` megabytes (default
+4096; 0 turns the memo tier off). A memoized file is re-read if it changes on
+disk.
+
+Callers get a copy of memoized pandas objects, so they can't corrupt them.
+Under pandas copy-on-write (pandas >= 1.5) that's a shallow copy that copies a
+column only when it's written to, so a hit costs next to nothing; otherwise
+it's a deep copy. Importing this module doesn't change pandas' settings: the
+top-level scripts call `enable_copy_on_write` themselves. Numpy arrays are
+returned as read-only views, and dicts, lists and tuples are rebuilt around
+protected items. Any other object (e.g. an `econtools` Results) is shared
+between callers and must not be modified.
+
+Reads go through the local mirror in `util.mirror` when it is on. Under a
+state or bounding-box subset (`util.subset`), files are kept apart from the
+full-scale ones.
+
+Builds are safe to run concurrently, from threads or separate processes. A
+builder holds `<file>.lock` while it runs; anyone else who misses on the same
+file waits for the lock and then reads what the builder wrote. Files are
+written to a temporary name and renamed into place, so readers never see a
+half-written pickle. A lock left behind by a dead process on this host is
+cleared automatically; delete it by hand if the builder died on another host.
+"""
+import inspect
+import json
+import os
+import pickle
+import socket
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+
+import numpy as np
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from util.mirror import open_read
+from util.profiling import stage, _rows
+from util.subset import namespaced
+
+
+MEMO_BUDGET_MB = float(os.environ.get('MONCOV_MEMO_MB', 4096))
+
+_memo = OrderedDict()    # key -> (obj, nbytes, file signature)
+_memo_lock = threading.Lock()
+_memo_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+
+
+def enable_copy_on_write():
+    """
+    Turn on pandas copy-on-write, if this pandas has it, so memo hits are
+    cheap. It changes assignment semantics process-wide, so only entry points
+    should call it.
+    """
+    try:
+        pd.set_option('mode.copy_on_write', True)
+    except KeyError:    # pandas < 1.5
+        pass
+
+
+LOCK_POLL_MAX_S = 2.
+LOCK_BREAK_S = 30.      # a `.break` file older than this was left by a crash
+
+
+def load_or_build(raw_filepath, path_args=[]):
+    """
+    Load the output of the decorated function from `raw_filepath` if the file
+    exists, otherwise build it and save it there.
+
+    `raw_filepath` is formatted with the arguments listed in `path_args` (by
+    position or name) or, if `path_args` is empty, with all of the function's
+    arguments by name. Pass `_rebuild=True` to force a build and `_load=False`
+    to skip reading a file that already exists. `func.cache_path(*args,
+    **kwargs)` is the file a call would use.
+    """
+    def decorator(builder):
+        signature = inspect.signature(builder)
+        stage_name = f'{builder.__module__}.{builder.__name__}'
+
+        @wraps(builder)
+        def wrapper(*args, **kwargs):
+            rebuild = kwargs.pop('_rebuild', False)
+            load = kwargs.pop('_load', True)
+            filepath = namespaced(_format_path(raw_filepath, path_args,
+                                               signature, args, kwargs))
+
+            with stage(stage_name) as st:
+                if load and not rebuild:
+                    out = memo_get(filepath, _file_signature(filepath))
+                    if out is not None:
+                        st.cache = 'memo'
+                        st.rows_out = _rows(out)
+                        return out
+
+                if os.path.isfile(filepath) and not rebuild:
+                    st.cache = 'hit'
+                    if not load:
+                        return None
+                    st.bytes_read = os.path.getsize(filepath)
+                    out = read(filepath)
+                    st.rows_out = _rows(out)
+                else:
+                    before = _file_signature(filepath)
+                    with build_lock(filepath):
+                        after = _file_signature(filepath)
+                        if after is not None and after != before:
+                            # Someone else built it while we waited
+                            st.cache = 'hit'
+                            if not load:
+                                return None
+                            st.bytes_read = after[1]
+                            out = read(filepath)
+                        else:
+                            st.cache = 'miss'
+                            print(f"****** Building *******\n"
+                                  f"\tfile: {filepath}\n"
+                                  f"\tfunc: {builder.__name__}\n"
+                                  f"*************")
+                            out = builder(*args, **kwargs)
+                            write(out, filepath)
+                            st.bytes_written = os.path.getsize(filepath)
+                    st.rows_out = _rows(out)
+
+            file_sig = _file_signature(filepath)
+            return memo_put(filepath, out, file_sig, nbytes=file_sig[1])
+
+        def cache_path(*args, **kwargs):
+            return namespaced(_format_path(raw_filepath, path_args,
+                                           signature, args, kwargs))
+
+        wrapper.cache_path = cache_path
+        return wrapper
+
+    return decorator
+
+
+def memoized(func):
+    """
+    Keep `func`'s return values in the memo tier, keyed by its arguments.
+    For loaders without their own `load_or_build` file.
+    """
+    stage_name = f'{func.__module__}.{func.__name__}'
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (stage_name, args, tuple(sorted(kwargs.items())))
+        with stage(stage_name) as st:
+            out = memo_get(key)
+            if out is not None:
+                st.cache = 'memo'
+            else:
+                st.cache = 'miss'
+                out = func(*args, **kwargs)
+                out = memo_put(key, out)
+            st.rows_out = _rows(out)
+        return out
+
+    return wrapper
+
+
+def _format_path(raw_filepath, path_args, signature, args, kwargs):
+    bound = signature.bind(*args, **kwargs)
+    bound.apply_defaults()
+    if path_args:
+        arg_values = list(bound.arguments.values())
+        fmt_args = [arg_values[a] if isinstance(a, int) else bound.arguments[a]
+                    for a in path_args]
+        return raw_filepath.format(*fmt_args)
+    else:
+        return raw_filepath.format(**bound.arguments)
+
+
+def read(filepath):
+    if not filepath.endswith('.pkl'):
+        raise ValueError(f"Unsupported cache format: {filepath}")
+    with open_read(filepath) as f:
+        return pd.read_pickle(f)
+
+
+def write(obj, filepath):
+    """ Write `obj` to a temporary file and rename it to `filepath` """
+    if not filepath.endswith('.pkl'):
+        raise ValueError(f"Unsupported cache format: {filepath}")
+    tmp = f'{filepath}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            if isinstance(obj, (pd.DataFrame, pd.Series)):
+                obj.to_pickle(f)
+            else:
+                pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filepath)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+@contextmanager
+def build_lock(filepath, wait=True):
+    """
+    Hold `<filepath>.lock` for the enclosed block, waiting for whoever holds
+    it now (another thread or process) to finish. With `wait=False`, don't
+    wait: yields False at once if the lock is held, else True.
+    """
+    lock_path = filepath + '.lock'
+    owner = json.dumps({'host': socket.gethostname(), 'pid': os.getpid(),
+                        'thread': threading.get_ident()})
+    delay = .05
+    waiting = False
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            holder = _lock_holder(lock_path)
+            if holder is not None and _is_stale(holder):
+                _break_stale(lock_path, holder)
+                continue
+            if not wait:
+                yield False
+                return
+            if not waiting:
+                print(f"Waiting for {lock_path} (held by {holder})")
+                waiting = True
+            time.sleep(delay)
+            delay = min(delay * 2, LOCK_POLL_MAX_S)
+            continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(owner)
+        break
+
+    try:
+        yield True
+    finally:
+        # Only our own lock; never one taken after ours was broken
+        if _lock_holder(lock_path) == json.loads(owner):
+            _remove(lock_path)
+
+
+def _break_stale(lock_path, holder):
+    """
+    Remove `lock_path` if it still names `holder`, a dead process. Waiters
+    that saw the same dead holder take turns under `<lock_path>.break`, so
+    only the first removes it; the rest find the lock it took since.
+    """
+    break_path = lock_path + '.break'
+    try:
+        fd = os.open(break_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        # Someone is breaking it now; one that died doing so is cleared
+        try:
+            if time.time() - os.path.getmtime(break_path) > LOCK_BREAK_S:
+                _remove(break_path)
+        except FileNotFoundError:
+            pass
+        time.sleep(.01)
+        return
+    os.close(fd)
+    try:
+        if _lock_holder(lock_path) == holder:
+            _remove(lock_path)
+    finally:
+        _remove(break_path)
+
+
+def _lock_holder(lock_path):
+    try:
+        with open(lock_path) as f:
+            return json.load(f)
+    except (OSError, ValueError):   # Gone, or still being written
+        return None
+
+
+def _is_stale(holder):
+    """ True if the lock's owner was a process on this host that is gone """
+    if holder.get('host') != socket.gethostname():
+        return False
+    pid = holder.get('pid')
+    if psutil is not None:
+        return not psutil.pid_exists(pid)
+    if os.name == 'nt':     # os.kill(pid, 0) would kill it
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        pass
+    return False
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Memo tier
+def memo_get(key, file_signature=None):
+    """ Copy of the memoized object under `key`, None if absent or stale """
+    with _memo_lock:
+        entry = _memo.get(key)
+        if entry is None:
+            _memo_stats['misses'] += 1
+            return None
+        obj, nbytes, signature = entry
+        if signature != file_signature:
+            # File was rebuilt or removed since we memoized it
+            del _memo[key]
+            _memo_stats['bytes'] -= nbytes
+            _memo_stats['misses'] += 1
+            return None
+        _memo.move_to_end(key)
+        _memo_stats['hits'] += 1
+    return _protect(obj)
+
+
+def memo_put(key, obj, file_signature=None, nbytes=None):
+    """ Memoize `obj` under `key` and return a copy safe to hand out """
+    budget = MEMO_BUDGET_MB * 2 ** 20
+    if obj is None or budget <= 0:
+        return obj
+    nbytes = max(_nbytes(obj), nbytes or 0)
+    if nbytes > budget:
+        return obj
+
+    if isinstance(obj, np.ndarray):
+        obj = obj.view()
+        obj.flags.writeable = False
+
+    with _memo_lock:
+        old = _memo.pop(key, None)
+        if old is not None:
+            _memo_stats['bytes'] -= old[1]
+        _memo[key] = (obj, nbytes, file_signature)
+        _memo_stats['bytes'] += nbytes
+        while _memo_stats['bytes'] > budget:
+            __, (__, old_bytes, __) = _memo.popitem(last=False)
+            _memo_stats['bytes'] -= old_bytes
+            _memo_stats['evictions'] += 1
+
+    return _protect(obj)
+
+
+def memo_clear():
+    with _memo_lock:
+        _memo.clear()
+        _memo_stats['bytes'] = 0
+
+
+def memo_stats() -> dict:
+    with _memo_lock:
+        return dict(_memo_stats, entries=len(_memo))
+
+
+def _protect(obj):
+    """ What callers get for memoized `obj`; see the module docstring """
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return obj.copy(deep=not _copy_on_write())
+    elif isinstance(obj, np.ndarray):
+        view = obj.view()
+        view.flags.writeable = False
+        return view
+    elif type(obj) is dict:
+        return {k: _protect(v) for k, v in obj.items()}
+    elif type(obj) in (list, tuple):
+        return type(obj)(_protect(v) for v in obj)
+    else:
+        return obj
+
+
+def _copy_on_write():
+    try:
+        return pd.get_option('mode.copy_on_write') is True
+    except KeyError:    # pandas < 1.5
+        return False
+
+
+def _nbytes(obj):
+    if isinstance(obj, pd.DataFrame):
+        return (_values_nbytes(obj.index) +
+                sum(_values_nbytes(col) for __, col in obj.items()))
+    elif isinstance(obj, pd.Series):
+        return _values_nbytes(obj.index) + _values_nbytes(obj)
+    elif isinstance(obj, np.ndarray):
+        return obj.nbytes
+    elif type(obj) is dict:
+        return sum(_nbytes(v) for v in obj.values())
+    elif type(obj) in (list, tuple):
+        return sum(_nbytes(v) for v in obj)
+    return 0
+
+
+def _values_nbytes(values):
+    """ Bytes held by an Index or Series, with the strings in it """
+    if isinstance(values, pd.MultiIndex):
+        return (sum(_values_nbytes(level) for level in values.levels) +
+                sum(codes.nbytes for codes in values.codes))
+    elif isinstance(values.dtype, pd.CategoricalDtype):
+        return (values.array.codes.nbytes +
+                _values_nbytes(values.dtype.categories))
+    elif values.dtype == object:
+        # As `memory_usage(deep=True)`, which fails on the read-only arrays
+        # copy-on-write hands out
+        arr = np.asarray(values)
+        return arr.nbytes + sum(map(sys.getsizeof, arr))
+    return int(values.array.nbytes)
+
+
+def _file_signature(filepath):
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
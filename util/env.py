@@ -1,36 +1,94 @@
+"""
+Where data and output live.
+
+Paths are resolved on first use, not at import. Each root is taken from, in
+order: an environment variable, the `[paths]` section of the config file
+(`MONCOV_CONFIG`, default `~/.moncov.cfg`), and finally the machine we're on.
+
+    Setting         Env variable            Config key
+    data root       MONCOV_DATA_ROOT        data_root
+    Dropbox root    MONCOV_DROPBOX_ROOT     dropbox_root
+    output root     MONCOV_OUT_ROOT         out_root
+    local mirror    MONCOV_MIRROR_ROOT      mirror_root
+
+The local mirror (see `util.mirror`) is on by default only when data is read
+over the network; set its root to "off" to turn it off.
+
+The old module-level names (`DATA_PATH`, `OUT_PATH_ROOT`, ...) still work.
+"""
 import os
-import socket
 import datetime
+from functools import lru_cache
+
+
+CONFIG_PATH = os.path.join(os.path.expanduser('~'), '.moncov.cfg')
+
+
+@lru_cache(maxsize=None)
+def _config() -> dict:
+    from configparser import ConfigParser
+    path = os.environ.get('MONCOV_CONFIG', CONFIG_PATH)
+    parser = ConfigParser()
+    parser.read(path)
+    return dict(parser['paths']) if parser.has_section('paths') else {}
+
 
+def _setting(name: str, default):
+    value = (os.environ.get('MONCOV_' + name.upper()) or
+             _config().get(name))
+    return value if value else default()
 
-# Check which machine we're on
-HOST = socket.gethostname()
-# Dan's
-if HOST in ('sullivan-7d', 'sullivan-10d'):
-    data_root = "D:\\"
-    dropbox_root = os.path.join('c:\\users', 'sullivan', 'dropbox')
-# Mark's
-elif HOST == 'nepf-7d':
-    data_root = "M:\\EPA_AirPollution\\"
-    dropbox_root = os.path.join('C:\\Users', 'nepf', 'Dropbox')
-# Fall back to Dan's computer over the network
-else:
-    data_root = r'\\Sullivan-10d\d'
 
+@lru_cache(maxsize=None)
+def _host_roots() -> tuple:
+    """ (data_root, dropbox_root) for the machine we're on """
+    import socket
+    host = socket.gethostname()
+    # Dan's
+    if host in ('sullivan-7d', 'sullivan-10d'):
+        return "D:\\", os.path.join('c:\\users', 'sullivan', 'dropbox')
+    # Mark's
+    elif host == 'nepf-7d':
+        return ("M:\\EPA_AirPollution\\",
+                os.path.join('C:\\Users', 'nepf', 'Dropbox'))
+    # Fall back to Dan's computer over the network
+    else:
+        return (r'\\Sullivan-10d\d',
+                os.path.join(os.path.expanduser('~'), 'Dropbox'))
 
-GIS_SRC_PATH = os.path.join(data_root, 'Data', 'gis')
 
-DATA_PATH = os.path.join(data_root, 'Data', 'mon-coverage')
+def _data_root() -> str:
+    return _setting('data_root', lambda: _host_roots()[0])
 
 
-now = datetime.datetime.now()
-out_month = str(now.year)[-2:] + str(now.month).zfill(2)
-OUT_PATH_ROOT = os.path.join(dropbox_root, 'research', 'mon-coverage', 'out')
-OUT_PATH_MONTH = os.path.join(OUT_PATH_ROOT, out_month)
+def _dropbox_root() -> str:
+    return _setting('dropbox_root', lambda: _host_roots()[1])
+
+
+def _out_path_root() -> str:
+    return _setting('out_root', lambda: os.path.join(
+        _dropbox_root(), 'research', 'mon-coverage', 'out'))
+
+
+def mirror_root() -> str:
+    """ Local mirror directory for `data_path` reads, '' if not mirroring """
+    def default():
+        if _data_root().startswith('\\\\'):      # UNC network path
+            return os.path.join(os.path.expanduser('~'), '.cache',
+                                'moncov-mirror')
+        return ''
+    root = _setting('mirror_root', default)
+    return '' if root == 'off' else root
+
+
+def _out_path_month() -> str:
+    now = datetime.datetime.now()
+    out_month = str(now.year)[-2:] + str(now.month).zfill(2)
+    return os.path.join(_out_path_root(), out_month)
 
 
 def data_path(*args):
-    return os.path.join(DATA_PATH, *args)
+    return os.path.join(_data_root(), 'Data', 'mon-coverage', *args)
 
 
 def src_path(*args):
@@ -38,10 +96,29 @@ def src_path(*args):
 
 
 def gis_src_path(*args):
-    return os.path.join(GIS_SRC_PATH, *args)
+    return os.path.join(_data_root(), 'Data', 'gis', *args)
 
 
 def out_path(*args):
-    if not os.path.isdir(OUT_PATH_ROOT) and os.path.isdir(OUT_PATH_MONTH):
-        os.makedirs(OUT_PATH_MONTH)
-    return os.path.join(OUT_PATH_MONTH, *args)
+    out_root, out_month = _out_path_root(), _out_path_month()
+    if not os.path.isdir(out_root) and os.path.isdir(out_month):
+        os.makedirs(out_month)
+    return os.path.join(out_month, *args)
+
+
+def __getattr__(name):
+    """ Resolve the old module-level constants on demand """
+    if name == 'HOST':
+        import socket
+        return socket.gethostname()
+    lazy = {
+        'data_root': _data_root,
+        'dropbox_root': _dropbox_root,
+        'GIS_SRC_PATH': gis_src_path,
+        'DATA_PATH': data_path,
+        'OUT_PATH_ROOT': _out_path_root,
+        'OUT_PATH_MONTH': _out_path_month,
+    }
+    if name in lazy:
+        return lazy[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,227 @@
+"""
+Local read-through mirror of files under the data root.
+
+When `util.env.mirror_root()` is set (by default only when the data root is
+a network share), the first read of a file copies it to local disk and later
+reads use the local copy for as long as the remote file's mtime and size are
+unchanged. Local copies are compressed with a fast codec (zstd if the
+`zstandard` package is installed, else lz4 with `lz4`, else none), chosen per
+file by `codec_for`; files read by memory map, like parquet, are kept raw.
+Copies are evicted least recently used first once the mirror is over
+`MONCOV_MIRROR_GB` (default 100). Each process keeps a running total of what
+it has copied and only walks the mirror once that is over budget. A copy
+that is being written, or was used in the last `EVICT_MIN_AGE_S` seconds,
+is never evicted.
+"""
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+from util.env import mirror_root
+
+
+MIRROR_BUDGET_GB = float(os.environ.get('MONCOV_MIRROR_GB', 100))
+COPY_CHUNK = 16 * 2 ** 20
+EVICT_MIN_AGE_S = 60
+
+# (filename pattern, codec, level); first match wins
+CODEC_RULES = [
+    ('*.parquet', 'none', None),    # memory-mapped, already compressed
+    ('*.pkl', 'auto', None),
+    ('*', 'auto', None),
+]
+DEFAULT_LEVELS = {'zstd': 3, 'lz4': 0}
+
+_mirror_bytes = None     # Size at the last walk plus copies since
+_size_lock = threading.Lock()
+
+
+@contextmanager
+def open_read(remote_path: str):
+    """ Binary file object for `remote_path`, through the mirror if on """
+    if not mirror_root():
+        with open(remote_path, 'rb') as f:
+            yield f
+        return
+
+    local, codec = _mirrored(remote_path)
+    try:
+        f = open(local, 'rb')
+    except FileNotFoundError:   # Evicted since we checked it
+        local, codec = _mirrored(remote_path)
+        f = open(local, 'rb')
+    with f:
+        if codec == 'zstd':
+            import zstandard
+            with zstandard.ZstdDecompressor().stream_reader(
+                    f, read_size=COPY_CHUNK) as reader:
+                yield reader
+        elif codec == 'lz4':
+            import lz4.frame
+            with lz4.frame.open(f, 'rb') as reader:
+                yield reader
+        else:
+            yield f
+
+
+def local_path(remote_path: str) -> str:
+    """ Path to an uncompressed local copy (e.g. to memory map), or remote """
+    if not mirror_root():
+        return remote_path
+    local, __ = _mirrored(remote_path, codec='none')
+    return local
+
+
+def codec_for(remote_path: str):
+    """ (codec, level) used to mirror `remote_path` """
+    name = os.path.basename(remote_path)
+    for pattern, codec, level in CODEC_RULES:
+        if fnmatch.fnmatch(name, pattern):
+            break
+    if codec == 'auto':
+        codec = _best_codec()
+    return codec, DEFAULT_LEVELS.get(codec) if level is None else level
+
+
+def _mirrored(remote_path, codec=None):
+    """ Local copy of `remote_path`, refreshed if the remote changed """
+    from util.cache import build_lock   # `util.cache` reads through here
+
+    st = os.stat(remote_path)
+    codec, level = codec_for(remote_path) if codec is None else (codec, None)
+    local = _local_name(remote_path, codec)
+    if _is_current(local, st):
+        try:
+            os.utime(local)     # Mark as recently used
+            return local, codec
+        except FileNotFoundError:   # Evicted since we checked it
+            pass
+
+    os.makedirs(os.path.dirname(local), exist_ok=True)
+    # One copier per file; the rest wait and use its copy
+    with build_lock(local):
+        if _is_current(local, st):
+            return local, codec
+        tmp = f'{local}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(remote_path, 'rb') as src, open(tmp, 'wb') as dst:
+            _copy(src, dst, codec, level)
+        os.replace(tmp, local)
+        with open(tmp, 'w') as f:
+            json.dump({'remote': remote_path, 'mtime_ns': st.st_mtime_ns,
+                       'size': st.st_size, 'codec': codec}, f)
+        os.replace(tmp, local + '.meta')
+    _added(os.path.getsize(local), keep=local)
+
+    return local, codec
+
+
+def _is_current(local, st):
+    """ Whether `local` is a copy of the remote file whose stat is `st` """
+    try:
+        with open(local + '.meta') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return (os.path.isfile(local) and meta['mtime_ns'] == st.st_mtime_ns and
+            meta['size'] == st.st_size)
+
+
+def _copy(src, dst, codec, level):
+    if codec == 'zstd':
+        import zstandard
+        zstandard.ZstdCompressor(level=level, threads=-1).copy_stream(
+            src, dst, read_size=COPY_CHUNK)
+    elif codec == 'lz4':
+        import lz4.frame
+        with lz4.frame.open(dst, 'wb', compression_level=level) as out:
+            shutil.copyfileobj(src, out, COPY_CHUNK)
+    elif codec == 'none':
+        shutil.copyfileobj(src, dst, COPY_CHUNK)
+    else:
+        raise ValueError(f"Unknown codec: {codec}")
+
+
+def _local_name(remote_path, codec):
+    digest = hashlib.blake2b(os.path.abspath(remote_path).encode(),
+                             digest_size=8).hexdigest()
+    name = f'{digest}_{os.path.basename(remote_path)}'
+    if codec != 'none':
+        name += '.' + codec
+    return os.path.join(mirror_root(), digest[:2], name)
+
+
+def _added(nbytes, keep=None):
+    """ Count a new copy; evict if the mirror may now be over budget """
+    global _mirror_bytes
+    with _size_lock:
+        if _mirror_bytes is not None:
+            _mirror_bytes += nbytes
+            if _mirror_bytes <= MIRROR_BUDGET_GB * 2 ** 30:
+                return
+    _evict(keep=keep)
+
+
+def _evict(keep=None):
+    """ Drop least recently used copies until under budget """
+    from util.cache import build_lock
+
+    global _mirror_bytes
+    budget = MIRROR_BUDGET_GB * 2 ** 30
+    entries = []
+    for dirpath, __, filenames in os.walk(mirror_root()):
+        for name in filenames:
+            if name.endswith(('.meta', '.tmp', '.lock', '.break')):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:   # Another process evicted it
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for __, size, __ in entries)
+    recent = time.time() - EVICT_MIN_AGE_S
+    for mtime, size, path in sorted(entries):
+        if total <= budget or mtime > recent:
+            break
+        if path == keep:
+            continue
+        # Skip copies being written now
+        with build_lock(path, wait=False) as locked:
+            if not locked:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:     # e.g. open by a reader on Windows
+                continue
+            _remove_quietly(path + '.meta')
+        total -= size
+
+    with _size_lock:
+        _mirror_bytes = total
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+@lru_cache(maxsize=None)
+def _best_codec():
+    for codec, module in (('zstd', 'zstandard'), ('lz4', 'lz4.frame')):
+        try:
+            __import__(module)
+            return codec
+        except ImportError:
+            pass
+    return 'none'
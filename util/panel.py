@@ -0,0 +1,101 @@
+"""
+Build a (rows x years) panel one column at a time.
+
+`pd.concat(list_of_years, axis=1)` holds every year's frame and the result at
+once, and aligns every index against every other. `PanelBuilder` allocates
+the output once and writes each column into place as it is produced, aligning
+it against the panel's index with one `get_indexer`; the caller can drop each
+year's frame as soon as it's added. Peak memory is about the final panel.
+
+The index is given up front or taken from the first column added. Rows that a
+later column brings are appended (the rows the other columns don't have are
+NaN, as with an outer concat), which costs a reallocation, so give the full
+index when it's known.
+
+The dtype, unless given, is the first column's (promoted to float, to hold
+NaN), so float32 surfaces make a float32 panel; a later, wider column widens
+the panel.
+
+With `memmap=True` (default from `MONCOV_PANEL_MEMMAP`) the panel is backed
+by an anonymous temporary file rather than memory, for panels near the size
+of RAM.
+"""
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+PANEL_MEMMAP = bool(int(os.environ.get('MONCOV_PANEL_MEMMAP', 0)))
+
+
+class PanelBuilder(object):
+
+    def __init__(self, columns, index: pd.Index=None, dtype=None,
+                 memmap: bool=None):
+        self.columns = pd.Index(columns)
+        self.index = index
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        self.memmap = PANEL_MEMMAP if memmap is None else memmap
+        self._values = None     # (columns x rows), so columns are contiguous
+        if index is not None and self.dtype is not None:
+            self._values = self._alloc(len(index))
+
+    def add(self, column, values: pd.Series):
+        """ Write `values` (indexed like the panel) as `column` """
+        j = self.columns.get_loc(column)
+        dtype = np.promote_types(values.dtype, np.float32)     # holds NaN
+        if self.dtype is None:
+            self.dtype = dtype
+        else:
+            dtype = np.promote_types(self.dtype, dtype)
+            if dtype != self.dtype:
+                self._widen(dtype)
+        if self.index is None:
+            self.index = values.index
+        if self._values is None:
+            self._values = self._alloc(len(self.index))
+        if values.index.equals(self.index):
+            self._values[j] = values.values
+            return
+
+        pos = self.index.get_indexer(values.index)
+        new = pos < 0
+        if new.any():
+            self._grow(values.index[new])
+            pos[new] = np.arange(len(self.index) - new.sum(), len(self.index))
+        self._values[j, pos] = values.values
+
+    def frame(self) -> pd.DataFrame:
+        """ The panel; a view on the builder's array, not a copy """
+        if self._values is None:
+            return pd.DataFrame(index=self.index, columns=self.columns,
+                                dtype=self.dtype or np.float64)
+        return pd.DataFrame(self._values.T, index=self.index,
+                            columns=self.columns, copy=False)
+
+    def _alloc(self, n_rows):
+        shape = (len(self.columns), n_rows)
+        if self.memmap:
+            out = np.memmap(tempfile.TemporaryFile(prefix='moncov-panel-'),
+                            dtype=self.dtype, mode='w+', shape=shape)
+        else:
+            out = np.empty(shape, dtype=self.dtype)
+        out.fill(np.nan)
+        return out
+
+    def _widen(self, dtype):
+        old = self._values
+        self.dtype = dtype
+        if old is not None:
+            self._values = self._alloc(old.shape[1])
+            self._values[:] = old
+            del old
+
+    def _grow(self, new_index):
+        old = self._values
+        self.index = self.index.append(new_index)
+        self._values = self._alloc(len(self.index))
+        self._values[:, :old.shape[1]] = old
+        del old
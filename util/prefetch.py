@@ -0,0 +1,82 @@
+"""
+Background loading of independent inputs.
+
+Loads run on a shared pool of `MONCOV_IO_WORKERS` threads (default 4; 0 runs
+everything in the calling thread). Reading pickles and parquet releases the
+GIL for most of its time, so this mostly pays off when `data_root` is a
+network share and we'd otherwise wait on I/O.
+
+`gather` starts several independent loads at once and waits for all of them.
+`prefetch_map` loads the items of a sequence in order, keeping the next ones
+in flight while the caller works on the current one.
+
+Stages recorded on a worker are filed under the stage that started the load,
+so profiling reports keep their nesting.
+"""
+import itertools
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from util.profiling import current_stage, attach
+
+
+IO_WORKERS = int(os.environ.get('MONCOV_IO_WORKERS', 4))
+
+_pool = None
+_pool_lock = threading.Lock()
+_worker = threading.local()
+
+
+def prefetch(func, *args, **kwargs) -> Future:
+    """ Start `func(*args, **kwargs)` in the background """
+    parent = current_stage()
+    # Loads started by a worker run in place, so nested loads can't deadlock
+    if IO_WORKERS <= 0 or getattr(_worker, 'busy', False):
+        future = Future()
+        try:
+            future.set_result(func(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+    return _get_pool().submit(_run, parent, func, args, kwargs)
+
+
+def gather(*calls) -> list:
+    """
+    Run independent loads concurrently and return their results in order.
+    Each call is `(func, arg1, arg2, ...)`, e.g.
+    `gather((block_has_monitor, year), (blocks_population,))`.
+    """
+    futures = [prefetch(call[0], *call[1:]) for call in calls]
+    return [f.result() for f in futures]
+
+
+def prefetch_map(func, items, ahead: int=1):
+    """ Yield `func(item)` for each item, loading `ahead` items in advance """
+    items = iter(items)
+    pending = deque(prefetch(func, item)
+                    for item in itertools.islice(items, ahead + 1))
+    while pending:
+        yield pending.popleft().result()
+        for item in itertools.islice(items, 1):
+            pending.append(prefetch(func, item))
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=IO_WORKERS,
+                                       thread_name_prefix='moncov-io')
+        return _pool
+
+
+def _run(parent, func, args, kwargs):
+    _worker.busy = True
+    try:
+        with attach(parent):
+            return func(*args, **kwargs)
+    finally:
+        _worker.busy = False
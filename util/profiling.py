@@ -0,0 +1,363 @@
+"""
+Stage-level profiling.
+
+Functions wrapped with `profiled` (and every `util.cache.load_or_build`
+builder) record wall time, CPU time, memory, rows in/out and cache activity
+for each call. Calls nest, so a run produces a tree of stages. Memory is the
+change in current RSS over the stage (`rss_growth`, negative if it freed
+more than it kept) and the process's peak RSS so far when it ended
+(`rss_peak`); the peak is for the whole process, not the stage.
+
+Timing is always on; it costs some microseconds per stage. By default only
+per-name totals are kept (`totals`), so memory doesn't grow with the number
+of calls. Set the environment variable `MONCOV_PROFILE` to keep the full tree
+and get a report when the process exits: `MONCOV_PROFILE=1` prints a text
+report to stderr, any other value is used as a path prefix for
+`<prefix>.txt`, `<prefix>.json` (nested stages) and `<prefix>.trace.json`
+(Chrome/Perfetto trace events). `recording` keeps the tree for one block.
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+_local = threading.local()
+_lock = threading.Lock()
+_roots = []
+_totals = {}
+_keep_tree = bool(os.environ.get('MONCOV_PROFILE'))
+_t0 = time.perf_counter()
+_process = None
+_report = True
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+class Stage(object):
+    """ One timed call; `children` are stages started while this one ran """
+
+    __slots__ = ('name', 'children', 'start', 'wall', 'cpu', 'rss_peak',
+                 'rss', 'rss_growth', 'rows_in', 'rows_out', 'cache',
+                 'bytes_read', 'bytes_written', 'thread')
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.children = []
+        self.start = 0.
+        self.wall = 0.
+        self.cpu = 0.
+        self.rss_peak = None
+        self.rss = None
+        self.rss_growth = None
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.cache = None
+        self.bytes_read = None
+        self.bytes_written = None
+        self.thread = threading.get_ident()
+
+    def to_dict(self):
+        out = {k: getattr(self, k) for k in self.__slots__
+               if k not in ('children', 'thread')}
+        out['children'] = [c.to_dict() for c in self.children]
+        return out
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    """ Time the enclosed block as stage `name`; yields the `Stage` """
+    st = Stage(name, rows_in=rows_in)
+    stack = _stack()
+    if _keep_tree:
+        if stack:
+            stack[-1].children.append(st)
+        else:
+            with _lock:
+                _roots.append(st)
+    stack.append(st)
+
+    rss0 = _current_rss()
+    cpu0 = time.process_time()
+    st.start = time.perf_counter()
+    try:
+        yield st
+    finally:
+        st.wall = time.perf_counter() - st.start
+        st.cpu = time.process_time() - cpu0
+        st.rss_peak = _peak_rss()
+        st.rss = _current_rss()
+        if rss0 is not None and st.rss is not None:
+            st.rss_growth = st.rss - rss0
+        stack.pop()
+        _add_to_totals(st)
+
+
+@contextmanager
+def recording(on=True):
+    """ Keep the full stage tree inside this block (a no-op if not `on`) """
+    global _keep_tree
+    saved = _keep_tree
+    _keep_tree = saved or on
+    try:
+        yield
+    finally:
+        _keep_tree = saved
+
+
+def _add_to_totals(st):
+    with _lock:
+        tot = _totals.get(st.name)
+        if tot is None:
+            tot = _totals[st.name] = {'calls': 0, 'wall': 0., 'cpu': 0.,
+                                      'hits': 0, 'misses': 0,
+                                      'bytes_read': 0}
+        tot['calls'] += 1
+        tot['wall'] += st.wall
+        tot['cpu'] += st.cpu
+        tot['hits'] += st.cache in ('hit', 'memo')
+        tot['misses'] += st.cache == 'miss'
+        tot['bytes_read'] += st.bytes_read or 0
+
+
+def profiled(func=None, name=None):
+    """
+    Decorator that runs each call of `func` as a stage. Rows in/out are taken
+    from the first positional argument and the return value when they have a
+    `shape`.
+    """
+    if func is None:
+        return lambda f: profiled(f, name=name)
+
+    stage_name = name or f'{func.__module__}.{func.__name__}'
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        rows_in = _rows(args[0]) if args else None
+        with stage(stage_name, rows_in=rows_in) as st:
+            out = func(*args, **kwargs)
+            st.rows_out = _rows(out)
+        return out
+
+    return wrapper
+
+
+def current_stage():
+    """ Innermost stage running on this thread, None if none """
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def attach(parent):
+    """
+    File stages started in this block under `parent`, a stage from another
+    thread (e.g. the one that handed this thread some work).
+    """
+    saved = _stack()
+    _local.stack = [parent] if parent is not None else []
+    try:
+        yield
+    finally:
+        _local.stack = saved
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+
+def _rows(obj):
+    shape = getattr(obj, 'shape', None)
+    if shape:
+        return int(shape[0])
+    return None
+
+
+def _current_rss():
+    """ Resident set size of this process now, in bytes, None if unknown """
+    global _process
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        pass
+    if psutil is not None:
+        if _process is None:
+            _process = psutil.Process()
+        return _process.memory_info().rss
+    return None
+
+
+def _peak_rss():
+    """
+    Peak resident set size of this process so far in bytes (over its whole
+    life, not one stage), None if unknown
+    """
+    global _process
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    if psutil is not None:
+        if _process is None:
+            _process = psutil.Process()
+        info = _process.memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    return None
+
+
+# Reports
+def stages():
+    """ Top-level stages recorded so far """
+    with _lock:
+        return list(_roots)
+
+
+def totals():
+    """ Calls, wall/CPU seconds and cache activity by stage name, all time """
+    with _lock:
+        return {name: dict(tot) for name, tot in _totals.items()}
+
+
+def reset():
+    """ Drop the recorded stage tree (`totals` are kept) """
+    with _lock:
+        del _roots[:]
+
+
+def report_text(roots=None):
+    """
+    Indented table of stages. Siblings with the same name (e.g., one call per
+    state) are collapsed into one line with a call count. `+MB` is the
+    stages' own change in RSS; `proc pk MB` the process's peak RSS so far.
+    """
+    roots = stages() if roots is None else roots
+    header = (f"{'stage':<56} {'calls':>5} {'wall s':>9} {'cpu s':>9} "
+              f"{'+MB':>7} {'proc pk MB':>10} {'rows in':>11} "
+              f"{'rows out':>11} {'hit/miss':>9} {'MB read':>8}")
+    lines = [header, '-' * len(header)]
+    _text_lines(roots, 0, lines)
+    return '\n'.join(lines)
+
+
+def _text_lines(stage_list, depth, lines):
+    groups = {}
+    for st in stage_list:
+        groups.setdefault(st.name, []).append(st)
+
+    for name, group in groups.items():
+        label = ('  ' * depth + name)[:56]
+        wall = sum(s.wall for s in group)
+        cpu = sum(s.cpu for s in group)
+        peaks = [s.rss_peak for s in group if s.rss_peak is not None]
+        growth = [s.rss_growth for s in group if s.rss_growth is not None]
+        hits = sum(s.cache in ('hit', 'memo') for s in group)
+        misses = sum(s.cache == 'miss' for s in group)
+        lines.append(
+            f"{label:<56} {len(group):>5} {wall:>9.2f} {cpu:>9.2f} "
+            f"{_mb(sum(growth) if growth else None):>7} "
+            f"{_mb(max(peaks) if peaks else None):>10} "
+            f"{_sum_str(s.rows_in for s in group):>11} "
+            f"{_sum_str(s.rows_out for s in group):>11} "
+            f"{(f'{hits}/{misses}' if hits or misses else '-'):>9} "
+            f"{_mb(_sum_or_none(s.bytes_read for s in group)):>8}"
+        )
+        children = [c for s in group for c in s.children]
+        _text_lines(children, depth + 1, lines)
+
+
+def report_json(roots=None):
+    roots = stages() if roots is None else roots
+    return json.dumps([st.to_dict() for st in roots], indent=1)
+
+
+def trace_events(roots=None):
+    """ Stages as Chrome trace-event 'complete' events (load in Perfetto) """
+    roots = stages() if roots is None else roots
+    pid = os.getpid()
+    events = []
+
+    def walk(st):
+        args = {k: getattr(st, k)
+                for k in ('cpu', 'rss_peak', 'rss', 'rss_growth', 'rows_in',
+                          'rows_out', 'cache', 'bytes_read', 'bytes_written')
+                if getattr(st, k) is not None}
+        events.append({'name': st.name, 'ph': 'X', 'pid': pid,
+                       'tid': st.thread,
+                       'ts': (st.start - _t0) * 1e6, 'dur': st.wall * 1e6,
+                       'args': args})
+        for child in st.children:
+            walk(child)
+
+    for st in roots:
+        walk(st)
+
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def write_report(prefix):
+    """
+    Write text, JSON and trace-event reports to `prefix`.*, then drop the
+    stages written
+    """
+    roots = stages()
+    with open(prefix + '.txt', 'w') as f:
+        f.write(report_text(roots))
+    with open(prefix + '.json', 'w') as f:
+        f.write(report_json(roots))
+    with open(prefix + '.trace.json', 'w') as f:
+        json.dump(trace_events(roots), f)
+    with _lock:
+        del _roots[:len(roots)]
+
+
+def disable_report():
+    """
+    No report at exit from this process, e.g. a pool worker, whose stages
+    would otherwise print once per worker
+    """
+    global _report
+    _report = False
+
+
+def _report_at_exit():
+    target = os.environ.get('MONCOV_PROFILE')
+    if not _report or not target or not stages():
+        return
+    if target == '1':
+        print(report_text(), file=sys.stderr)
+    else:
+        write_report(target)
+
+
+def _mb(x):
+    return '-' if x is None else f'{x / 2**20:.0f}'
+
+
+def _sum_or_none(values):
+    values = [v for v in values if v is not None]
+    return sum(values) if values else None
+
+
+def _sum_str(values):
+    total = _sum_or_none(values)
+    return '-' if total is None else str(total)
+
+
+atexit.register(_report_at_exit)
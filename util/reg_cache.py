@@ -0,0 +1,91 @@
+"""
+Disk cache for fitted regressions.
+
+`cached_reg` is a drop-in for `econtools.metrics.reg`. Results are keyed by
+the specification (outcome, regressors, absorbed fixed effects, cluster and
+any other options) and a fingerprint of the estimation data: a hash of the
+column names, dtypes, values and index of the whole frame passed in, so a
+change to any column (e.g. one a sample filter or weights were built from)
+means a new fit. If neither changed, the fit is read from disk instead of
+re-estimated.
+
+What's kept is the `econtools` Results object without its per-observation
+arrays (`yhat`, `resid`, `sample`): coefficients, standard errors, p-values,
+confidence intervals, the covariance matrix, N, R² and the model metadata,
+so a cache file is a few KB whatever the sample size. Statistics derived from
+the residuals (R², adjusted R², SSR) are computed before the arrays are
+dropped. It is still a `Results` (`econtools.outreg` needs one), but one
+without per-observation output.
+"""
+import copy
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from util.cache import read, write, memo_get, memo_put, _file_signature
+from util.env import data_path
+from util.profiling import stage
+
+
+REG_CACHE_VERSION = 2       # 2: per-observation arrays dropped
+PER_OBS_ATTRS = ('yhat', 'resid', 'sample')
+# Computed from per-observation arrays on first access, then kept
+DERIVED_STATS = ('r2', 'r2_a', 'ssr', 'df_r', 'df_m', 'summary')
+
+
+def cached_reg(df: pd.DataFrame, y_name: str, x_name, **kwargs):
+    """ `econtools.metrics.reg(df, y_name, x_name, **kwargs)`, cached """
+    x_name = [x_name] if isinstance(x_name, str) else list(x_name)
+    spec = dict(kwargs, y_name=y_name, x_name=x_name)
+    key = reg_key(df, spec)
+    filepath = reg_cache_path(key)
+
+    with stage('util.reg_cache.cached_reg', rows_in=len(df)) as st:
+        file_sig = _file_signature(filepath)
+        res = memo_get(filepath, file_sig)
+        if res is not None:
+            st.cache = 'memo'
+            return res
+        if file_sig is not None:
+            st.cache = 'hit'
+            st.bytes_read = file_sig[1]
+            res = read(filepath)
+        else:
+            import econtools.metrics as mt
+            st.cache = 'miss'
+            res = compact_results(mt.reg(df, y_name, x_name, **kwargs))
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            write(res, filepath)
+            st.bytes_written = os.path.getsize(filepath)
+
+    # Results objects are shared between callers; see `util.cache`
+    return memo_put(filepath, res, _file_signature(filepath))
+
+
+def compact_results(res):
+    """ Copy of econtools Results `res` without per-observation arrays """
+    res = copy.copy(res)
+    for name in DERIVED_STATS:
+        getattr(res, name)
+    for name in PER_OBS_ATTRS:
+        vars(res).pop(name, None)
+    return res
+
+
+def reg_key(df: pd.DataFrame, spec: dict) -> str:
+    """ Hash of `spec` and all of `df` """
+    data_hash = pd.util.hash_pandas_object(df, index=True).values
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str(REG_CACHE_VERSION).encode())
+    h.update(json.dumps(spec, sort_keys=True, default=str).encode())
+    h.update(json.dumps([(str(c), str(t)) for c, t in df.dtypes.items()])
+             .encode())
+    h.update(np.ascontiguousarray(data_hash).tobytes())
+    return h.hexdigest()
+
+
+def reg_cache_path(key: str) -> str:
+    return data_path('reg_cache', f'{key}.pkl')
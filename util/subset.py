@@ -0,0 +1,102 @@
+"""
+Run the pipeline on part of the country.
+
+Set `MONCOV_SUBSET` (or pass `--subset` to a top-level script) to a list of
+state fips codes or to a bounding box inside `util.conus_bounds`, in the same
+(xmin, xmax, ymin, ymax) order:
+
+    MONCOV_SUBSET=06,41 python calc_mortality.py
+    python reg_nonattain.py --subset bbox:-124,-114,32,42
+
+The loaders in `analysis.sources` then return only blocks, block groups,
+monitors and satellite cells in the subset, and every `load_or_build` file is
+kept under `<cache dir>/subset/<tag>/`, so subset runs never read or write the
+full-scale caches. Choose the subset before anything is loaded; memoized
+loaders don't notice a change within a process.
+"""
+import argparse
+import os
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+from util import conus_bounds
+
+
+Subset = namedtuple('Subset', ['states', 'bbox'])
+
+
+def subset():
+    """ The `Subset` (states, bbox) in effect, None for a full run """
+    spec = os.environ.get('MONCOV_SUBSET', '').strip()
+    if not spec or spec == 'all':
+        return None
+    return parse_subset(spec)
+
+
+def parse_subset(spec: str) -> Subset:
+    if spec.startswith('bbox:'):
+        bbox = tuple(float(v) for v in spec[len('bbox:'):].split(','))
+        if len(bbox) != 4:
+            raise ValueError(f"Subset bbox needs xmin,xmax,ymin,ymax: {spec}")
+        xmin, xmax, ymin, ymax = bbox
+        if not (conus_bounds[0] <= xmin < xmax <= conus_bounds[1] and
+                conus_bounds[2] <= ymin < ymax <= conus_bounds[3]):
+            raise ValueError(f"Subset bbox not inside {conus_bounds}: {spec}")
+        return Subset(states=None, bbox=bbox)
+
+    states = tuple(sorted({s.strip().zfill(2) for s in spec.split(',')
+                           if s.strip()}))
+    if not all(s.isdigit() and len(s) == 2 for s in states):
+        raise ValueError(f"Subset states must be fips codes: {spec}")
+    return Subset(states=states, bbox=None)
+
+
+def subset_tag() -> str:
+    """ Name of the subset's cache namespace, '' for a full run """
+    sub = subset()
+    if sub is None:
+        return ''
+    elif sub.states is not None:
+        return 'states_' + '_'.join(sub.states)
+    else:
+        return 'bbox_' + '_'.join(f'{v:g}' for v in sub.bbox)
+
+
+def set_subset(spec):
+    """ Select a subset for this process and any it starts """
+    if spec:
+        parse_subset(spec)      # Fail early on a bad spec
+        os.environ['MONCOV_SUBSET'] = spec
+    else:
+        os.environ.pop('MONCOV_SUBSET', None)
+
+
+def subset_cli():
+    """
+    Take `--subset SPEC` off the command line, if given, and select it. Call
+    before a script parses its own arguments.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--subset', type=str)
+    args, rest = parser.parse_known_args()
+    if args.subset is not None:
+        set_subset(args.subset)
+    sys.argv[1:] = rest
+
+
+def namespaced(filepath: str) -> str:
+    """ Where a cache file lives under the current subset (folder made) """
+    tag = subset_tag()
+    if not tag:
+        return filepath
+    folder, name = os.path.split(filepath)
+    folder = os.path.join(folder, 'subset', tag)
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, name)
+
+
+def in_bbox(x, y, bbox) -> 'np.ndarray':
+    xmin, xmax, ymin, ymax = bbox
+    return (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
@@ -1,12 +1,11 @@
-from econtools import force_iterable
-
-
 def weighted_quantile(df, var_name, wt_name, q=.5):
     """
     Returns weighted quantile of `var_name` given weights `wt_name`.
 
     `q` is the desired quantile, can be a single number or a list.
     """
+    from econtools import force_iterable
+
     tmp_df = df[[var_name, wt_name]].sort_values(var_name)
     cumsum = tmp_df[wt_name].cumsum()
 